@@ -33,22 +33,40 @@ the DevKitPro SDK in a .h file.
 
 Usage:
 Go to Export and type a name for the file.
+
+Outside of Blender, the script converts Wavefront OBJ files :
+python nds_3d_export.py [options] mesh.obj [mesh.obj ...]
 """
 
-from Blender.BGL import *
-import Blender
-from Blender import Texture,Image,Material,Object, Draw, BGL, Window , sys
+import os
+import optparse
+import hashlib
+import shutil
+import heapq
+import re
+try:
+    from Blender.BGL import *
+    import Blender
+    from Blender import Texture,Image,Material,Object, Draw, BGL, Window , sys
+except ImportError :
+    #Running from the command line : only the OBJ meshes can be exported
+    Blender = None
 import random
 from random import random
 import math
 from math import *
 from numpy import *
+import numpy.random
 from struct import *
+import array as pyarray
+import sys as pysys
+import time
 
 # Define libnds binary functions and macros
 
 def floattov16(n) :
-    return array(n * (1<<12) , float32).astype(int16)
+    #saturated to the v16 range [-8, 8[ instead of wrapping
+    return array(clip(n * (1<<12) , -0x8000 , 0x7FFF) , float32).astype(int16)
 
 def VERTEX_PACK(x,y) :
     return array((x & 0xFFFF) | (y << 16) , int32)
@@ -71,6 +89,44 @@ def TEXTURE_PACK(u,v) :
 def RGB15(r,g,b) :
     return array(r | (g << 5) | (b <<10 ) , int32)
 
+# Batch versions of the macros above : they work on whole arrays (one row per
+# face corner) instead of one scalar at a time, and give the same words.
+# The shifts are done on int64 so the int16 inputs don't overflow before the
+# final int32 truncation, exactly like the scalar path does.
+
+def floattov16_batch(n) :
+    return clip(asarray(n , float64) * (1<<12) , -0x8000 , 0x7FFF).astype(float32).astype(int16)
+
+def VERTEX_PACK_BATCH(x,y) :
+    x = asarray(x).astype(int64)
+    y = asarray(y).astype(int64)
+    return ((x & 0xFFFF) | (y << 16)).astype(int32)
+
+def floattov10_batch(n) :
+    n = asarray(n , float64)
+    v10 = (n * (1<<9)).astype(float32).astype(int16)
+    return where(n > .998 , int16(0x1FF) , v10).astype(int16)
+
+def NORMAL_PACK_BATCH(x,y,z) :
+    x = asarray(x).astype(int64)
+    y = asarray(y).astype(int64)
+    z = asarray(z).astype(int64)
+    return ((x & 0x3FF) | ((y & 0x3FF) << 10) | (z << 20)).astype(int32)
+
+def floattot16_batch(n) :
+    return (asarray(n , float64) * (1 << 4)).astype(float32).astype(int16)
+
+def TEXTURE_PACK_BATCH(u,v) :
+    u = asarray(u).astype(int64)
+    v = asarray(v).astype(int64)
+    return ((u & 0xFFFF) | (v << 16)).astype(int32)
+
+def RGB15_BATCH(r,g,b) :
+    r = asarray(r).astype(int64)
+    g = asarray(g).astype(int64)
+    b = asarray(b).astype(int64)
+    return (r | (g << 5) | (b << 10)).astype(int32)
+
 FIFO_VERTEX16  = 0x23
 FIFO_NORMAL    = 0x21
 FIFO_TEX_COORD = 0x22
@@ -78,6 +134,12 @@ FIFO_COLOR     = 0x20
 FIFO_NOP       = 0x00
 FIFO_BEGIN     = 0x40
 FIFO_END       = 0x41
+FIFO_VERTEX10    = 0x24
+FIFO_VERTEX_XY   = 0x25
+FIFO_VERTEX_XZ   = 0x26
+FIFO_VERTEX_YZ   = 0x27
+FIFO_DIFF_VERTEX = 0x28
+FIFO_RESTORE     = 0x14
 
 GL_GLBEGIN_ENUM = {
     'GL_TRIANGLES'      : 0 ,
@@ -88,6 +150,33 @@ GL_GLBEGIN_ENUM = {
     'GL_QUAD'           : 1
 }
 
+GL_GLBEGIN_NAMES = {
+    0 : 'GL_TRIANGLES' ,
+    1 : 'GL_QUADS' ,
+    2 : 'GL_TRIANGLE_STRIP' ,
+    3 : 'GL_QUAD_STRIP'
+}
+
+GL_TEXTURE_TYPE_ENUM = {
+    'GL_RGB32_A3'   : 1 ,
+    'GL_RGB4'       : 2 ,
+    'GL_RGB16'      : 3 ,
+    'GL_RGB256'     : 4 ,
+    'GL_COMPRESSED' : 5 ,
+    'GL_RGB8_A5'    : 6 ,
+    'GL_RGBA'       : 7
+}
+
+GL_TEXTURE_TYPE_NAMES = {
+    1 : 'GL_RGB32_A3' ,
+    2 : 'GL_RGB4' ,
+    3 : 'GL_RGB16' ,
+    4 : 'GL_RGB256' ,
+    5 : 'GL_COMPRESSED' ,
+    6 : 'GL_RGB8_A5' ,
+    7 : 'GL_RGBA'
+}
+
 EXPORT_OPTIONS = {
     'FORMAT_TEXT'   : 1,
     'FORMAT_BINARY' : 0,
@@ -96,29 +185,743 @@ EXPORT_OPTIONS = {
     'COLORS'        : 1,
     'NO_COLORS'     : 0,
     'NORMALS'       : 1,
-    'NO_NORMALS'    : 0
+    'NO_NORMALS'    : 0,
+    'STREAM'        : 1,
+    'NO_STREAM'     : 0,
+    'STATE_FILTER'   : 1,
+    'NO_STATE_FILTER': 0,
+    'COMPACT_VERTICES'   : 1,
+    'NO_COMPACT_VERTICES': 0,
+    'PACK_SCHEDULE'      : 1,
+    'NO_PACK_SCHEDULE'   : 0,
+    'STRIPS'        : 1,
+    'NO_STRIPS'     : 0,
+    'TEXTURE_PCX'   : 0,
+    'TEXTURE_AUTO'  : 255,
+    'SPLIT'         : 1,
+    'NO_SPLIT'      : 0,
+    'SPLIT_ALWAYS'  : 2,
+    'RESCALE'       : 1,
+    'NO_RESCALE'    : 0,
+    'ANIMATION'     : 1,
+    'NO_ANIMATION'  : 0,
+    'SKELETON'      : 1,
+    'NO_SKELETON'   : 0
 }
 
+#Number of commands a streaming export keeps in memory before writing them
+CMDSTREAM_CHUNK = 16384
+
+#Default quality (PSNR in dB) of the TEXTURE_AUTO textures
+TEXTURE_QUALITY = 30
+
+#Largest atlas page (in texels), the largest GX texture
+ATLAS_SIZE = 1024
+
+#Polygons and vertices the geometry engine holds per frame (polygon and
+#vertex RAM) : a mesh over them cannot be drawn whole
+POLYGON_BUDGET = 2048
+VERTEX_BUDGET = 6144
+
+#Default largest number of faces of a chunk, when splitting a mesh
+CHUNK_POLYGONS = 512
+
+#Largest number of levels of detail of a mesh, each one keeping LOD_RATIO of
+#the faces of the previous one
+LOD_LEVELS = 4
+LOD_RATIO = 0.5
+
+#A level of detail is drawn from the distance its error is under
+#LOD_PIXEL_ERROR pixels of the LOD_SCREEN_HEIGHT pixels high screen, seen with
+#a LOD_FOV degrees vertical field of view
+LOD_PIXEL_ERROR = 1.0
+LOD_SCREEN_HEIGHT = 192
+LOD_FOV = 70.0
+
+#Directions of the views the chunk culling is estimated with : looking from
+#the center of the mesh along each axis, with a 90 degrees field of view
+CHUNK_VIEWS = ( (0 , 1) , (0 , -1) , (1 , 1) , (1 , -1) , (2 , 1) , (2 , -1) )
+
+#Default largest error (in 1/4096 units) of an animation frame interpolated
+#between its keyframes
+ANIM_TOLERANCE = 16
+
+#Number of bones a skeleton may have : the position matrix stack holds 31
+#matrices, the first one being kept for the vertices without a bone
+SKELETON_BONES = 30
+
+#Default size (in bytes) of the export cache
+CACHE_SIZE = 64 * 1024 * 1024
+
+#Age (in seconds) after which a temporary file of the export cache is left over
+#by a process that died while storing its mesh
+CACHE_TMP_AGE = 3600
+
+#Entries (commands and parameters) of the geometry FIFO
+GX_FIFO_SIZE = 256
+
+#Cycles taken to send one word of a list to the geometry FIFO (DMA from main
+#memory, an estimate)
+GX_FEED_CYCLES = 2
+
+#Clock of the geometry engine (in Hz)
+GX_CLOCK = 33513982
+
+#Synthetic meshes of the benchmark : their kinds, their numbers of faces, how
+#many times each one is exported (keeping the fastest time and smallest memory
+#of each stage), and how much slower / bigger a stage may get than in the
+#baseline (stages faster than BENCH_MIN_TIME seconds are too noisy to be compared)
+BENCH_KINDS = ( 'grid' , 'sphere' , 'quads' , 'soup' , 'attributes' )
+BENCH_SIZES = ( 1000 , 10000 , 100000 , 1000000 )
+BENCH_RUNS = 3
+BENCH_THRESHOLD = 0.25
+BENCH_MIN_TIME = 0.2
+
+#Synthetic meshes --verify compares with the reference encoder, their number of
+#faces and the size of the texture their UVs are scaled to
+VERIFY_KINDS = ( 'attributes' , 'quads' , 'soup' )
+VERIFY_FACES = 2000
+VERIFY_TEXTURE = ( 128 , 128 )
+
+# a _mesh_source is what the exporter needs to know of a mesh, wherever it comes from :
+#  - name : the mesh name, used for the output files
+#  - get_vertices() : the positions and normals of the vertices, two (n,3) arrays
+#  - get_faces() : a list of (vertex indices, UVs, colors) tuples, one per triangle
+#    or quad. UVs are (u,v) tuples and colors (r,g,b) tuples of 0..255 ints, one
+#    per corner, or None if the mesh has none
+#  - has_uv() / has_colors() : does the mesh carry UV coordinates / vertex colors ?
+#  - get_texture() : (texture data, name, width, height) of the texture bound to
+#    the mesh, or None
+#  - get_texture_file(texture data) : the image file of that texture
+#  - get_materials() : a (texture, alpha) tuple per material, the texture being
+#    given as by get_texture()
+#  - get_face_materials() : the material index of each face of get_faces()
+#  - get_frames() : the positions of the vertices at each frame of the
+#    animation of the mesh, (n,3) arrays the first one being the positions of
+#    get_vertices(), or [] if the mesh is not animated
+#  - get_skeleton() : ( bone names , bone index of each vertex (-1 if none) ,
+#    the (nb_bones,3,4) skinning matrices of each frame ) of the armature the
+#    mesh is deformed by, or None. A skinning matrix moves the vertices from
+#    the rest pose to the pose of the frame : p' = M[:,:3] p + M[:,3]
+#  - has_skeleton() : is the mesh deformed by an armature ? (without sampling
+#    its poses, unlike get_skeleton())
+class _mesh_source (object) :
+    __slots__ = 'name'
+
+    def get_vertices(self) :
+        return ( ( zeros((0,3) , float64) , zeros((0,3) , float64) ) )
+
+    def get_faces(self) :
+        return ( [] )
+
+    def has_uv(self) :
+        return ( False )
+
+    def has_colors(self) :
+        return ( False )
+
+    def get_texture(self) :
+        return ( None )
+
+    def get_texture_file(self,texture_data) :
+        return ( texture_data )
+
+    def get_materials(self) :
+        return ( [ ( self.get_texture() , 1.0 ) ] )
+
+    def get_face_materials(self) :
+        return ( [ 0 ] * len(self.get_faces()) )
+
+    def get_frames(self) :
+        return ( [] )
+
+    def get_skeleton(self) :
+        return ( None )
+
+    def has_skeleton(self) :
+        return ( False )
+
+
+# a _blender_mesh_source reads a Blender Mesh, and the armature its object is
+# parented to (the mesh and the armature objects being at the same place)
+class _blender_mesh_source (_mesh_source) :
+    __slots__ = 'mesh' , 'object'
+
+    def __init__(self,mesh,object=None) :
+        self.mesh = mesh
+        self.object = object
+        self.name = mesh.name
+
+    def get_vertices(self) :
+        co = array( [ (v.co[0] , v.co[1] , v.co[2]) for v in self.mesh.verts ] , float64 ).reshape(-1,3)
+        no = array( [ (v.no[0] , v.no[1] , v.no[2]) for v in self.mesh.verts ] , float64 ).reshape(-1,3)
+        return ( co , no )
+
+    def get_faces(self) :
+        faces = []
+        uv = self.has_uv()
+        col = self.has_colors()
+        for face in self.mesh.faces :
+            faces.append( ( [ v.index for v in face.v ] ,
+                            ( [ (c.x , c.y) for c in face.uv ] if (uv) else None ) ,
+                            ( [ (c.r , c.g , c.b) for c in face.col ] if (col) else None ) ) )
+        return ( faces )
+
+    def has_uv(self) :
+        return ( self.mesh.faceUV )
+
+    def has_colors(self) :
+        return ( self.mesh.vertexColors )
+
+    def get_texture(self) :
+        materials = self.mesh.materials
+        #Here we take the first material in the mesh
+        if len(materials)>0 :
+            return ( self.get_material_texture(materials[0]) )
+        return ( None )
+
+    def get_material_texture(self,material) :
+        tex = []
+        if (material != None) :
+            tex = material.getTextures()
+
+        #Here we take the first Texture of Image Type
+        for t in tex :
+            if t != None :
+                if (t.tex.getType() == 'Image' and t.tex.getImage() != None) :
+                    image = t.tex.getImage()
+                    return ( image , image.getName() , image.getSize()[0] , image.getSize()[1] )
+        return ( None )
+
+    def get_materials(self) :
+        materials = [ ( self.get_material_texture(m) , (m.alpha if (m != None) else 1.0) ) for m in self.mesh.materials ]
+        if (len(materials) == 0) :
+            return ( [ ( None , 1.0 ) ] )
+        return ( materials )
+
+    def get_face_materials(self) :
+        last = max( len(self.mesh.materials) - 1 , 0 )
+        return ( [ min(face.mat , last) for face in self.mesh.faces ] )
+
+    def get_frames(self) :
+        #the shape keys of the mesh, the basis being the first frame
+        key = self.mesh.key
+        if (key == None or len(key.blocks) < 2) :
+            return ( [] )
+        frames = [ self.get_vertices()[0] ]
+        for block in key.blocks[1:] :
+            frames.append( array( [ (v[0] , v[1] , v[2]) for v in block.data ] , float64 ).reshape(-1,3) )
+        return ( frames )
+
+    def get_armature(self) :
+        #the armature object the mesh object is parented to, or None
+        armature = None
+        if (self.object != None) : armature = self.object.getParent()
+        if (armature == None or armature.getType() != 'Armature') :
+            return ( None )
+        return ( armature )
+
+    def has_skeleton(self) :
+        return ( self.get_armature() != None )
+
+    def get_skeleton(self) :
+        #steps the scene through all its frames : only called when the
+        #skeleton is exported
+        armature = self.get_armature()
+        if (armature == None) :
+            return ( None )
+        bones = armature.getData().bones
+        names = bones.keys()
+        names.sort()
+
+        #the bone of a vertex is the group it has the most weight in
+        vertex_bones = [ -1 ] * len(self.mesh.verts)
+        weights = [ 0.0 ] * len(self.mesh.verts)
+        for group in self.mesh.getVertGroupNames() :
+            if not ( group in names ) : continue
+            for i , weight in self.mesh.getVertsFromGroup(group , 1) :
+                if (weight > weights[i]) :
+                    weights[i] = weight
+                    vertex_bones[i] = names.index(group)
+
+        #the poses of the frames of the scene, the Blender matrices being
+        #applied to row vectors
+        context = Blender.Scene.GetCurrent().getRenderingContext()
+        current = Blender.Get('curframe')
+        frames = []
+        for frame in range(context.startFrame() , context.endFrame() + 1) :
+            Blender.Set('curframe' , frame)
+            pose = armature.getPose()
+            matrices = []
+            for name in names :
+                rest = bones[name].matrix['ARMATURESPACE'].copy().invert()
+                matrix = rest * pose.bones[name].poseMatrix
+                matrices.append( array( [ list(row) for row in matrix ] , float64 ).T[:3] )
+            frames.append( array(matrices , float64).reshape(-1,3,4) )
+        Blender.Set('curframe' , current)
+        return ( ( names , vertex_bones , frames ) )
+
+    def get_texture_file(self,image) :
+        print image.filename
+        print Blender.sys.expandpath(image.filename)
+        if (image.packed ) : image.unpack(Blender.UnpackModes.USE_LOCAL)
+        return ( Blender.sys.expandpath(image.getFilename()) )
+
+
+# a _obj_mesh_source reads a Wavefront OBJ file, and the MTL files it uses.
+# OBJ corners index positions, UVs and normals separately : a vertex of the
+# source is a (position, normal) pair, and the positions without normals get
+# the average normal of their faces. The polygons are cut in triangle fans, and
+# the "v x y z r g b" vertex colors extension is supported.
+# The materials are those used by the faces (usemtl), their texture is their
+# map_Kd and their alpha their d (or 1 - Tr). The texture of the mesh is the
+# one of the first material with one.
+# An animated mesh is a list of OBJ files, one per frame : only the positions
+# ("v" lines) of the frames after the first one are read, they must be as many
+# as in the first one.
+class _obj_mesh_source (_mesh_source) :
+    __slots__ = 'path' , 'co' , 'no' , 'faces' , 'uv' , 'colors' , 'materials' , 'alphas' , 'material_names' , 'face_materials' , 'texture' , 'positions' , 'frames'
+
+    def __init__(self,path,frames=()) :
+        self.path = path
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self.materials = {}
+        self.alphas = {}
+        self.material_names = []
+        self.face_materials = []
+        self.texture = None
+        self.uv = False
+        self.colors = False
+        self.parse()
+        self.frames = []
+        if (len(frames) > 0) :
+            self.frames = [ self.co ] + [ self.parse_frame(frame) for frame in frames ]
+
+    def parse(self) :
+        positions = []
+        colors = []
+        uvs = []
+        normals = []
+        corners = {}
+        vertices = []
+        self.faces = []
+        material = 0
+
+        def get_index(token , count) :
+            if (token == '') : return ( None )
+            i = int(token)
+            if (i < 0) : return ( count + i )
+            return ( i - 1 )
+
+        f = open(self.path , "r")
+        for line in f :
+            tokens = line.split()
+            if (len(tokens) == 0) : continue
+            tag = tokens[0]
+            if (tag == 'v') :
+                positions.append( tuple( [ float(t) for t in tokens[1:4] ] ) )
+                if (len(tokens) >= 7) :
+                    colors.append( tuple( [ min( max( int(round(float(t) * 255)) , 0 ) , 255 ) for t in tokens[4:7] ] ) )
+                    self.colors = True
+                else :
+                    colors.append( (255 , 255 , 255) )
+            elif (tag == 'vt') :
+                uvs.append( ( float(tokens[1]) , float(tokens[2]) if (len(tokens) > 2) else 0.0 ) )
+            elif (tag == 'vn') :
+                normals.append( tuple( [ float(t) for t in tokens[1:4] ] ) )
+            elif (tag == 'f') :
+                index = []
+                face_uv = []
+                face_col = []
+                for corner in tokens[1:] :
+                    refs = (corner.split('/') + ['' , ''])[:3]
+                    vi = get_index(refs[0] , len(positions))
+                    ti = get_index(refs[1] , len(uvs))
+                    ni = get_index(refs[2] , len(normals))
+                    key = ( vi , ni )
+                    if not ( key in corners ) :
+                        corners[key] = len(vertices)
+                        vertices.append( key )
+                    index.append( corners[key] )
+                    if (ti != None) :
+                        face_uv.append( uvs[ti] )
+                        self.uv = True
+                    else :
+                        #no UV : no TEXTURE_PACK for this corner
+                        face_uv.append( (-1.0 , -1.0) )
+                    face_col.append( colors[vi] )
+                if (len(index) <= 4) :
+                    self.faces.append( (index , face_uv , face_col) )
+                    self.face_materials.append(material)
+                else :
+                    #triangle fan for the polygons
+                    for i in range(1 , len(index) - 1) :
+                        fan = [ 0 , i , i + 1 ]
+                        self.faces.append( ( [ index[j] for j in fan ] , [ face_uv[j] for j in fan ] , [ face_col[j] for j in fan ] ) )
+                        self.face_materials.append(material)
+            elif (tag == 'mtllib') :
+                for name in tokens[1:] :
+                    self.parse_mtl(os.path.join(os.path.dirname(self.path) , name))
+            elif (tag == 'usemtl' and len(tokens) > 1) :
+                if not ( tokens[1] in self.material_names ) :
+                    self.material_names.append(tokens[1])
+                material = self.material_names.index(tokens[1])
+        f.close()
+
+        for name in self.material_names :
+            if (self.materials.get(name) != None) :
+                self.texture = self.materials[name]
+                break
+        if (len(self.material_names) == 0) :
+            self.material_names.append(None)
+
+        kept = [ i for i , face in enumerate(self.faces) if len(face[0]) >= 3 ]
+        self.faces = [ self.faces[i] for i in kept ]
+        self.face_materials = [ self.face_materials[i] for i in kept ]
+        positions = array(positions , float64).reshape(-1,3)
+        normals = array(normals , float64).reshape(-1,3)
+        vertices = array( [ ( vi , (ni if (ni != None) else -1) ) for vi , ni in vertices ] , int32 ).reshape(-1,2)
+        self.positions = ( len(positions) , vertices[:,0] )
+        self.co = positions[vertices[:,0]]
+        self.no = zeros( (len(vertices) , 3) , float64 )
+        has_normal = vertices[:,1] >= 0
+        self.no[has_normal] = normals[vertices[has_normal,1]]
+        if not ( has_normal.all() ) :
+            #smooth normals, the sum of the face normals around each position
+            smooth = zeros( (len(positions) , 3) , float64 )
+            for index , face_uv , face_col in self.faces :
+                p = self.co[index]
+                n = cross(p[1] - p[0] , p[2] - p[0])
+                for i in index : smooth[vertices[i,0]] += n
+                if (len(index) == 4) :
+                    n = cross(p[2] - p[0] , p[3] - p[0])
+                    for i in index : smooth[vertices[i,0]] += n
+            length = sqrt( (smooth * smooth).sum(axis=1) ).reshape(-1,1)
+            smooth = smooth / where(length > 0 , length , 1)
+            self.no[~has_normal] = smooth[vertices[~has_normal,0]]
+
+        print "%s : %d vertices , %d faces" % (self.path , len(self.co) , len(self.faces))
+
+    def parse_mtl(self,path) :
+        if not ( os.path.exists(path) ) :
+            print "!!!Warning : Cannot find material library %s!!!" % path
+            return
+        material = None
+        f = open(path , "r")
+        for line in f :
+            tokens = line.split()
+            if (len(tokens) == 0) : continue
+            if (tokens[0] == 'newmtl' and len(tokens) > 1) :
+                material = tokens[1]
+                self.materials[material] = None
+            elif (tokens[0] == 'map_Kd' and len(tokens) > 1 and material != None) :
+                #the options (-s , -o , ...) come before the file name
+                self.materials[material] = os.path.join(os.path.dirname(path) , tokens[-1])
+            elif (tokens[0] == 'd' and len(tokens) > 1 and material != None) :
+                self.alphas[material] = float(tokens[1])
+            elif (tokens[0] == 'Tr' and len(tokens) > 1 and material != None) :
+                self.alphas[material] = 1.0 - float(tokens[1])
+        f.close()
+
+    def get_vertices(self) :
+        return ( self.co , self.no )
+
+    def get_faces(self) :
+        if (self.uv and self.colors) :
+            return ( self.faces )
+        return ( [ ( index , (face_uv if (self.uv) else None) , (face_col if (self.colors) else None) ) for index , face_uv , face_col in self.faces ] )
+
+    def has_uv(self) :
+        return ( self.uv )
+
+    def has_colors(self) :
+        return ( self.colors )
+
+    def get_texture(self) :
+        return ( self.get_image(self.texture) )
+
+    def get_image(self,path) :
+        if (path == None) : return ( None )
+        try:
+            import PIL.Image
+        except ImportError :
+            print "Python Imaging Library not installed : cannot read %s" % path
+            return ( None )
+        try:
+            w , h = PIL.Image.open(path).size
+        except IOError :
+            print "!!!Warning : Cannot read texture %s!!!" % path
+            return ( None )
+        return ( path , os.path.basename(path) , w , h )
+
+    def get_materials(self) :
+        return ( [ ( self.get_image(self.materials.get(name)) , self.alphas.get(name , 1.0) ) for name in self.material_names ] )
+
+    def parse_frame(self,path) :
+        #the positions of the vertices in another frame of the mesh
+        nb_positions , index = self.positions
+        positions = []
+        f = open(path , "r")
+        for line in f :
+            tokens = line.split()
+            if (len(tokens) >= 4 and tokens[0] == 'v') :
+                positions.append( tuple( [ float(t) for t in tokens[1:4] ] ) )
+        f.close()
+        if (len(positions) != nb_positions) :
+            raise ValueError("%s : %d vertices, %d expected as in %s" % (path , len(positions) , nb_positions , self.path))
+        return ( array(positions , float64).reshape(-1,3)[index] )
+
+    def get_frames(self) :
+        return ( self.frames )
+
+    def get_face_materials(self) :
+        return ( self.face_materials )
+
+
+# a _mesh_snapshot is a copy of what the export reads from another _mesh_source.
+# It is cheap to take, even in Blender, and holds nothing but arrays and lists,
+# so it can be sent to the processes of a _nds_batch_export.
+class _mesh_snapshot (_mesh_source) :
+    __slots__ = 'co' , 'no' , 'faces' , 'uv' , 'colors' , 'texture' , 'face_materials' , 'frames' , 'skeleton'
+
+    def __init__(self,source,texture_data,skeleton=False) :
+        self.name = source.name
+        self.co , self.no = source.get_vertices()
+        self.faces = source.get_faces()
+        self.uv = source.has_uv()
+        self.colors = source.has_colors()
+        self.texture = [ source.get_texture_file(t) for t in texture_data ]
+        self.face_materials = source.get_face_materials()
+        self.frames = source.get_frames()
+        #the poses are only sampled when the skeleton is exported
+        self.skeleton = source.get_skeleton() if (skeleton) else None
+
+    def __getstate__(self) :
+        return ( ( self.name , self.co , self.no , self.faces , self.uv , self.colors , self.texture , self.face_materials , self.frames , self.skeleton ) )
+
+    def __setstate__(self,state) :
+        ( self.name , self.co , self.no , self.faces , self.uv , self.colors , self.texture , self.face_materials , self.frames , self.skeleton ) = state
+
+    def get_vertices(self) :
+        return ( self.co , self.no )
+
+    def get_faces(self) :
+        return ( self.faces )
+
+    def has_uv(self) :
+        return ( self.uv )
+
+    def has_colors(self) :
+        return ( self.colors )
+
+    def get_face_materials(self) :
+        return ( self.face_materials )
+
+    def get_frames(self) :
+        return ( self.frames )
+
+    def get_skeleton(self) :
+        return ( self.skeleton )
+
+    def has_skeleton(self) :
+        return ( self.skeleton != None )
+
+
+# a _mesh_lod_source is a level of detail of a mesh : the vertices (and the
+# skeleton already read, if any) of the mesh, with the faces left by a
+# _nds_decimator
+class _mesh_lod_source (_mesh_source) :
+    __slots__ = 'co' , 'no' , 'faces' , 'face_materials' , 'uv' , 'colors' , 'frames' , 'skeleton'
+
+    def __init__(self,source,name,faces,face_materials,skeleton=None) :
+        self.name = name
+        self.co , self.no = source.get_vertices()
+        self.frames = source.get_frames()
+        self.skeleton = skeleton
+        self.faces = faces
+        self.face_materials = face_materials
+        self.uv = source.has_uv()
+        self.colors = source.has_colors()
+
+    def get_vertices(self) :
+        return ( ( self.co , self.no ) )
+
+    def get_faces(self) :
+        return ( self.faces )
+
+    def has_uv(self) :
+        return ( self.uv )
+
+    def has_colors(self) :
+        return ( self.colors )
+
+    def get_face_materials(self) :
+        return ( self.face_materials )
+
+    def get_frames(self) :
+        return ( self.frames )
+
+    def get_skeleton(self) :
+        return ( self.skeleton )
+
+    def has_skeleton(self) :
+        return ( self.skeleton != None )
+
+
+# a _synthetic_mesh_source generates a mesh of about nb_faces faces, standing in
+# for a Blender mesh in the benchmark :
+#  - grid : a wavy height field of triangles
+#  - sphere : a UV sphere, quads with triangles at the poles
+#  - quads : a torus of quads, one in eight split into two triangles
+#  - soup : unconnected triangles scattered in a cube
+#  - attributes : the sphere, with UV coordinates and vertex colors
+class _synthetic_mesh_source (_mesh_source) :
+    __slots__ = 'kind' , 'co' , 'no' , 'faces' , 'uv' , 'colors'
+
+    def __init__(self,kind,nb_faces) :
+        self.kind = kind
+        self.name = "%s_%d" % (kind , nb_faces)
+        self.uv = False
+        self.colors = False
+        if (kind == 'grid') : self.make_grid(nb_faces)
+        elif (kind == 'sphere') : self.make_sphere(nb_faces)
+        elif (kind == 'quads') : self.make_torus(nb_faces)
+        elif (kind == 'soup') : self.make_soup(nb_faces)
+        elif (kind == 'attributes') :
+            self.uv = True
+            self.colors = True
+            self.make_sphere(nb_faces)
+        else :
+            raise ValueError("unknown synthetic mesh %s" % kind)
+
+    def set_faces(self,index,uv=None,colors=None) :
+        #faces of (index , UVs , colors) tuples, from a (nb_faces,nb_corners)
+        #array and (nb_faces,nb_corners,2 or 3) lists
+        index = index.tolist()
+        uv = [ None ] * len(index) if (uv == None) else [ tuple( [ tuple(c) for c in f ] ) for f in uv ]
+        colors = [ None ] * len(index) if (colors == None) else [ tuple( [ tuple(c) for c in f ] ) for f in colors ]
+        self.faces += [ ( tuple(i) , u , c ) for i , u , c in zip(index , uv , colors) ]
+
+    def make_grid(self,nb_faces) :
+        n = max(int(ceil(sqrt(nb_faces / 2.0))) , 1)
+        x , y = meshgrid(linspace(-1 , 1 , n + 1) , linspace(-1 , 1 , n + 1))
+        x = x.ravel()
+        y = y.ravel()
+        self.co = column_stack( ( x , y , 0.1 * sin(3 * x) * cos(3 * y) ) )
+        no = column_stack( ( -0.3 * cos(3 * x) * cos(3 * y) , 0.3 * sin(3 * x) * sin(3 * y) , ones(len(x)) ) )
+        self.no = no / sqrt((no ** 2).sum(1)).reshape(-1,1)
+        v = arange((n + 1) * (n + 1)).reshape(n + 1 , n + 1)
+        a , b , c , d = v[:-1,:-1].ravel() , v[:-1,1:].ravel() , v[1:,1:].ravel() , v[1:,:-1].ravel()
+        self.faces = []
+        self.set_faces( column_stack( ( a , b , c , a , c , d ) ).reshape(-1,3)[:nb_faces] )
+
+    def make_sphere(self,nb_faces) :
+        #rings x 2 rings segments faces, the corners given by their (ring , segment)
+        rings = max(int(round(sqrt(nb_faces / 2.0))) , 2)
+        segments = 2 * rings
+        theta = arange(rings + 1) * pi / rings
+        phi = arange(segments) * 2 * pi / segments
+        co = [ array( [ ( 0.0 , 0.0 , 1.0 ) ] ) ]
+        co.append( column_stack( ( outer(sin(theta[1:-1]) , cos(phi)).ravel() , outer(sin(theta[1:-1]) , sin(phi)).ravel() , repeat(cos(theta[1:-1]) , segments) ) ) )
+        co.append( array( [ ( 0.0 , 0.0 , -1.0 ) ] ) )
+        self.co = concatenate(co)
+        self.no = self.co.copy()
+
+        self.faces = []
+        j = arange(segments)
+        top = ( zeros((segments , 3) , int32) + ( 0 , 1 , 1 ) , column_stack( ( j , j + 1 , j ) ) )
+        i = repeat(arange(1 , rings - 1) , segments)
+        j = tile(arange(segments) , rings - 2)
+        middle = ( column_stack( ( i , i + 1 , i + 1 , i ) ) , column_stack( ( j , j , j + 1 , j + 1 ) ) )
+        j = arange(segments)
+        bottom = ( zeros((segments , 3) , int32) + ( rings - 1 , rings , rings - 1 ) , column_stack( ( j , j , j + 1 ) ) )
+        for ring , segment in ( middle , top , bottom ) :
+            index = where(ring == 0 , 0 , where(ring == rings , len(self.co) - 1 , 1 + (ring - 1) * segments + segment % segments))
+            uv = colors = None
+            if (self.uv) : uv = dstack( ( segment / float(segments) , 1 - ring / float(rings) ) ).tolist()
+            if (self.colors) : colors = ((self.co[index] + 1) * 127.5).astype(int32).tolist()
+            self.set_faces(index , uv , colors)
+
+    def make_torus(self,nb_faces) :
+        nb_quads = max(nb_faces * 8 / 9 , 8)
+        v = max(int(round(sqrt(nb_quads / 2.0))) , 3)
+        u = 2 * v
+        i = repeat(arange(u) , v)
+        j = tile(arange(v) , u)
+        a = i * 2 * pi / u
+        b = j * 2 * pi / v
+        self.co = column_stack( ( (1 + 0.3 * cos(b)) * cos(a) , (1 + 0.3 * cos(b)) * sin(a) , 0.3 * sin(b) ) )
+        self.no = column_stack( ( cos(b) * cos(a) , cos(b) * sin(a) , sin(b) ) )
+        quads = column_stack( ( i * v + j , ((i + 1) % u) * v + j , ((i + 1) % u) * v + (j + 1) % v , i * v + (j + 1) % v ) )
+        split = (arange(len(quads)) % 8) == 7
+        self.faces = []
+        self.set_faces(quads[~split])
+        self.set_faces(quads[split][:,(0 , 1 , 2 , 0 , 2 , 3)].reshape(-1,3))
+
+    def make_soup(self,nb_faces) :
+        state = numpy.random.RandomState(nb_faces)
+        co = state.uniform(-1 , 1 , (nb_faces , 1 , 3)) + state.normal(0 , 0.05 , (nb_faces , 3 , 3))
+        no = cross(co[:,1] - co[:,0] , co[:,2] - co[:,0])
+        no /= maximum(sqrt((no ** 2).sum(1)) , 1e-12).reshape(-1,1)
+        self.co = co.reshape(-1,3)
+        self.no = repeat(no , 3 , 0)
+        self.faces = []
+        self.set_faces(arange(3 * nb_faces).reshape(-1,3))
+
+    def get_vertices(self) :
+        return ( self.co , self.no )
+
+    def get_faces(self) :
+        return ( self.faces )
+
+    def has_uv(self) :
+        return ( self.uv )
+
+    def has_colors(self) :
+        return ( self.colors )
+
+
 # a _mesh_option represents export options in the gui
 class _mesh_options (object) :
-    __slots__ = 'format' , 'uv_export' ,'texfile_export' , 'normals_export' , 'color_export' , 'mesh_data' , 'mesh_name', 'texture_data' , 'texture_list' , 'texture_w' , 'texture_h', 'dir_path'
+    __slots__ = 'format' , 'uv_export' ,'texfile_export' , 'normals_export' , 'color_export' , 'stream_export' , 'state_filter' , 'compact_vertices' , 'vertex_tolerance' , 'pack_schedule' , 'strips' , 'mesh_data' , 'mesh_name', 'texture_data' , 'texture_list' , 'texture_sizes' , 'materials' , 'texture_w' , 'texture_h', 'texture_x' , 'texture_y' , 'texture_format' , 'texture_quality' , 'split_budget' , 'polygon_budget' , 'vertex_budget' , 'chunk_polygons' , 'lod_levels' , 'rescale' , 'anim_export' , 'anim_tolerance' , 'skeleton_export' , 'dir_path'
 
     def __init__(self,mesh_data,dir_path) :
         self.format         = EXPORT_OPTIONS['FORMAT_BINARY']   #Which format for the export? FORMAT_BINARY->Binary, FORMAT_TEXT->C-Style
         self.uv_export      = EXPORT_OPTIONS['NO_TEXCOORDS']    #Do we export uv coordinates? NO_TEXCOORDS->No, TEXCOORDS->Yes
         self.normals_export = EXPORT_OPTIONS['NORMALS']         #Do we export normals coordinates ? NO_NORMALS->No, NORMALS->Yes
         self.color_export   = EXPORT_OPTIONS['NO_COLORS']          #Do we export color attributes ? COLORS->No, NO_COLORS->Yes
-
-        self.mesh_data = mesh_data #The Blender Mesh data
-        self.mesh_name = mesh_data.name #The Blender Mesh name
+        self.stream_export  = EXPORT_OPTIONS['NO_STREAM']       #Do we write the list while it is built ? NO_STREAM->No, STREAM->Yes
+        self.state_filter   = EXPORT_OPTIONS['STATE_FILTER']    #Do we drop the attributes commands that repeat the current state ? NO_STATE_FILTER->No, STATE_FILTER->Yes
+        self.compact_vertices = EXPORT_OPTIONS['COMPACT_VERTICES'] #Do we use the 1 parameter vertex commands when possible ? NO_COMPACT_VERTICES->No, COMPACT_VERTICES->Yes
+        self.vertex_tolerance = 0                               #How far (in 1/4096 units) a vertex may move to fit in a FIFO_VERTEX10
+        self.pack_schedule  = EXPORT_OPTIONS['PACK_SCHEDULE']   #Do we drop the FIFO_END commands that would make a list end on a padded pack ? NO_PACK_SCHEDULE->No, PACK_SCHEDULE->Yes
+        self.strips         = EXPORT_OPTIONS['STRIPS']          #Do we link the faces into triangle / quad strips ? NO_STRIPS->No, STRIPS->Yes
+        self.texture_format = EXPORT_OPTIONS['TEXTURE_PCX']     #Which texture format ? TEXTURE_PCX->PCX file, TEXTURE_AUTO->Smallest GX format within texture_quality, GL_TEXTURE_TYPE_ENUM->This GX format
+        self.texture_quality = TEXTURE_QUALITY                  #Lowest PSNR (in dB) of a TEXTURE_AUTO texture
+        self.split_budget   = EXPORT_OPTIONS['NO_SPLIT']        #Do we split the mesh into chunks ? NO_SPLIT->No, SPLIT->If over the budget, SPLIT_ALWAYS->Yes
+        self.polygon_budget = POLYGON_BUDGET                    #Polygons a mesh may use (a frame holds POLYGON_BUDGET)
+        self.vertex_budget  = VERTEX_BUDGET                     #Vertices a mesh may use (a frame holds VERTEX_BUDGET)
+        self.chunk_polygons = CHUNK_POLYGONS                    #Largest number of faces of a chunk
+        self.lod_levels     = 1                                 #Number of levels of detail (1 to LOD_LEVELS), the first one being the mesh
+        self.rescale        = EXPORT_OPTIONS['NO_RESCALE']      #Do we scale the vertices to the whole v16 range (with a scale header) ? NO_RESCALE->No, RESCALE->Yes
+        self.anim_export    = EXPORT_OPTIONS['NO_ANIMATION']    #Do we export the frames of the mesh as keyframe deltas ? NO_ANIMATION->No, ANIMATION->Yes
+        self.anim_tolerance = ANIM_TOLERANCE                    #How far (in 1/4096 units) an interpolated frame may be from the exported one
+        self.skeleton_export = EXPORT_OPTIONS['NO_SKELETON']    #Do we skin the vertices with the matrix stack and export the bone tracks ? NO_SKELETON->No, SKELETON->Yes
+
+        self.mesh_data = mesh_data #The _mesh_source of the mesh
+        self.mesh_name = mesh_data.name #The mesh name
         self.texture_w = 0
         self.texture_h = 0
-        self.list_textures() #Retrieve all texture bound to the Blender mesh
+        self.texture_x = 0 #Where the texture is in its atlas page (in texels)
+        self.texture_y = 0
+        self.list_textures() #Retrieve all texture bound to the mesh
         
-        if (self.mesh_data.faceUV ): self.uv_export = EXPORT_OPTIONS['TEXCOORDS']
+        if (self.mesh_data.has_uv() ): self.uv_export = EXPORT_OPTIONS['TEXCOORDS']
         else: self.uv_export = EXPORT_OPTIONS['NO_TEXCOORDS']
-        if (self.mesh_data.vertexColors ) : self.color_export = EXPORT_OPTIONS['COLORS']
+        if (self.mesh_data.has_colors() ) : self.color_export = EXPORT_OPTIONS['COLORS']
         else: self.color_export = EXPORT_OPTIONS['NO_COLORS']
+        if (len(self.mesh_data.get_frames()) > 1) : self.anim_export = EXPORT_OPTIONS['ANIMATION']
+        if (self.mesh_data.has_skeleton()) : self.skeleton_export = EXPORT_OPTIONS['SKELETON']
         
         self.dir_path = dir_path
         self.texfile_export = 0
@@ -126,286 +929,1687 @@ class _mesh_options (object) :
 
     def list_textures(self) :
         print "listing textures for mesh \"%s\"" % self.mesh_name
-        materials = self.mesh_data.materials
         self.texture_data = []
-        #Here we take the first material in the mesh
-        tex = []
-        if len(materials)>0 :
-            tex = materials[0].getTextures()
-
         self.texture_list = []
-        #Here we take the first Texture of Image Type
-        img_found = 0
-        if len(tex)>0 :
-            for t in tex :
-                if t != None :
-                    if (t.tex.getType() == 'Image' and t.tex.getImage() != None) :
-                        image = t.tex.getImage()
-                        self.texture_list.append(t)
-                        img_found = 1
-                        #print "%s %dx%d" % (image.getName(),image.getSize()[0],image.getSize()[1])
-
-        if (img_found == 1):
-            image = self.texture_list[0].tex.getImage()
-            self.texture_data.append(image)
-
-            w = image.getSize()[0]
-            h = image.getSize()[1]
-            ratio = float(w)/float(h)
-            print "Texture %s %dx%d ratio=%f" % (image.getName(),w,h,ratio)
-
-            if (w > 128) : w = 128
-            if (w < 8) : w = 8
-
-            if (h > 128) : h = 128
-            if (h < 8) : h = 8
-
-            if (ratio < 1.0) :
-                w = h * (1/round(1/ratio))
-                print "ratio <  1 : Texture %s %dx%d" % (image.getName(),w,h)
-            else :
-                h = w / round(ratio)
-                print "ratio >= 1 :Texture %s %dx%d" % (image.getName(),w,h)
-
-            self.texture_w = int(w)
-            self.texture_h = int(h)
+        self.texture_sizes = []
+        materials = self.mesh_data.get_materials()
+
+        #the texture of the mesh comes first, then the other textures of its
+        #materials, each texture being listed once
+        for texture in [ self.mesh_data.get_texture() ] + [ m[0] for m in materials ] :
+            if (texture == None or texture[0] in self.texture_data) : continue
+            self.texture_list.append(texture)
+            self.texture_data.append(texture[0])
+            self.texture_sizes.append( self.get_texture_size(texture) )
+
+        #(index in texture_data or None , alpha) of each material of the mesh
+        self.materials = []
+        for texture , alpha in materials :
+            if (texture == None) : self.materials.append( ( None , alpha ) )
+            else : self.materials.append( ( self.texture_data.index(texture[0]) , alpha ) )
+
+        if (len(self.texture_data) > 0):
+            self.texture_w , self.texture_h = self.texture_sizes[0]
         else :
             print "!!!Warning : Cannot find any textures bound to the mesh!!!"
             print "!!!          TEXTURE_PACKs won't be exported           !!!"
 
-    def get_final_path_mesh(self):
-        return ( Blender.sys.join(self.dir_path,self.mesh_name + (".h" if (self.format) else ".bin")) )
-
-    def get_final_path_tex(self):
-        return ( Blender.sys.join(self.dir_path, "Texture_" + self.mesh_name + ".pcx") )
+    def get_texture_size(self,texture) :
+        #the size the texture is exported at
+        image , name , w , h = texture
+        ratio = float(w)/float(h)
+        print "Texture %s %dx%d ratio=%f" % (name,w,h,ratio)
 
-    def __str__(self):
-        return "File Format:%s , Exporting Texture:%s , Exporting Normals:%s , Exporting Colors:%s" % (self.format,self.uv_export,self.normals_export,self.color_export)
+        if (w > 128) : w = 128
+        if (w < 8) : w = 8
 
+        if (h > 128) : h = 128
+        if (h < 8) : h = 8
 
-class _nds_cmdpack_nop(object) :
-    __slots__ = 'cmd','val'
+        if (ratio < 1.0) :
+            w = h * (1/round(1/ratio))
+            print "ratio <  1 : Texture %s %dx%d" % (name,w,h)
+        else :
+            h = w / round(ratio)
+            print "ratio >= 1 :Texture %s %dx%d" % (name,w,h)
+
+        #the GX only draws textures of 8 to 1024 texels (powers of 2)
+        w = 8 << int(log(w / 8.0) / log(2) + 1e-6)
+        h = 8 << int(log(h / 8.0) / log(2) + 1e-6)
+
+        return ( ( int(w) , int(h) ) )
+
+    def get_texture_scale(self,texture) :
+        #(width , height , x , y) the UV of a texture_data entry are scaled
+        #to, the first texture being the one set in the GUI / atlas
+        if (texture == None or texture <= 0) :
+            return ( ( self.texture_w , self.texture_h , self.texture_x , self.texture_y ) )
+        return ( self.texture_sizes[texture] + ( 0 , 0 ) )
+
+    def get_chunk_polygons(self) :
+        #largest number of faces of a chunk : a chunk is never over the
+        #polygon budget
+        return ( max( min(self.chunk_polygons , self.polygon_budget) , 1 ) )
+
+    def __getstate__(self) :
+        return ( [ getattr(self , k) for k in self.__slots__ ] )
+
+    def __setstate__(self,state) :
+        for k , v in zip(self.__slots__ , state) : setattr(self , k , v)
+
+    def get_snapshot(self) :
+        #the same options, on a _mesh_snapshot of the mesh
+        options = _mesh_options.__new__(_mesh_options)
+        options.__setstate__(self.__getstate__())
+        options.mesh_data = _mesh_snapshot(self.mesh_data , self.texture_data , self.skeleton_export)
+        options.texture_data = options.mesh_data.texture
+        options.texture_list = []
+        return ( options )
+
+    def get_lod_options(self,level,source=None) :
+        #the same options, for a level of detail of the mesh drawn with the
+        #textures of the mesh
+        options = _mesh_options.__new__(_mesh_options)
+        options.__setstate__(self.__getstate__())
+        options.mesh_name = "%s_lod%d" % (self.mesh_name , level)
+        if (source != None) : options.mesh_data = source
+        options.texfile_export = 0
+        options.lod_levels = 1
+        return ( options )
+
+    def apply_settings(self,other) :
+        #a batch exports every mesh with the settings of the first one, but
+        #only turns off the attributes a mesh has
+        for k in ('format' , 'normals_export' , 'stream_export' , 'state_filter' , 'compact_vertices' , 'vertex_tolerance' , 'pack_schedule' , 'strips' , 'texture_format' , 'texture_quality' , 'split_budget' , 'polygon_budget' , 'vertex_budget' , 'chunk_polygons' , 'lod_levels' , 'rescale' , 'anim_tolerance') :
+            setattr(self , k , getattr(other , k))
+        if not (other.uv_export) : self.uv_export = EXPORT_OPTIONS['NO_TEXCOORDS']
+        if not (other.color_export) : self.color_export = EXPORT_OPTIONS['NO_COLORS']
+        if not (other.anim_export) : self.anim_export = EXPORT_OPTIONS['NO_ANIMATION']
+        if not (other.skeleton_export) : self.skeleton_export = EXPORT_OPTIONS['NO_SKELETON']
+        self.texfile_export = 1 if (other.texfile_export and self.uv_export and len(self.texture_data) > 0) else 0
 
-    def __init__(self):
-        self.cmd = {}
-        self.cmd[EXPORT_OPTIONS['FORMAT_TEXT']] = "FIFO_NOP"
-        self.cmd[EXPORT_OPTIONS['FORMAT_BINARY']] = pack( 'b' , FIFO_NOP )
+    def get_final_path_mesh(self):
+        return ( os.path.join(self.dir_path,self.mesh_name + (".h" if (self.format) else ".bin")) )
+
+    def get_texture_name(self,texture=0):
+        #the first texture is the one of the mesh, the others are numbered
+        if (texture == 0) : return ( "Texture_" + self.mesh_name )
+        return ( "Texture_%s_%d" % (self.mesh_name , texture) )
+
+    def get_final_path_tex(self,texture=0):
+        if (self.texture_format == EXPORT_OPTIONS['TEXTURE_PCX']) :
+            return ( os.path.join(self.dir_path, self.get_texture_name(texture) + ".pcx") )
+        return ( os.path.join(self.dir_path, self.get_texture_name(texture) + (".h" if (self.format) else ".tex")) )
+
+    def get_final_path_materials(self):
+        return ( os.path.join(self.dir_path,self.mesh_name + "_materials" + (".h" if (self.format) else ".bin")) )
+
+    def get_final_path_chunks(self):
+        return ( os.path.join(self.dir_path,self.mesh_name + "_chunks" + (".h" if (self.format) else ".bin")) )
+
+    def get_final_path_nodes(self):
+        return ( os.path.join(self.dir_path,self.mesh_name + "_nodes" + (".h" if (self.format) else ".bin")) )
+
+    def get_final_path_lods(self):
+        return ( os.path.join(self.dir_path,self.mesh_name + "_lods" + (".h" if (self.format) else ".bin")) )
+
+    def get_final_path_anim(self):
+        return ( os.path.join(self.dir_path,self.mesh_name + "_anim" + (".h" if (self.format) else ".bin")) )
+
+    def get_final_path_profile(self):
+        return ( os.path.join(self.dir_path , self.mesh_name + ".prof") )
+
+    def get_final_path_skeleton(self):
+        return ( os.path.join(self.dir_path,self.mesh_name + "_skeleton" + (".h" if (self.format) else ".bin")) )
+
+    def get_final_paths(self):
+        #every file an export of the mesh may write, the materials table is
+        #only written for the meshes drawn in several sub-lists, the chunks
+        #and nodes tables for the split meshes
+        paths = [ self.get_final_path_mesh() ]
+        if (self.texfile_export) : paths += [ self.get_final_path_tex(i) for i in range(len(self.texture_data)) ]
+        paths.append( self.get_final_path_materials() )
+        paths.append( self.get_final_path_chunks() )
+        paths.append( self.get_final_path_nodes() )
+        if (self.anim_export) : paths.append( self.get_final_path_anim() )
+        if (self.skeleton_export) : paths.append( self.get_final_path_skeleton() )
+        if (self.lod_levels > 1) :
+            for level in range(1 , self.lod_levels) :
+                paths += self.get_lod_options(level).get_final_paths()
+            paths.append( self.get_final_path_lods() )
+        return ( paths )
 
+    def __str__(self):
+        return "File Format:%s , Exporting Texture:%s , Exporting Normals:%s , Exporting Colors:%s , Streaming:%s , State filter:%s , Compact vertices:%s (tolerance %d) , Pack schedule:%s , Strips:%s , Texture format:%s , Split:%s (%d faces chunks) , LOD levels:%d , Rescale:%s , Animation:%s (tolerance %d) , Skeleton:%s" % (self.format,self.uv_export,self.normals_export,self.color_export,self.stream_export,self.state_filter,self.compact_vertices,self.vertex_tolerance,self.pack_schedule,self.strips,self.texture_format,self.split_budget,self.get_chunk_polygons(),self.lod_levels,self.rescale,self.anim_export,self.anim_tolerance,self.skeleton_export)
+
+
+# a _nds_mesh_corners gathers the attributes of the corners of a face list into
+# contiguous arrays, so the whole list is quantized and packed in a few array
+# operations instead of once per corner.
+# The corners are cached by (source vertex index, UV, color) : a vertex shared
+# by several faces with the same attributes is only stored, and so quantized
+# and packed, once. ids gives for each face corner its entry in the arrays.
+# scales optionally gives for each face the (width , height , x , y) of its
+# texture, when the faces are not all mapped on the texture of the mesh.
+class _nds_mesh_corners (object) :
+    __slots__ = 'ids' , 'indices' , 'vertices' , 'normals' , 'texcoords' , 'uv_valid' , 'colors' , 'nb_hits' , 'nb_misses'
+
+    def __init__(self,faces,source,options,scales=None) :
+        cache = {}
+        ids = []
+        index = []
+        uv = []
+        col = []
+        scale = []
+        for f , ( face_index , face_uv , face_col ) in enumerate(faces) :
+            #a mesh without UV / colors exports untextured / white corners
+            if (face_uv == None) : face_uv = [ (-1.0 , -1.0) ] * len(face_index)
+            if (face_col == None) : face_col = [ (255 , 255 , 255) ] * len(face_index)
+            for i, v in enumerate(face_index) :
+                key = ( v , )
+                if (options.uv_export) :
+                    key += tuple(face_uv[i])
+                if (options.color_export) :
+                    key += tuple(face_col[i])
+                if (scales != None) :
+                    key += ( scales[f] , )
+
+                if ( key in cache ) :
+                    ids.append( cache[key] )
+                    continue
+
+                cache[key] = len(index)
+                ids.append( len(index) )
+                index.append( v )
+                if (options.uv_export) :
+                    uv.append( key[1:3] )
+                    if (scales != None) : scale.append( scales[f] )
+                if (options.color_export) :
+                    col.append( tuple(face_col[i]) )
+
+        self.nb_misses = len(index)
+        self.nb_hits = len(ids) - len(index)
+
+        self.ids = array(ids , int32)
+        self.indices = array(index , int32)
+        co , no = source.get_vertices()
+        self.vertices = co[self.indices]
+        self.normals = no[self.indices]
+
+        uv = array(uv , float64).reshape(-1,2)
+        if (scales != None) :
+            w , h , x , y = array(scale , float64).reshape(-1,4).T
+        else :
+            w , h , x , y = options.get_texture_scale(0)
+        #UV coordinates are scaled to the texture size, V being flipped
+        self.texcoords = column_stack( (uv[:,0] * w + x , (1-uv[:,1]) * h + y) )
+        self.uv_valid = logical_and(uv[:,0] >= 0 , uv[:,1] >= 0)
+
+        #8 bits Blender colors down to 5 bits NDS colors
+        self.colors = array(col , int32).reshape(-1,3) * 32 / 256
+
+    def len(self) :
+        return ( len(self.vertices) )
+
+    def __str__(self) :
+        return "Vertex cache : %d corners, %d unique vertices (%d hits, %d misses, %.1f%% reused)" % (len(self.ids) , self.len() , self.nb_hits , self.nb_misses , 100.0 * self.nb_hits / max(len(self.ids) , 1))
+
+    def get_vertex_ids(self) :
+        #Corners of the same source vertex with the same packed UV and color
+        #are the same vertex for the hardware : they get the same id
+        keys = [ self.indices ]
+        if ( len(self.texcoords) > 0 ) :
+            keys += [ self.encode_texcoords() , self.uv_valid ]
+        if ( len(self.colors) > 0 ) :
+            keys.append( self.encode_colors() )
+        ids = {}
+        return ( array( [ ids.setdefault(key , len(ids)) for key in zip( *[ k.tolist() for k in keys ] ) ] , int32 ) )
+
+    def encode_vertices(self) :
+        v16 = floattov16_batch(self.vertices)
+        return ( column_stack( (VERTEX_PACK_BATCH(v16[:,0] , v16[:,1]) , VERTEX_PACK_BATCH(v16[:,2] , 0)) ) )
+
+    def encode_normals(self) :
+        v10 = floattov10_batch(self.normals)
+        return ( NORMAL_PACK_BATCH(v10[:,0] , v10[:,1] , v10[:,2]) )
+
+    def encode_texcoords(self) :
+        t16 = floattot16_batch(self.texcoords)
+        return ( TEXTURE_PACK_BATCH(t16[:,0] , t16[:,1]) )
+
+    def encode_colors(self) :
+        return ( RGB15_BATCH(self.colors[:,0] , self.colors[:,1] , self.colors[:,2]) )
+
+
+# a _nds_stripifier links the faces sharing an edge into GL_TRIANGLE_STRIP and
+# GL_QUAD_STRIP lists, so that the shared vertices are only sent once.
+# Two faces are only linked if the corners of their common edge are the same
+# hardware vertex (see _nds_mesh_corners.get_vertex_ids), and the strips keep
+# the winding of every face :
+#  - triangle i of a strip is (v[i],v[i+1],v[i+2]) if i is even, else (v[i+1],v[i],v[i+2])
+#  - quad i of a strip is (v[2i],v[2i+1],v[2i+3],v[2i+2])
+# The faces left alone go back to the independent GL_TRIANGLES / GL_QUADS lists.
+class _nds_stripifier (object) :
+    __slots__ = 'ids' , 'corner_cost' , 'nb_strips' , 'nb_triangles' , 'nb_vertices' , 'nb_bytes'
+
+    #bytes taken by a FIFO_BEGIN / FIFO_END pair
+    LIST_COST = 4 + 2
+
+    def __init__(self,ids,corner_cost):
+        self.ids = ids
+        self.corner_cost = corner_cost
+        self.nb_strips = { 3 : 0 , 4 : 0 }
+        self.nb_triangles = 0
+        #before / after stripification
+        self.nb_vertices = [ 0 , 0 ]
+        self.nb_bytes = [ 0 , 0 ]
+
+    def stripify(self,face_list,size):
+        #face_list holds the corners of the faces (size corners each), returns
+        #the strips (as corner lists) and the corners of the faces left alone
+        faces = face_list.reshape(-1,size)
+        face_ids = self.ids[faces].tolist()
+        nb_faces = len(faces)
+
+        #directed edge -> faces walking it, with the corners following the edge
+        edges = {}
+        for f, c in enumerate(face_ids) :
+            if ( len(set(c)) < size ) :
+                continue
+            for k in range(size) :
+                rest = [ c[(k+j) % size] for j in range(2,size) ]
+                edges.setdefault( ( c[k] , c[(k+1) % size] ) , [] ).append( ( f , rest ) )
+
+        #faces with few neighbours first, they would be left alone otherwise
+        nb_neighbours = [ 0 ] * nb_faces
+        for edge, walkers in edges.items() :
+            for f, rest in edges.get( ( edge[1] , edge[0] ) , () ) :
+                nb_neighbours[f] += len(walkers)
+        order = sorted( range(nb_faces) , key=lambda f : nb_neighbours[f] )
+
+        used = [ False ] * nb_faces
+        strips = []
+        alone = []
+        for f in order :
+            if ( used[f] ) :
+                continue
+            best = None
+            if ( len(set(face_ids[f])) == size ) :
+                for k in range(size) :
+                    strip = self.extend( face_ids[f][k:] + face_ids[f][:k] , f , size , edges , used )
+                    if ( best == None or len(strip[1]) > len(best[1]) ) :
+                        best = strip
+            if ( best == None or len(best[1]) < 2 ) :
+                used[f] = True
+                alone.append(f)
+                continue
+            for g in best[1] :
+                used[g] = True
+            strips.append( self.get_corners(best[0] , best[1] , faces , face_ids) )
+
+        alone = faces[array(alone , int32)].ravel() if len(alone) > 0 else zeros(0 , int32)
+        self.add_stats(face_list , strips , alone , size)
+        return ( strips , alone )
+
+    def extend(self,c,f,size,edges,used):
+        #Greedily grow a strip starting with the face f (corner ids c, rotated)
+        if ( size == 3 ) :
+            strip = list(c)
+        else :
+            strip = [ c[0] , c[1] , c[3] , c[2] ]
+        strip_faces = [ f ]
+        in_strip = set(strip_faces)
+        while ( True ) :
+            p , q = strip[-2] , strip[-1]
+            if ( size == 3 and len(strip_faces) % 2 == 1 ) :
+                p , q = q , p
+            found = None
+            for g, rest in edges.get( ( p , q ) , () ) :
+                if not ( used[g] or g in in_strip ) :
+                    found = ( g , rest )
+                    break
+            if ( found == None ) :
+                break
+            g , rest = found
+            if ( size == 3 ) :
+                strip.append( rest[0] )
+            else :
+                strip += [ rest[1] , rest[0] ]
+            strip_faces.append(g)
+            in_strip.add(g)
+        return ( strip , strip_faces )
+
+    def get_corners(self,strip,strip_faces,faces,face_ids):
+        #A corner for each strip vertex, taken from the faces of the strip :
+        #any corner of an id has the attributes of the strip vertex
+        corner = {}
+        for g in strip_faces :
+            for k, i in enumerate(face_ids[g]) :
+                corner[i] = faces[g][k]
+        return ( array( [ corner[i] for i in strip ] , int32 ) )
+
+    def add_stats(self,face_list,strips,alone,size):
+        nb_triangles = (len(face_list) / size) * (size - 2)
+        self.nb_triangles += nb_triangles
+        self.nb_strips[size] += len(strips)
+        self.nb_vertices[0] += len(face_list)
+        self.nb_bytes[0] += int(self.corner_cost[face_list].sum()) + self.LIST_COST
+        for l in strips + [ alone ] :
+            if ( len(l) > 0 ) :
+                self.nb_vertices[1] += len(l)
+                self.nb_bytes[1] += int(self.corner_cost[l].sum()) + self.LIST_COST
 
-        self.val = {}
-        self.val[EXPORT_OPTIONS['FORMAT_TEXT']] = None
-        self.val[EXPORT_OPTIONS['FORMAT_BINARY']] = None
+    def __str__(self):
+        nb = max(self.nb_triangles , 1)
+        return "Strips : %d triangle strips, %d quad strips, %.2f vertices and ~%.1f bytes per triangle (%.2f and ~%.1f without strips)" % (self.nb_strips[3] , self.nb_strips[4] , float(self.nb_vertices[1]) / nb , float(self.nb_bytes[1]) / nb , float(self.nb_vertices[0]) / nb , float(self.nb_bytes[0]) / nb)
+
+
+# A _nds_cmdpack_command is a view over one command of a _nds_cmdstream.
+# The stream only stores an opcode and an int argument per command (the
+# primitive type for FIFO_BEGIN, the corner index in the stream source for the
+# vertex attributes), the parameters are built in the requested format only
+# when they are asked for.
+# The words() and texts() class methods build the parameters of many commands
+# of the same opcode at once, they are what the serializer uses.
+# cycles is the geometry engine execution time of the command (from GBATEK).
+class _nds_cmdpack_command (object) :
+    __slots__ = 'stream' , 'arg'
+
+    opcode = FIFO_NOP
+    name = "FIFO_NOP"
+    nb_val = 0
+    cycles = 0
+
+    def __init__(self,stream=None,arg=-1):
+        self.stream = stream
+        self.arg = arg
 
     def get_cmd(self,format):
-        return ( self.cmd[format] )
+        if ( format == EXPORT_OPTIONS['FORMAT_TEXT'] ) :
+            return ( self.name )
+        return ( pack( 'b' , self.opcode ) )
 
     def get_val(self,format):
-        return ( self.val[format] )
+        if ( self.nb_val == 0 ) :
+            return ( None )
+        if ( format == EXPORT_OPTIONS['FORMAT_TEXT'] ) :
+            return ( self.texts(self.stream , [self.arg])[0] )
+        return ( pack( '<%di' % self.nb_val , *self.words(self.stream , [self.arg])[0] ) )
 
     def get_nb_val(self):
-        return ( 0 )
+        return ( self.nb_val )
+
+    @classmethod
+    def words(cls,stream,args):
+        return ( stream.get_words(cls.opcode)[asarray(args , int32)] )
+
+    @classmethod
+    def texts(cls,stream,args):
+        return ( [ None ] * len(args) )
 
     def __str__(self):
-        return ( "%s , %s" % ( self.cmd[EXPORT_OPTIONS['FORMAT_TEXT']], self.val[EXPORT_OPTIONS['FORMAT_TEXT']]) )
+        return ( "%s , %s" % ( self.get_cmd(EXPORT_OPTIONS['FORMAT_TEXT']), self.get_val(EXPORT_OPTIONS['FORMAT_TEXT'])) )
 
-class _nds_cmdpack_begin (object) :
-    __slots__ = 'cmd','val'
 
-    def __init__(self,begin_opt):
-        self.cmd = {}
-        self.cmd[EXPORT_OPTIONS['FORMAT_TEXT']] = "FIFO_BEGIN"
-        self.cmd[EXPORT_OPTIONS['FORMAT_BINARY']] = pack( 'b' , FIFO_BEGIN )
+class _nds_cmdpack_nop (_nds_cmdpack_command) :
+    __slots__ = ()
 
+    opcode = FIFO_NOP
+    name = "FIFO_NOP"
+    nb_val = 0
+    cycles = 0
 
-        self.val = {}
-        self.val[EXPORT_OPTIONS['FORMAT_TEXT']] = begin_opt
-        self.val[EXPORT_OPTIONS['FORMAT_BINARY']] = pack('<i' , GL_GLBEGIN_ENUM[begin_opt] )
 
+class _nds_cmdpack_begin (_nds_cmdpack_command) :
+    __slots__ = ()
 
-    def get_cmd(self,format):
-        return ( self.cmd[format] )
+    opcode = FIFO_BEGIN
+    name = "FIFO_BEGIN"
+    nb_val = 1
+    cycles = 1
 
-    def get_val(self,format):
-        return ( self.val[format] )
+    @classmethod
+    def words(cls,stream,args):
+        return ( asarray(args , int32).reshape(-1,1) )
 
-    def get_nb_val(self):
-        return ( 1 )
+    @classmethod
+    def texts(cls,stream,args):
+        return ( [ GL_GLBEGIN_NAMES[a] for a in args ] )
 
-    def __str__(self):
-        return ( "%s , %s" % ( self.cmd[EXPORT_OPTIONS['FORMAT_TEXT']], self.val[EXPORT_OPTIONS['FORMAT_TEXT']]) )
 
-class _nds_cmdpack_end(object) :
+class _nds_cmdpack_end (_nds_cmdpack_command) :
+    __slots__ = ()
 
-    __slots__ = 'cmd','val'
+    opcode = FIFO_END
+    name = "FIFO_END"
+    nb_val = 0
+    cycles = 1
 
-    def __init__(self):
-        self.cmd = {}
-        self.cmd[EXPORT_OPTIONS['FORMAT_TEXT']] = "FIFO_END"
-        self.cmd[EXPORT_OPTIONS['FORMAT_BINARY']] = pack( 'b' , FIFO_END )
 
+class _nds_cmdpack_vertex (_nds_cmdpack_command) :
+    __slots__ = ()
 
-        self.val = {}
-        self.val[EXPORT_OPTIONS['FORMAT_TEXT']] = None
-        self.val[EXPORT_OPTIONS['FORMAT_BINARY']] = None
+    opcode = FIFO_VERTEX16
+    name = "FIFO_VERTEX16"
+    nb_val = 2
+    cycles = 9
 
+    @classmethod
+    def texts(cls,stream,args):
+        fmt = "VERTEX_PACK(floattov16(%f),floattov16(%f)) , VERTEX_PACK(floattov16(%f),0)"
+        return ( [ fmt % tuple(v) for v in stream.source.vertices[asarray(args , int32)].tolist() ] )
 
-    def get_cmd(self,format):
-        return ( self.cmd[format] )
+    @staticmethod
+    def encode(source):
+        return ( source.encode_vertices() )
 
-    def get_val(self,format):
-        return ( self.val[format] )
 
-    def get_nb_val(self):
-        return ( 0 )
+class _nds_cmdpack_normal (_nds_cmdpack_command) :
+    __slots__ = ()
 
-    def __str__(self):
-        return ( "%s , %s" % ( self.cmd[EXPORT_OPTIONS['FORMAT_TEXT']], self.val[EXPORT_OPTIONS['FORMAT_TEXT']]) )
+    opcode = FIFO_NORMAL
+    name = "FIFO_NORMAL"
+    nb_val = 1
+    cycles = 9
 
+    @classmethod
+    def texts(cls,stream,args):
+        fmt = "NORMAL_PACK(floattov10(%3.6f),floattov10(%3.6f),floattov10(%3.6f))"
+        return ( [ fmt % tuple(n) for n in stream.source.normals[asarray(args , int32)].tolist() ] )
 
-class _nds_cmdpack_vertex (object) :
-    __slots__ = 'cmd','val'
+    @staticmethod
+    def encode(source):
+        return ( source.encode_normals().reshape(-1,1) )
 
-    def __init__(self,vertex=(0.0,0.0,0.0)):
-        x, y, z = vertex
-        self.cmd = {}
-        self.cmd[EXPORT_OPTIONS['FORMAT_TEXT']] = "FIFO_VERTEX16"
-        self.cmd[EXPORT_OPTIONS['FORMAT_BINARY']] = pack( 'b' , FIFO_VERTEX16 )
 
+class _nds_cmdpack_color (_nds_cmdpack_command) :
+    __slots__ = ()
 
-        self.val = {}
-        self.val[EXPORT_OPTIONS['FORMAT_TEXT']] = "VERTEX_PACK(floattov16(%f),floattov16(%f)) , VERTEX_PACK(floattov16(%f),0)" % (x,y,z)
-        self.val[EXPORT_OPTIONS['FORMAT_BINARY']] = pack('<ii' , VERTEX_PACK(floattov16(x) , floattov16(y)) , VERTEX_PACK(floattov16(z) , 0))
+    opcode = FIFO_COLOR
+    name = "FIFO_COLOR"
+    nb_val = 1
+    cycles = 1
 
+    @classmethod
+    def texts(cls,stream,args):
+        return ( [ "RGB15(%d,%d,%d)" % tuple(c) for c in stream.source.colors[asarray(args , int32)].tolist() ] )
 
-    def get_cmd(self, format):
-        return ( self.cmd[format] )
+    @staticmethod
+    def encode(source):
+        return ( source.encode_colors().reshape(-1,1) )
 
-    def get_val(self, format):
-        return ( self.val[format] )
 
-    def get_nb_val(self):
-        return ( 2 )
+class _nds_cmdpack_texture (_nds_cmdpack_command) :
+    __slots__ = ()
 
-    def __str__(self):
-        return ( "%s , %s" % ( self.cmd[EXPORT_OPTIONS['FORMAT_TEXT']], self.val[EXPORT_OPTIONS['FORMAT_TEXT']]) )
+    opcode = FIFO_TEX_COORD
+    name = "FIFO_TEX_COORD"
+    nb_val = 1
+    cycles = 1
 
+    @classmethod
+    def texts(cls,stream,args):
+        fmt = "TEXTURE_PACK(floattot16(%3.6f),floattot16(%3.6f))"
+        return ( [ fmt % tuple(t) for t in stream.source.texcoords[asarray(args , int32)].tolist() ] )
 
-class _nds_cmdpack_normal (object):
-    __slots__ = 'cmd','val'
+    @staticmethod
+    def encode(source):
+        return ( source.encode_texcoords().reshape(-1,1) )
 
-    def __init__(self,normal=(0.0,0.0,0.0)):
-        x, y, z = normal
-        self.cmd = {}
-        self.cmd[EXPORT_OPTIONS['FORMAT_TEXT']] = "FIFO_NORMAL"
-        self.cmd[EXPORT_OPTIONS['FORMAT_BINARY']] = pack( 'b' , FIFO_NORMAL )
 
+# The compact vertex commands take a single parameter word, computed by the
+# _nds_vertex_compactor pass and stored in the raw table of the stream.
+class _nds_cmdpack_raw (_nds_cmdpack_command) :
+    __slots__ = ()
 
-        self.val = {}
-        self.val[EXPORT_OPTIONS['FORMAT_TEXT']] =  "NORMAL_PACK(floattov10(%3.6f),floattov10(%3.6f),floattov10(%3.6f))" % (x,y,z)
-        self.val[EXPORT_OPTIONS['FORMAT_BINARY']] = pack('<i' , NORMAL_PACK(floattov10(x) , floattov10(y) , floattov10(z)))
+    nb_val = 1
 
+    @classmethod
+    def words(cls,stream,args):
+        return ( frombuffer(stream.raw , int32)[asarray(args , int32)].reshape(-1,1) )
 
-    def get_cmd(self, format):
-        return ( self.cmd[format] )
+    @classmethod
+    def texts(cls,stream,args):
+        return ( [ "0x%08X" % (w & 0xFFFFFFFF) for w in cls.words(stream,args)[:,0].tolist() ] )
 
-    def get_val(self, format):
-        return ( self.val[format] )
 
-    def get_nb_val(self):
-        return ( 1 )
+class _nds_cmdpack_vertex10 (_nds_cmdpack_raw) :
+    __slots__ = ()
 
-    def __str__(self):
-        return ( "%s , %s" % ( self.cmd[EXPORT_OPTIONS['FORMAT_TEXT']], self.val[EXPORT_OPTIONS['FORMAT_TEXT']]) )
+    opcode = FIFO_VERTEX10
+    name = "FIFO_VERTEX10"
+    nb_val = 1
+    cycles = 8
 
-class _nds_cmdpack_color (object):
-    __slots__ = 'cmd' , 'val'
 
-    def __init__(self,color=(0,0,0)):
-        r,g,b = color
-        self.cmd = {}
-        self.cmd[EXPORT_OPTIONS['FORMAT_TEXT']] = "FIFO_COLOR"
-        self.cmd[EXPORT_OPTIONS['FORMAT_BINARY']] = pack( 'b' , FIFO_COLOR )
+class _nds_cmdpack_vertex_xy (_nds_cmdpack_raw) :
+    __slots__ = ()
 
+    opcode = FIFO_VERTEX_XY
+    name = "FIFO_VERTEX_XY"
+    nb_val = 1
+    cycles = 8
 
-        self.val = {}
-        self.val[EXPORT_OPTIONS['FORMAT_TEXT']] =  "RGB15(%d,%d,%d)" % (r,g,b)
-        self.val[EXPORT_OPTIONS['FORMAT_BINARY']] = pack( '<i' , RGB15(r,g,b) )
 
+class _nds_cmdpack_vertex_xz (_nds_cmdpack_raw) :
+    __slots__ = ()
 
-    def get_cmd(self, format):
-        return ( self.cmd[format] )
+    opcode = FIFO_VERTEX_XZ
+    name = "FIFO_VERTEX_XZ"
+    nb_val = 1
+    cycles = 8
 
-    def get_val(self, format):
-        return ( self.val[format] )
 
-    def get_nb_val(self):
-        return ( 1 )
+class _nds_cmdpack_vertex_yz (_nds_cmdpack_raw) :
+    __slots__ = ()
 
-    def __str__(self):
-        return ( "%s , %s" % ( self.cmd[EXPORT_OPTIONS['FORMAT_TEXT']], self.val[EXPORT_OPTIONS['FORMAT_TEXT']]) )
+    opcode = FIFO_VERTEX_YZ
+    name = "FIFO_VERTEX_YZ"
+    nb_val = 1
+    cycles = 8
 
 
-class _nds_cmdpack_texture (object):
-    __slots__ = 'cmd' , 'val'
+class _nds_cmdpack_vertex_diff (_nds_cmdpack_raw) :
+    __slots__ = ()
 
-    def __init__(self,uv=(0.0,0.0)):
-        u,v = uv
-        self.cmd = {}
-        self.cmd[EXPORT_OPTIONS['FORMAT_TEXT']] = "FIFO_TEX_COORD"
-        self.cmd[EXPORT_OPTIONS['FORMAT_BINARY']] = pack( 'b' , FIFO_TEX_COORD )
+    opcode = FIFO_DIFF_VERTEX
+    name = "FIFO_DIFF_VERTEX"
+    nb_val = 1
+    cycles = 8
 
 
-        self.val = {}
-        self.val[EXPORT_OPTIONS['FORMAT_TEXT']] =  "TEXTURE_PACK(floattot16(%3.6f),floattot16(%3.6f))" % (u,v)
-        self.val[EXPORT_OPTIONS['FORMAT_BINARY']] = pack( '<i' , TEXTURE_PACK( floattot16(u) , floattot16(v) ) )
+# the argument of a FIFO_RESTORE is the position of the matrix in the stack
+class _nds_cmdpack_restore (_nds_cmdpack_command) :
+    __slots__ = ()
 
+    opcode = FIFO_RESTORE
+    name = "FIFO_RESTORE"
+    nb_val = 1
+    cycles = 36
 
-    def get_cmd(self, format):
-        return ( self.cmd[format] )
+    @classmethod
+    def words(cls,stream,args):
+        return ( asarray(args , int32).reshape(-1,1) )
 
-    def get_val(self, format):
-        return ( self.val[format] )
+    @classmethod
+    def texts(cls,stream,args):
+        return ( [ "%d" % (a) for a in args ] )
 
-    def get_nb_val(self):
-        return ( 1 )
+
+FIFO_COMMANDS = {
+    FIFO_NOP       : _nds_cmdpack_nop ,
+    FIFO_BEGIN     : _nds_cmdpack_begin ,
+    FIFO_END       : _nds_cmdpack_end ,
+    FIFO_VERTEX16  : _nds_cmdpack_vertex ,
+    FIFO_NORMAL    : _nds_cmdpack_normal ,
+    FIFO_COLOR     : _nds_cmdpack_color ,
+    FIFO_TEX_COORD : _nds_cmdpack_texture ,
+    FIFO_VERTEX10    : _nds_cmdpack_vertex10 ,
+    FIFO_VERTEX_XY   : _nds_cmdpack_vertex_xy ,
+    FIFO_VERTEX_XZ   : _nds_cmdpack_vertex_xz ,
+    FIFO_VERTEX_YZ   : _nds_cmdpack_vertex_yz ,
+    FIFO_DIFF_VERTEX : _nds_cmdpack_vertex_diff ,
+    FIFO_RESTORE     : _nds_cmdpack_restore
+}
+
+#Number of parameters and execution cycles of each opcode, indexed by opcode
+FIFO_NB_PARAMS = zeros(256 , int32)
+FIFO_CYCLES = zeros(256 , int32)
+for _opcode, _command in FIFO_COMMANDS.items() :
+    FIFO_NB_PARAMS[_opcode] = _command.nb_val
+    FIFO_CYCLES[_opcode] = _command.cycles
+
+
+# a _nds_cmdstream stores a whole command list in two parallel arrays : one
+# byte per opcode and one int per argument. Every 4 consecutive commands make
+# a FIFO_COMMAND_PACK. The attributes the arguments refer to stay in the
+# source (a _nds_mesh_corners) and are only packed when serializing.
+# The parameters computed by the optimization passes go in the raw table.
+class _nds_cmdstream (object) :
+    __slots__ = 'ops' , 'args' , 'source' , 'words' , 'raw' , 'nb_padding' , 'histogram'
+
+    def __init__(self,source=None):
+        self.ops = pyarray.array('B')
+        self.args = pyarray.array('i')
+        self.source = source
+        self.words = {}
+        self.raw = pyarray.array('i')
+        self.nb_padding = 0 #NOP commands added by terminate()
+        self.histogram = zeros(256 , int64) #opcodes of the discarded commands
+
+    def add(self,opcode,arg=-1):
+        self.ops.append(opcode)
+        self.args.append(arg)
+
+    def len(self):
+        return ( len(self.ops) )
+
+    def terminate(self):
+        #Fill the remaining slots of the last pack with NOP commands
+        if ( self.len() == 0 ) :
+            self.add(FIFO_NOP)
+            self.nb_padding += 1
+        while ( self.len() % 4 ) :
+            self.add(FIFO_NOP)
+            self.nb_padding += 1
+
+    def get_command(self,i):
+        return ( FIFO_COMMANDS[self.ops[i]](self,self.args[i]) )
+
+    def get_words(self,opcode):
+        #the parameters of an attribute are packed all at once, the first time they are needed
+        if not ( opcode in self.words ) :
+            self.words[opcode] = FIFO_COMMANDS[opcode].encode(self.source)
+        return ( self.words[opcode] )
+
+    def get_ops(self):
+        return ( frombuffer(self.ops , uint8) )
+
+    def get_args(self):
+        return ( frombuffer(self.args , int32) )
+
+    def compact(self,start,keep):
+        #Only keep the commands after start selected by the keep mask
+        self.ops[start:] = pyarray.array( 'B' , self.get_ops()[start:][keep].tostring() )
+        self.args[start:] = pyarray.array( 'i' , self.get_args()[start:][keep].tostring() )
+
+    def replace(self,start,positions,opcodes,args):
+        #Change the commands at the given positions (after start)
+        ops = self.get_ops()[start:].copy()
+        ops[positions] = opcodes
+        self.ops[start:] = pyarray.array( 'B' , ops.tostring() )
+        cmd_args = self.get_args()[start:].copy()
+        cmd_args[positions] = args
+        self.args[start:] = pyarray.array( 'i' , cmd_args.tostring() )
+
+    def add_raw(self,words):
+        #Store parameter words, returns the index of the first one
+        index = len(self.raw)
+        self.raw.extend( pyarray.array( 'i' , asarray(words).astype(int32).tostring() ) )
+        return ( index )
+
+    def discard(self,end):
+        #Forget the commands before end, once they have been written
+        self.histogram += _bincount(self.get_ops()[:end] , None , 256).astype(int64)
+        del self.ops[:end]
+        del self.args[:end]
+
+    def get_histogram(self):
+        #number of commands of each opcode, written or not
+        return ( self.histogram + _bincount(self.get_ops() , None , 256).astype(int64) )
+
+    def get_nb_params(self,end=None,start=0):
+        ops = self.get_ops()[start:end]
+        nb_packs = (len(ops) + 3) / 4
+        return ( nb_packs + int(FIFO_NB_PARAMS[ops].sum()) )
+
+    def get_layout(self,ops):
+        #(word offset of each pack header , word offset of the first parameter
+        #of each command , number of words) of complete packs
+        nb = FIFO_NB_PARAMS[ops].reshape(-1,4)
+        pack_size = 1 + nb.sum(1)
+        pack_start = cumsum(pack_size) - pack_size
+        cmd_start = (pack_start.reshape(-1,1) + 1 + cumsum(nb,1) - nb).ravel()
+        return ( ( pack_start , cmd_start , int(pack_size.sum()) ) )
+
+    def get_param_offsets(self,end=None,start=0):
+        #word offset (from the start command) of the first parameter of each
+        #command. It must only hold complete packs.
+        return ( self.get_layout(self.get_ops()[start:end])[1] )
+
+    def get_binary(self,end=None,start=0):
+        #The list (from the start to the end command) is written in one
+        #preallocated buffer of 32 bits words : each pack is its header word
+        #(4 opcodes bytes) followed by the parameters of its commands. It must
+        #only hold complete packs.
+        ops = self.get_ops()[start:end]
+        args = self.get_args()[start:end]
+        pack_start , cmd_start , nb_words = self.get_layout(ops)
+
+        words = zeros( nb_words , '<i4' )
+        words[pack_start] = ops.reshape(-1,4).copy().view('<i4').ravel()
+        for opcode in unique(ops) :
+            nb_val = FIFO_NB_PARAMS[opcode]
+            if ( nb_val == 0 ) :
+                continue
+            selected = nonzero(ops == opcode)[0]
+            val = FIFO_COMMANDS[opcode].words(self , args[selected])
+            for j in range(nb_val) :
+                words[cmd_start[selected] + j] = val[:,j]
+        return ( words.tostring() )
+
+    def get_text_items(self,end=None,start=0):
+        #One item per pack header and per command parameter, in list order,
+        #they only have to be joined by ",\n". It must only hold complete packs.
+        ops = self.get_ops()[start:end]
+        args = self.get_args()[start:end]
+
+        texts = [ None ] * len(ops)
+        for opcode in unique(ops) :
+            selected = nonzero(ops == opcode)[0]
+            for i, t in zip( selected.tolist() , FIFO_COMMANDS[opcode].texts(self , args[selected]) ) :
+                texts[i] = t
+
+        names = [ FIFO_COMMANDS[op].name for op in ops.tolist() ]
+        items = []
+        for i in range(0 , len(ops) , 4) :
+            items.append( "FIFO_COMMAND_PACK( %s , %s , %s , %s )" % tuple(names[i:i+4]) )
+            for t in texts[i:i+4] :
+                if ( t != None ) :
+                    items.append(t)
+        return ( items )
+
+
+# a _nds_cmdlist_writer writes the packs of a _nds_cmdstream to the final file
+# while the stream is being built, so that the list is never held in memory.
+# Only the list is streamed : the faces and corners of the mesh (see
+# _nds_mesh_corners) are still gathered in full before it is built, and take
+# most of the memory of a large mesh.
+# The parameters count is only known at the end : it is written as a
+# placeholder first, then patched in place.
+# A file may hold several lists one after the other (the sub-lists of a
+# multi-material mesh) : each one is started by start_list() and ended by
+# end_list(), and gets its own count.
+# When patches is a list, the word offset (in the file, in the array when
+# C-Style) of the parameters of every FIFO_VERTEX16 written is added to it,
+# with the command argument, for the vertex animation.
+class _nds_cmdlist_writer (object) :
+    __slots__ = 'file' , 'path' , 'format' , 'nb_params' , 'nb_bytes' , 'nb_words' , 'patches' , 'count_pos' , 'counts' , 'list_start' , 'start_time' , 'elapsed'
+
+    def __init__(self,path,format,name,header=""):
+        self.path = path
+        self.format = format
+        self.nb_params = 0
+        self.nb_bytes = 0
+        self.nb_words = 0
+        if ( self.format == EXPORT_OPTIONS['FORMAT_BINARY'] ) : self.nb_words = len(header) / 4
+        self.patches = None
+        self.count_pos = []
+        self.counts = []
+        self.list_start = 0
+        self.elapsed = 0.0
+        self.start_time = time.time()
+        self.file = open(path,"wb")
+
+        #the data before the lists (scale header)
+        self.write_data(header)
+        if ( self.format == EXPORT_OPTIONS['FORMAT_TEXT'] ) :
+            self.write_data( "u32 %s[] = {\n" % (name) )
+        self.write_count()
+
+    def write_count(self):
+        self.count_pos.append(self.nb_bytes)
+        self.nb_words += 1
+        if ( self.format == EXPORT_OPTIONS['FORMAT_TEXT'] ) :
+            #a fixed width placeholder, so that the real count fits in it
+            self.write_data( "%10d" % (0) )
+        else :
+            self.write_data( pack( '<i' , 0 ) )
+
+    def start_list(self):
+        #Start another list after the ended one
+        if ( self.format == EXPORT_OPTIONS['FORMAT_TEXT'] ) :
+            self.write_data( ",\n" )
+        self.write_count()
+
+    def end_list(self,stream):
+        #The stream must be terminated
+        self.write(stream)
+        self.counts.append(self.nb_params - self.list_start)
+        self.list_start = self.nb_params
+
+    def write_data(self,data):
+        self.file.write(data)
+        self.nb_bytes += len(data)
+
+    def write(self,stream):
+        #Write every complete pack of the stream and remove them from it
+        end = stream.len() - stream.len() % 4
+        if ( end == 0 ) :
+            return ( 0 )
+        if ( self.patches != None ) :
+            selected = nonzero(stream.get_ops()[:end] == FIFO_VERTEX16)[0]
+            self.patches.append( ( self.nb_words + stream.get_param_offsets(end)[selected] , stream.get_args()[selected].copy() ) )
+        self.nb_params += stream.get_nb_params(end)
+        self.nb_words += stream.get_nb_params(end)
+        if ( self.format == EXPORT_OPTIONS['FORMAT_TEXT'] ) :
+            self.write_data( "".join( [ ",\n" + i for i in stream.get_text_items(end) ] ) )
+        else :
+            self.write_data( stream.get_binary(end) )
+        stream.discard(end)
+        return ( end )
+
+    def close(self,stream):
+        #The stream must be terminated
+        if ( len(self.counts) < len(self.count_pos) ) :
+            self.end_list(stream)
+        if ( self.format == EXPORT_OPTIONS['FORMAT_TEXT'] ) :
+            self.write_data( "\n};\n" )
+        for pos , nb_params in zip(self.count_pos , self.counts) :
+            if ( self.format == EXPORT_OPTIONS['FORMAT_TEXT'] ) :
+                count = "%10d" % (nb_params)
+            else :
+                count = pack( '<i' , nb_params )
+            self.file.seek(pos)
+            self.file.write(count)
+        self.file.close()
+        self.elapsed = time.time() - self.start_time
+
+    def get_throughput(self):
+        #in MB/s
+        return ( self.nb_bytes / (1024.0 * 1024.0) / max(self.elapsed , 1e-6) )
 
     def __str__(self):
-        return ( "%s , %s" % ( self.cmd[EXPORT_OPTIONS['FORMAT_TEXT']], self.val[EXPORT_OPTIONS['FORMAT_TEXT']]) )
+        #the time covers building the list as well as writing it
+        return "Wrote %d bytes (%d parameters) into %s in %.3fs : %.2f MB/s" % (self.nb_bytes , self.nb_params , self.path , self.elapsed , self.get_throughput())
+
+
+# a _nds_cmdlist_reader parses the lists of an exported .bin file : each list is
+# its parameters count followed by FIFO_COMMAND_PACKs, the lists following each
+# other after the header words (the scale header of a rescaled mesh). It checks
+# that every opcode is known, that the packs hold exactly the counted
+# parameters (the parameters of each command being its get_nb_val()) and that
+# the primitives are well formed : the problems are gathered in errors.
+# A C-Style .h file is read as well : its items are parsed (the macros above
+# and the numbers), the scale header being its <mesh>_scale array.
+class _nds_cmdlist_reader (object) :
+    __slots__ = 'path' , 'words' , 'lists' , 'errors' , 'scale'
+
+    VERTEX_OPCODES = ( FIFO_VERTEX16 , FIFO_VERTEX10 , FIFO_VERTEX_XY , FIFO_VERTEX_XZ , FIFO_VERTEX_YZ , FIFO_DIFF_VERTEX )
+
+    def __init__(self,path,header=0):
+        self.path = path
+        self.lists = []
+        self.errors = []
+        self.scale = None
+        f = open(path , "rb")
+        data = f.read()
+        f.close()
+        if ( path.endswith(".h") ) :
+            self.words = self.parse_text(data)
+            header = 0
+        else :
+            if ( len(data) % 4 ) :
+                self.errors.append( "%d trailing bytes" % (len(data) % 4) )
+            self.words = frombuffer(data[:len(data) - len(data) % 4] , '<i4').astype(int64)
+            if ( header == 4 and len(self.words) >= 4 ) :
+                self.scale = ( int(self.words[0]) , tuple(self.words[1:4].tolist()) )
+        offset = header
+        headers = (self.words & 0xFFFFFFFF).tolist()
+        nb_vals = dict( [ ( opcode , command().get_nb_val() ) for opcode , command in FIFO_COMMANDS.items() ] )
+        while ( offset < len(self.words) ) :
+            offset = self.read_list(offset , headers , nb_vals)
+
+    #the macros of the C-Style files : (number of arguments , float arguments ?
+    #, function)
+    TEXT_MACROS = {
+        'FIFO_COMMAND_PACK' : ( 4 , False , lambda a , b , c , d : a | (b << 8) | (c << 16) | (d << 24) ) ,
+        'VERTEX_PACK' : ( 2 , False , lambda x , y : int(VERTEX_PACK(x , y)) ) ,
+        'NORMAL_PACK' : ( 3 , False , lambda x , y , z : int(NORMAL_PACK(x , y , z)) ) ,
+        'TEXTURE_PACK' : ( 2 , False , lambda u , v : int(TEXTURE_PACK(u , v)) ) ,
+        'RGB15' : ( 3 , False , lambda r , g , b : int(RGB15(r , g , b)) ) ,
+        'floattov16' : ( 1 , True , lambda n : int(floattov16(n)) ) ,
+        'floattov10' : ( 1 , True , lambda n : int(floattov10(n)) ) ,
+        'floattot16' : ( 1 , True , lambda n : int(floattot16(n)) )
+    }
+
+    #an integer, a float, a name, or a parenthesis / comma
+    TEXT_TOKENS = re.compile( r"\s*(?:(-?0[xX][0-9a-fA-F]+|-?[0-9]+(?![0-9.eE]))|(-?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?)|([A-Za-z_]\w*)|([(),]))" )
+
+    def parse_item(self,item,names):
+        #the value of an item, written with the integers, the names and the
+        #macros of the exporter only : anything else raises a ValueError
+        tokens = []
+        pos = 0
+        item = item.strip()
+        while ( pos < len(item) ) :
+            m = self.TEXT_TOKENS.match(item , pos)
+            if ( m == None ) : raise ValueError("unexpected \"%s\"" % item[pos:])
+            tokens.append( m.groups() )
+            pos = m.end()
+        tokens.append( ( None , None , None , None ) )
+
+        def parse(i , is_float) :
+            integer , real , name , punct = tokens[i]
+            if ( integer != None ) :
+                value = int(integer , 0)
+                if not ( -(1<<31) <= value < (1<<32) ) : raise ValueError("%s out of range" % integer)
+                return ( ( float(value) if (is_float) else value , i + 1 ) )
+            if ( real != None ) :
+                value = float(real)
+                if not ( is_float and abs(value) < (1<<15) ) : raise ValueError("unexpected %s" % real)
+                return ( ( value , i + 1 ) )
+            if ( name != None and name in names and not is_float ) :
+                return ( ( names[name] , i + 1 ) )
+            if ( name != None and name in self.TEXT_MACROS and not is_float and tokens[i + 1][3] == '(' ) :
+                nb_args , float_args , function = self.TEXT_MACROS[name]
+                args = []
+                i += 2
+                while ( True ) :
+                    value , i = parse(i , float_args)
+                    args.append(value)
+                    if ( tokens[i][3] == ')' ) : break
+                    if ( tokens[i][3] != ',' ) : raise ValueError("unexpected end of %s" % name)
+                    i += 1
+                if ( len(args) != nb_args ) : raise ValueError("%s of %d arguments" % (name , len(args)))
+                return ( ( function(*args) , i + 1 ) )
+            raise ValueError("unexpected %s" % (integer or real or name or punct or "end"))
+
+        value , i = parse(0 , False)
+        if ( tokens[i] != ( None , None , None , None ) ) : raise ValueError("unexpected %s after the value" % filter(None , tokens[i])[0])
+        return ( value )
+
+    def parse_text(self,data):
+        #the words of the u32 array of the file, (1 / scale , offset) from its
+        #s32 _scale array. The items are parsed, never evaluated.
+        names = {}
+        for opcode , command in FIFO_COMMANDS.items() :
+            names[command.name] = opcode
+        names.update(GL_GLBEGIN_ENUM)
+        values = {}
+        words = []
+        for kind , name , body in re.findall( r"(\w+)\s+(\w+)\[\]\s*=\s*\{(.*?)\};" , data , re.S ) :
+            #the items are split on the commas outside of the macros
+            items = []
+            depth = 0
+            start = 0
+            for m in re.finditer( r"[(),]" , body ) :
+                c = m.group()
+                if ( c == '(' ) : depth += 1
+                elif ( c == ')' ) : depth -= 1
+                elif ( depth == 0 ) :
+                    items.append( body[start:m.start()].strip() )
+                    start = m.end()
+            items.append( body[start:].strip() )
+            for item in items :
+                if not ( item in values ) :
+                    try:
+                        values[item] = int( self.parse_item(item , names) ) & 0xFFFFFFFF
+                    except (ValueError , OverflowError) , e :
+                        self.errors.append( "cannot read item \"%s\" of %s (%s)" % (item , name , e) )
+                        values[item] = 0
+            items = [ values[item] for item in items ]
+            if ( name.endswith("_scale") and len(items) == 4 ) :
+                items = [ i - (1<<32) if (i >= 0x80000000) else i for i in items ]
+                self.scale = ( items[0] , tuple(items[1:4]) )
+            else :
+                words += items
+        return ( array(words , int64) )
+
+    def read_list(self,offset,headers,nb_vals):
+        #(word offset , opcodes , word offset of the parameters of each
+        #command) of the list at offset, returns the offset after it
+        nb_params = int(self.words[offset])
+        end = offset + 1 + nb_params
+        if ( nb_params < 0 or end > len(self.words) ) :
+            self.errors.append( "list at word %d : %d parameters counted, %d words left" % (offset , nb_params , len(self.words) - offset - 1) )
+            end = len(self.words)
+        ops = []
+        starts = []
+        i = offset + 1
+        while ( i < end ) :
+            header = headers[i]
+            i += 1
+            for k in range(4) :
+                opcode = (header >> (8 * k)) & 0xFF
+                if not ( opcode in nb_vals ) :
+                    self.errors.append( "list at word %d : unknown opcode 0x%02X at word %d" % (offset , opcode , i - 1) )
+                    return ( end )
+                ops.append(opcode)
+                starts.append(i)
+                i += nb_vals[opcode]
+        if ( i != end ) :
+            self.errors.append( "list at word %d : %d parameters counted, the packs hold %d" % (offset , nb_params , i - offset - 1) )
+        self.lists.append( ( offset , array(ops , uint8) , array(starts , int64) ) )
+        return ( max(i , end) )
+
+    def get_primitives(self,index):
+        #(GL_GLBEGIN_ENUM , number of vertices) of each primitives list of a
+        #list, the malformed ones being added to errors
+        offset , ops , starts = self.lists[index]
+        primitives = []
+        mode = None
+        nb_vertices = 0
+        is_vertex = zeros(256 , bool)
+        is_vertex[list(self.VERTEX_OPCODES)] = True
+        #only the commands that start / end a primitive or draw a vertex matter
+        selected = nonzero( is_vertex[ops] | (ops == FIFO_BEGIN) | (ops == FIFO_END) )[0]
+        for i in selected.tolist() :
+            opcode = ops[i]
+            if ( opcode == FIFO_BEGIN or opcode == FIFO_END ) :
+                if ( mode != None ) :
+                    primitives.append( ( mode , nb_vertices ) )
+                mode = None
+                nb_vertices = 0
+                if ( opcode == FIFO_BEGIN ) :
+                    mode = int(self.words[starts[i]]) & 3
+            elif ( mode == None ) :
+                self.errors.append( "list at word %d : vertex outside of a primitive at word %d" % (offset , starts[i]) )
+            else :
+                nb_vertices += 1
+        if ( mode != None ) :
+            primitives.append( ( mode , nb_vertices ) )
+
+        for mode , nb in primitives :
+            valid = { 0 : nb % 3 == 0 , 1 : nb % 4 == 0 , 2 : nb >= 3 or nb == 0 , 3 : (nb >= 4 and nb % 2 == 0) or nb == 0 }[mode]
+            if not ( valid ) :
+                self.errors.append( "list at word %d : %s of %d vertices" % (offset , GL_GLBEGIN_NAMES[mode] , nb) )
+        return ( primitives )
+
+    def decode(self):
+        #run the lists as the geometry engine does, the attributes being sticky :
+        #(v16 position , v10 normal , t16 texture coordinates , 5 bits color) of
+        #each vertex drawn, None for an attribute not set yet, and the polygons
+        #(vertex indices, in the order they are drawn)
+        words = self.words.tolist()
+        vertices = []
+        polygons = []
+        normal = texcoord = color = None
+        pos = ( 0 , 0 , 0 )
+        s16 = lambda v : ((v + 0x8000) & 0xFFFF) - 0x8000
+        s10 = lambda v : ((v + 0x200) & 0x3FF) - 0x200
+        for offset , ops , starts in self.lists :
+            mode = None
+            strip = []
+            for opcode , i in zip(ops.tolist() , starts.tolist()) :
+                if ( opcode == FIFO_NOP or opcode == FIFO_RESTORE ) :
+                    continue
+                elif ( opcode == FIFO_BEGIN or opcode == FIFO_END ) :
+                    if ( mode != None ) : polygons += self.get_polygons(mode , strip)
+                    mode = None
+                    strip = []
+                    if ( opcode == FIFO_BEGIN ) : mode = words[i] & 3
+                    continue
+                w = words[i]
+                if ( opcode == FIFO_NORMAL ) :
+                    normal = ( s10(w) , s10(w >> 10) , s10(w >> 20) )
+                elif ( opcode == FIFO_TEX_COORD ) :
+                    texcoord = ( s16(w) , s16(w >> 16) )
+                elif ( opcode == FIFO_COLOR ) :
+                    color = ( w & 0x1F , (w >> 5) & 0x1F , (w >> 10) & 0x1F )
+                else :
+                    if ( opcode == FIFO_VERTEX16 ) : pos = ( s16(w) , s16(w >> 16) , s16(words[i + 1]) )
+                    elif ( opcode == FIFO_VERTEX10 ) : pos = ( s10(w) << 6 , s10(w >> 10) << 6 , s10(w >> 20) << 6 )
+                    elif ( opcode == FIFO_VERTEX_XY ) : pos = ( s16(w) , s16(w >> 16) , pos[2] )
+                    elif ( opcode == FIFO_VERTEX_XZ ) : pos = ( s16(w) , pos[1] , s16(w >> 16) )
+                    elif ( opcode == FIFO_VERTEX_YZ ) : pos = ( pos[0] , s16(w) , s16(w >> 16) )
+                    elif ( opcode == FIFO_DIFF_VERTEX ) : pos = ( s16(pos[0] + s10(w)) , s16(pos[1] + s10(w >> 10)) , s16(pos[2] + s10(w >> 20)) )
+                    strip.append( len(vertices) )
+                    vertices.append( ( pos , normal , texcoord , color ) )
+            if ( mode != None ) : polygons += self.get_polygons(mode , strip)
+        return ( ( vertices , polygons ) )
+
+    def get_polygons(self,mode,v):
+        #the polygons of a primitives list, strips keeping the winding of their
+        #first polygon
+        if ( mode == GL_GLBEGIN_ENUM['GL_TRIANGLES'] ) :
+            return ( [ v[i:i+3] for i in range(0 , len(v) - 2 , 3) ] )
+        if ( mode == GL_GLBEGIN_ENUM['GL_QUADS'] ) :
+            return ( [ v[i:i+4] for i in range(0 , len(v) - 3 , 4) ] )
+        if ( mode == GL_GLBEGIN_ENUM['GL_TRIANGLE_STRIP'] ) :
+            return ( [ ( [ v[i] , v[i+1] , v[i+2] ] if (i % 2 == 0) else [ v[i+1] , v[i] , v[i+2] ] ) for i in range(len(v) - 2) ] )
+        return ( [ [ v[i] , v[i+1] , v[i+3] , v[i+2] ] for i in range(0 , len(v) - 3 , 2) ] )
+
+
+# a _nds_cost_model estimates the time the geometry engine takes to run the
+# lists read by a _nds_cmdlist_reader : the execution cycles of each command
+# (FIFO_CYCLES), the cycles the engine waits for the parameters of a command to
+# arrive (the list is sent at one word every GX_FEED_CYCLES), and the cycles the
+# sender is stalled because the FIFO is full (GX_FIFO_SIZE entries, every word
+# counting as one). The FIFO being larger than any command, the stalls of the
+# sender never delay the engine : both are computed in closed form.
+class _nds_cost_model (object) :
+    __slots__ = 'feed_cycles' , 'fifo_size' , 'nb_words' , 'nb_commands' , 'cycles' , 'idle_cycles' , 'stall_cycles' , 'nb_opcodes'
+
+    def __init__(self,feed_cycles=GX_FEED_CYCLES,fifo_size=GX_FIFO_SIZE):
+        self.feed_cycles = feed_cycles
+        self.fifo_size = fifo_size
+        self.nb_words = 0
+        self.nb_commands = 0
+        self.cycles = 0
+        self.idle_cycles = 0
+        self.stall_cycles = 0
+        self.nb_opcodes = zeros(256 , int64)
+
+    def run(self,offset,ops,starts):
+        #a list (as read by _nds_cmdlist_reader), the engine being idle when it
+        #is called. Word 0 is its parameters count.
+        keep = nonzero(ops != FIFO_NOP)[0]
+        if ( len(keep) == 0 ) :
+            self.nb_words += 1 + len(ops) / 4
+            return
+        nb_words = int(starts[-1] + FIFO_NB_PARAMS[ops[-1]] - offset)
+        cycles = FIFO_CYCLES[ops[keep]].astype(int64)
+        #the time the last parameter (or the pack header) of each command is sent
+        last_word = maximum(starts[keep] + FIFO_NB_PARAMS[ops[keep]] - 1 , starts[keep] - 1) - offset
+        arrival = (last_word + 1) * self.feed_cycles
+        #a command ends after the previous one and after its parameters arrived
+        done = cumsum(cycles)
+        waited = maximum.accumulate( maximum(arrival - (done - cycles) , 0) )
+        end = done + waited
+        begin = end - cycles
+
+        #word w of the list is only accepted once the word GX_FIFO_SIZE before
+        #it left the FIFO, ie once its command began
+        owner = clip( searchsorted(starts[keep] - offset , arange(nb_words) , 'right') - 1 , 0 , len(keep) - 1 )
+        left = begin[owner]
+        stall = 0
+        if ( nb_words > self.fifo_size ) :
+            stall = max( int( (left[:-self.fifo_size] - (arange(self.fifo_size , nb_words) + 1) * self.feed_cycles).max() ) , 0 )
+
+        self.nb_words += nb_words
+        self.nb_commands += len(keep)
+        self.cycles += int(done[-1])
+        self.idle_cycles += int(waited[-1])
+        self.stall_cycles += stall
+        self.nb_opcodes += _bincount(ops[keep].astype(int64) , None , 256).astype(int64)
+
+    def get_total(self):
+        #cycles from the call of the lists to the end of their last command
+        return ( self.cycles + self.idle_cycles )
 
+    def __str__(self):
+        opcodes = " ".join( [ "%s=%d" % (FIFO_COMMANDS[op].name , self.nb_opcodes[op]) for op in nonzero(self.nb_opcodes)[0].tolist() ] )
+        return "%d words, %d commands (%s), %d geometry cycles (%.3f ms) : %d executing, %d waiting for the list, sender stalled %d cycles on a full FIFO" % (self.nb_words , self.nb_commands , opcodes , self.get_total() , 1000.0 * self.get_total() / GX_CLOCK , self.cycles , self.idle_cycles , self.stall_cycles)
+
+
+# a _nds_roundtrip reads back the list of an exported mesh and compares what the
+# geometry engine draws with the source mesh : the decoded polygons are matched
+# with the source faces by the quantized positions of their corners (or, for
+# the vertices the compactor moved, by the nearest face), and every attribute is
+# compared both with the source value (error, in the units of the mesh / UV
+# texels / 5 bits colors) and with the source value quantized by
+# floattov16 / floattov10 / floattot16 (the optimization passes must give it
+# back exactly, the positions within the vertex tolerance). The decoded mesh is
+# written to <mesh>_decoded.obj.
+class _nds_roundtrip (object) :
+    __slots__ = 'options' , 'nb_problems'
+
+    def __init__(self,options):
+        self.options = options
+        self.nb_problems = 0
+
+    def get_stats(self,error):
+        #max , rms of the error of each vertex
+        if ( len(error) == 0 ) :
+            return ( ( 0.0 , 0.0 ) )
+        return ( ( float(error.max()) , float(sqrt( (error ** 2).mean() )) ) )
+
+    def get_face_scales(self,face_materials):
+        #the texture scale of each face, as its corners were scaled to
+        options = self.options
+        textures = set( [ -1 if (options.materials[m][0] == None) else options.materials[m][0] for m in face_materials ] )
+        scales = []
+        for m in face_materials :
+            texture = options.materials[m][0]
+            if ( len(textures) <= 1 ) : texture = 0
+            scales.append( options.get_texture_scale(-1 if (texture == None) else texture) )
+        return ( scales )
+
+    def run(self):
+        options = self.options
+        header = 0
+        if (options.rescale and options.format == EXPORT_OPTIONS['FORMAT_BINARY']) : header = 4
+        reader = _nds_cmdlist_reader(options.get_final_path_mesh() , header)
+        vertices , polygons = reader.decode()
+        inverse , offset = reader.scale or ( 1<<12 , ( 0 , 0 , 0 ) )
+        offset = array(offset , float64) / (1<<12)
+        step = inverse / float(1<<24)
+
+        #the source faces, by the quantized positions of their corners
+        source = options.mesh_data
+        co , no = source.get_vertices()
+        quantized = floattov16_batch( (co - offset) / step / (1<<12) ).astype(int64)
+        keys = [ tuple(q) for q in quantized.tolist() ]
+        faces = []
+        face_materials = []
+        for face , material in zip(source.get_faces() , source.get_face_materials()) :
+            if (len(face[0]) == 4 or len(face[0]) == 3) :
+                faces.append(face)
+                face_materials.append( min(material , len(options.materials) - 1) )
+        by_key = {}
+        for f , face in enumerate(faces) :
+            key = [ keys[v] for v in face[0] ]
+            key.sort()
+            by_key.setdefault( tuple(key) , [] ).append(f)
+
+        #each decoded polygon takes a source face with the same corners, the
+        #others the nearest face left with as many corners
+        matches = [ None ] * len(polygons)
+        unmatched = []
+        for p , polygon in enumerate(polygons) :
+            key = [ vertices[i][0] for i in polygon ]
+            key.sort()
+            found = by_key.get( tuple(key) )
+            if ( found ) : matches[p] = found.pop(0)
+            else : unmatched.append(p)
+        left = [ f for found in by_key.values() for f in found ]
+        if ( len(unmatched) > 0 and len(left) > 0 ) :
+            left.sort()
+            centers = array( [ co[faces[f][0]].mean(0) for f in left ] , float64 ).reshape(-1,3)
+            sizes = array( [ len(faces[f][0]) for f in left ] , int32 )
+            for p in unmatched :
+                center = array( [ vertices[i][0] for i in polygons[p] ] , float64 ).mean(0) * step + offset
+                distance = ((centers - center) ** 2).sum(1)
+                distance[sizes != len(polygons[p])] = inf
+                best = int(argmin(distance))
+                if ( distance[best] == inf ) : continue
+                matches[p] = left[best]
+                centers[best] = inf
+        nb_extra = len( [ m for m in matches if m == None ] )
+        nb_missing = len(faces) - (len(polygons) - nb_extra)
+
+        #(decoded vertex , source face , corner) of every matched corner : a
+        #polygon keeps the winding of its face, its corners are paired with
+        #the rotation of the face corners nearest to them (corners at the same
+        #place, as at the poles of a sphere, stay apart)
+        pairs = []
+        for p , f in enumerate(matches) :
+            if ( f == None ) : continue
+            corners = quantized[faces[f][0]]
+            drawn = array( [ vertices[i][0] for i in polygons[p] ] , int64 ).reshape(-1,3)
+            rotations = (arange(len(corners)).reshape(1,-1) + arange(len(corners)).reshape(-1,1)) % len(corners)
+            r = int(argmin( abs(corners[rotations] - drawn).sum(2).sum(1) ))
+            pairs += [ ( i , f , int(rotations[r][j]) ) for j , i in enumerate(polygons[p]) ]
+
+        lines = [ "Round trip %s : %d polygons decoded, %d matched with the %d source faces, %d missing, %d extra" % (options.mesh_name , len(polygons) , len(polygons) - nb_extra , len(faces) , nb_missing , nb_extra) ]
+        self.nb_problems = nb_missing + nb_extra + len(reader.errors)
+
+        ids = array( [ faces[f][0][k] for i , f , k in pairs ] , int32 )
+        decoded = array( [ vertices[i][0] for i , f , k in pairs ] , int64 ).reshape(-1,3)
+        error = sqrt( (((decoded * step + offset) - co[ids]) ** 2).sum(1) )
+        moved = abs(decoded - quantized[ids]).max(1) if (len(ids) > 0) else zeros(0 , int64)
+        beyond = int( (moved > options.vertex_tolerance).sum() )
+        lines.append( "  positions : error max %f rms %f (v16 step %f), %d vertices off the quantized source, %d beyond the tolerance" % (self.get_stats(error) + ( step , int((moved > 0).sum()) , beyond )) )
+        self.nb_problems += beyond
+
+        if (options.normals_export) :
+            selected = [ n for n , ( i , f , k ) in enumerate(pairs) if vertices[i][1] != None ]
+            decoded = array( [ vertices[pairs[n][0]][1] for n in selected ] , int64 ).reshape(-1,3)
+            reference = no[ids[selected]]
+            error = sqrt( ((decoded / 512.0 - reference) ** 2).sum(1) )
+            off = int( (decoded != floattov10_batch(reference)).any(1).sum() )
+            lines.append( "  normals : error max %f rms %f (v10 step %f), %d off the quantized source" % (self.get_stats(error) + ( 1 / 512.0 , off )) )
+            self.nb_problems += off + len(pairs) - len(selected)
+
+        scales = self.get_face_scales(face_materials)
+        if (options.uv_export) :
+            selected = []
+            reference = []
+            for n , ( i , f , k ) in enumerate(pairs) :
+                uv = faces[f][1]
+                if ( uv == None or uv[k][0] < 0 or uv[k][1] < 0 ) : continue
+                w , h , x , y = scales[f]
+                selected.append(n)
+                reference.append( ( uv[k][0] * w + x , (1 - uv[k][1]) * h + y ) )
+            reference = array(reference , float64).reshape(-1,2)
+            missing = [ n for n in selected if vertices[pairs[n][0]][2] == None ]
+            decoded = array( [ vertices[pairs[n][0]][2] or ( 0 , 0 ) for n in selected ] , int64 ).reshape(-1,2)
+            error = sqrt( ((decoded / 16.0 - reference) ** 2).sum(1) )
+            off = int( (decoded != floattot16_batch(reference)).any(1).sum() )
+            lines.append( "  texcoords : error max %f rms %f texels (t16 step %f), %d off the quantized source" % (self.get_stats(error) + ( 1 / 16.0 , off )) )
+            self.nb_problems += off + len(missing)
+
+        if (options.color_export) :
+            selected = [ n for n , ( i , f , k ) in enumerate(pairs) if faces[f][2] != None ]
+            decoded = array( [ vertices[pairs[n][0]][3] or ( 0 , 0 , 0 ) for n in selected ] , int64 ).reshape(-1,3)
+            reference = array( [ faces[pairs[n][1]][2][pairs[n][2]] for n in selected ] , float64 ).reshape(-1,3)
+            error = abs(decoded - reference * 32 / 256).max(1) if (len(selected) > 0) else zeros(0)
+            off = int( (decoded != (reference.astype(int32) * 32 / 256)).any(1).sum() )
+            lines.append( "  colors : error max %f rms %f (5 bits), %d off the quantized source" % (self.get_stats(error) + ( off , )) )
+            self.nb_problems += off
+
+        for error in reader.errors :
+            lines.append( "!!!Error : %s!!!" % (error) )
+        if ( self.nb_problems == 0 ) :
+            lines.append( "  lossless : the list draws the quantized source mesh" )
+        else :
+            lines.append( "!!!Warning : %d differences with the quantized source mesh!!!" % (self.nb_problems) )
+        #the UV of a vertex are scaled back by the texture of the face its
+        #polygon was matched with (the first texture if none)
+        vertex_scales = [ options.get_texture_scale(0) ] * len(vertices)
+        for p , f in enumerate(matches) :
+            if ( f == None ) : continue
+            for i in polygons[p] : vertex_scales[i] = scales[f]
+        self.save_obj(vertices , polygons , step , offset , vertex_scales)
+        return ( "\n".join(lines) )
+
+    def save_obj(self,vertices,polygons,step,offset,scales):
+        #every decoded vertex gets its own position / UV / normal, the colors
+        #following the positions, the UV being scaled back by the texture
+        #scale of each vertex
+        options = self.options
+        lines = [ "# %s decoded from %s" % (options.mesh_name , options.get_final_path_mesh()) ]
+        for ( pos , normal , texcoord , color ) , ( w , h , x , y ) in zip(vertices , scales) :
+            p = array(pos , float64) * step + offset
+            if ( options.color_export ) :
+                color = color or ( 31 , 31 , 31 )
+                lines.append( "v %f %f %f %f %f %f" % ( p[0] , p[1] , p[2] , color[0] / 31.0 , color[1] / 31.0 , color[2] / 31.0 ) )
+            else :
+                lines.append( "v %f %f %f" % ( p[0] , p[1] , p[2] ) )
+            if ( options.uv_export ) :
+                s , t = texcoord or ( 0 , 0 )
+                lines.append( "vt %f %f" % ( (s / 16.0 - x) / max(w , 1) , 1 - (t / 16.0 - y) / max(h , 1) ) )
+            if ( options.normals_export ) :
+                n = normal or ( 0 , 0 , 0 )
+                lines.append( "vn %f %f %f" % ( n[0] / 512.0 , n[1] / 512.0 , n[2] / 512.0 ) )
+        for polygon in polygons :
+            if ( options.uv_export and options.normals_export ) : corner = "%d/%d/%d"
+            elif ( options.uv_export ) : corner = "%d/%d"
+            elif ( options.normals_export ) : corner = "%d//%d"
+            else : corner = "%d"
+            lines.append( "f " + " ".join( [ corner % ( (i + 1 , ) * corner.count("%d") ) for i in polygon ] ) )
+        f = open(os.path.join(options.dir_path , options.mesh_name + "_decoded.obj") , "w")
+        f.write( "\n".join(lines) + "\n" )
+        f.close()
+
+
+# a _nds_reference_list encodes a mesh the way the first exporter did : one
+# command at a time, each parameter packed with the scalar macros, and the
+# commands grouped by 4 in FIFO_COMMAND_PACKs, a GL_QUADS list then a
+# GL_TRIANGLES list. It knows none of the later passes (state filter, compact
+# vertices, strips, pack schedule, sub-lists, rescale), and is only kept to
+# check that the batch encoder and the serializer still give the same bytes
+# with those turned off (see --verify).
+class _nds_reference_list (object) :
+    __slots__ = 'options' , 'commands'
+
+    def __init__(self,options):
+        self.options = options
+        #( name , opcode , nb_val , text parameters , binary parameters ) of
+        #each command
+        self.commands = []
+        source = options.mesh_data
+        co , no = source.get_vertices()
+        faces = source.get_faces()
+        for size , begin_opt in ( ( 4 , 'GL_QUADS' ) , ( 3 , 'GL_TRIANGLES' ) ) :
+            selected = [ face for face in faces if (len(face[0]) == size) ]
+            if ( len(selected) == 0 ) : continue
+            self.add( "FIFO_BEGIN" , FIFO_BEGIN , 1 , begin_opt , pack('<i' , GL_GLBEGIN_ENUM[begin_opt]) )
+            for index , uv , col in selected :
+                for i , v in enumerate(index) :
+                    self.add_corner(co[v] , no[v] , uv[i] if (uv != None) else None , col[i] if (col != None) else None)
+            self.add( "FIFO_END" , FIFO_END )
+        #Fill the remaining cmd slots with NOP commands
+        while ( len(self.commands) == 0 or len(self.commands) % 4 != 0 ) :
+            self.add( "FIFO_NOP" , FIFO_NOP )
+
+    def add(self,name,opcode,nb_val=0,text=None,binary=None):
+        self.commands.append( ( name , opcode , nb_val , text , binary ) )
+
+    def add_corner(self,co,no,uv,col):
+        options = self.options
+        if ( options.color_export and col != None ) :
+            r , g , b = col[0] * 32 / 256 , col[1] * 32 / 256 , col[2] * 32 / 256
+            self.add( "FIFO_COLOR" , FIFO_COLOR , 1 , "RGB15(%d,%d,%d)" % (r,g,b) , pack('<i' , RGB15(r,g,b)) )
+        if ( options.uv_export and uv != None and uv[0] >= 0 and uv[1] >= 0 ) :
+            w , h , x , y = options.get_texture_scale(0)
+            u , v = uv[0] * w + x , (1-uv[1]) * h + y
+            self.add( "FIFO_TEX_COORD" , FIFO_TEX_COORD , 1 , "TEXTURE_PACK(floattot16(%3.6f),floattot16(%3.6f))" % (u,v) , pack('<i' , TEXTURE_PACK(floattot16(u) , floattot16(v))) )
+        if ( options.normals_export ) :
+            x , y , z = no
+            self.add( "FIFO_NORMAL" , FIFO_NORMAL , 1 , "NORMAL_PACK(floattov10(%3.6f),floattov10(%3.6f),floattov10(%3.6f))" % (x,y,z) , pack('<i' , NORMAL_PACK(floattov10(x) , floattov10(y) , floattov10(z))) )
+        x , y , z = co
+        self.add( "FIFO_VERTEX16" , FIFO_VERTEX16 , 2 , "VERTEX_PACK(floattov16(%f),floattov16(%f)) , VERTEX_PACK(floattov16(%f),0)" % (x,y,z) , pack('<ii' , VERTEX_PACK(floattov16(x) , floattov16(y)) , VERTEX_PACK(floattov16(z) , 0)) )
+
+    def get_nb_params(self):
+        #a word per pack, plus the parameters of its commands
+        return ( len(self.commands) / 4 + sum( [ c[2] for c in self.commands ] ) )
 
-class _nds_mesh_vertex (object):
-    __slots__ = 'vertex','uv','normal','color'
+    def get_bytes(self):
+        #the .bin or .h file of the mesh
+        packs = [ self.commands[i : i + 4] for i in range(0 , len(self.commands) , 4) ]
+        if (self.options.format == EXPORT_OPTIONS['FORMAT_TEXT']) :
+            s = [ "u32 %s[] = {\n%d,\n" % ( self.options.mesh_name , self.get_nb_params() ) ]
+            for p in packs :
+                s.append( "FIFO_COMMAND_PACK( %s , %s , %s , %s ),\n" % tuple( [ c[0] for c in p ] ) )
+                s += [ c[3] + ",\n" for c in p if (c[3] != None) ]
+            return ( "".join(s)[0:-2] + "\n};\n" )
+        s = [ pack( '<i' , self.get_nb_params() ) ]
+        for p in packs :
+            s += [ pack( 'b' , c[1] ) for c in p ]
+            s += [ c[4] for c in p if (c[4] != None) ]
+        return ( "".join(s) )
+
+
+# a _nds_state_filter drops the COLOR, TEX_COORD and NORMAL commands that send
+# again the value the geometry engine already holds : these attributes are
+# sticky and only consumed by the next vertices.
+# Values are compared once packed, ie as the hardware sees them. With lighting
+# enabled, NORMAL computes the vertex color, so a COLOR is only redundant if
+# no NORMAL came since the previous COLOR, and a NORMAL is only redundant if
+# no COLOR came since the previous NORMAL. Texture coordinates are assumed not
+# to be generated from the normals (TEXGEN normal source is never used by our
+# lists). A NORMAL after a FIFO_RESTORE is lit with another matrix, it is never
+# redundant. Nothing is known of the state when the list is called.
+# The filter can run several times on a growing stream (streaming export),
+# the last command seen for each attribute is carried between runs.
+class _nds_state_filter (object) :
+    __slots__ = 'last' , 'nb_removed'
+
+    #commands that change the state of an attribute, besides the attribute itself
+    INVALIDATORS = {
+        FIFO_COLOR     : ( FIFO_NORMAL , ) ,
+        FIFO_NORMAL    : ( FIFO_COLOR , FIFO_RESTORE ) ,
+        FIFO_TEX_COORD : ()
+    }
 
     def __init__(self):
-        self.vertex = None
-        self.uv = None
-        self.normal = None
-        self.color = None
+        self.last = {}
+        self.nb_removed = {}
+        for opcode in self.INVALIDATORS :
+            self.nb_removed[opcode] = 0
+        self.reset()
+
+    def reset(self):
+        #Forget the state, at the start of another list
+        for opcode in self.INVALIDATORS :
+            self.last[opcode] = ( None , None )
+
+    def run(self,stream,start=0):
+        #Filter the commands of the stream after start
+        ops = stream.get_ops()[start:]
+        args = stream.get_args()[start:]
+        keep = ones(len(ops) , bool)
+
+        for opcode, invalidators in self.INVALIDATORS.items() :
+            #the commands that set or invalidate this state, in list order
+            relevant = (ops == opcode)
+            for i in invalidators :
+                relevant |= (ops == i)
+            selected = nonzero(relevant)[0]
+            if ( len(selected) == 0 ) :
+                continue
+
+            sub_ops = ops[selected]
+            is_attr = (sub_ops == opcode)
+            values = zeros( len(selected) , int64 )
+            words = stream.get_words(opcode)[args[selected[is_attr]]]
+            values[is_attr] = words[:,0]
+
+            last_op, last_value = self.last[opcode]
+            prev_ops = concatenate( ( [ -1 if last_op == None else last_op ] , sub_ops[:-1] ) )
+            prev_values = concatenate( ( [ 0 if last_value == None else last_value ] , values[:-1] ) )
+
+            #a dropped command holds the same value as the state, so comparing
+            #with the previous command (dropped or not) gives the same answer
+            redundant = is_attr & (prev_ops == opcode) & (values == prev_values)
+            keep[selected[redundant]] = False
+            self.nb_removed[opcode] += int(redundant.sum())
+            self.last[opcode] = ( int(sub_ops[-1]) , int(values[-1]) )
+
+        stream.compact(start , keep)
+
+    def get_nb_removed(self):
+        return ( sum( self.nb_removed.values() ) )
+
+    def get_bytes_saved(self):
+        #each command costs its parameters words and its opcode byte in a pack header
+        return ( sum( [ nb * (4 * FIFO_NB_PARAMS[op] + 1) for op, nb in self.nb_removed.items() ] ) )
+
+    def get_cycles_saved(self):
+        return ( sum( [ nb * FIFO_CYCLES[op] for op, nb in self.nb_removed.items() ] ) )
 
     def __str__(self):
-        return "MESH_VERTEX(vertex=%s uv=%s normal=%s color=%s)" % (self.vertex , self.uv , self.normal , self.color)
+        return "State filter : removed %d commands (COLOR=%d, TEX_COORD=%d, NORMAL=%d), ~%d bytes and ~%d geometry cycles saved" % (self.get_nb_removed() , self.nb_removed[FIFO_COLOR] , self.nb_removed[FIFO_TEX_COORD] , self.nb_removed[FIFO_NORMAL] , self.get_bytes_saved() , self.get_cycles_saved())
+
+
+# a _nds_vertex_compactor replaces the FIFO_VERTEX16 commands (2 parameters)
+# by an equivalent 1 parameter command whenever it can :
+#  - FIFO_VERTEX10 when the vertex is on the 4.6 fixed point grid, or within
+#    tolerance (in 1/4096 units) of it, the vertex is then moved on the grid
+#  - FIFO_VERTEX_XY/XZ/YZ when the missing axis is the one of the previous vertex
+#  - FIFO_DIFF_VERTEX when the vertex is within 511/4096 of the previous one
+# The relative commands are always exact : they are computed from the position
+# the hardware really holds. The previous vertex is unknown when the list is
+# called, the first vertex is always absolute.
+class _nds_vertex_compactor (object) :
+    __slots__ = 'tolerance' , 'last' , 'nb_opcodes'
+
+    def __init__(self,tolerance=0):
+        self.tolerance = tolerance
+        self.last = None
+        self.nb_opcodes = {}
+        for opcode in ( FIFO_VERTEX16 , FIFO_VERTEX10 , FIFO_VERTEX_XY , FIFO_VERTEX_XZ , FIFO_VERTEX_YZ , FIFO_DIFF_VERTEX ) :
+            self.nb_opcodes[opcode] = 0
+
+    def reset(self):
+        #Forget the previous vertex, at the start of another list
+        self.last = None
+
+    def run(self,stream,start=0):
+        #Compact the vertices of the stream after start
+        ops = stream.get_ops()[start:]
+        args = stream.get_args()[start:]
+        selected = nonzero(ops == FIFO_VERTEX16)[0]
+        n = len(selected)
+        if ( n == 0 ) :
+            return
 
+        v16 = floattov16_batch(stream.source.vertices[args[selected]]).astype(int64)
 
-class _nds_cmdpack (object) :
-    __slots__ = 'commands'
+        #the vertices close enough to the 4.6 grid are moved on it
+        v10 = clip( (v16 + 32) >> 6 , -512 , 511 )
+        is_v10 = (abs( (v10 << 6) - v16 ) <= self.tolerance).all(1)
+        pos = where( is_v10.reshape(-1,1) , v10 << 6 , v16 )
+
+        #position held by the hardware before each vertex
+        has_prev = ones(n , bool)
+        if ( self.last == None ) :
+            has_prev[0] = False
+            prev = concatenate( ( zeros( (1,3) , int64 ) , pos[:-1] ) )
+        else :
+            prev = concatenate( ( array( [ self.last ] , int64 ) , pos[:-1] ) )
+        diff = pos - prev
+
+        is_xy = has_prev & (diff[:,2] == 0)
+        is_xz = has_prev & (diff[:,1] == 0)
+        is_yz = has_prev & (diff[:,0] == 0)
+        is_diff = has_prev & ( (diff >= -512) & (diff <= 511) ).all(1)
+
+        #from the lowest to the highest priority, the last match wins
+        opcodes = zeros(n , uint8) + FIFO_VERTEX16
+        words = zeros(n , int64)
+        for mask, opcode, word in (
+                ( is_diff , FIFO_DIFF_VERTEX , (diff[:,0] & 0x3FF) | ((diff[:,1] & 0x3FF) << 10) | ((diff[:,2] & 0x3FF) << 20) ) ,
+                ( is_yz , FIFO_VERTEX_YZ , (pos[:,1] & 0xFFFF) | (pos[:,2] << 16) ) ,
+                ( is_xz , FIFO_VERTEX_XZ , (pos[:,0] & 0xFFFF) | (pos[:,2] << 16) ) ,
+                ( is_xy , FIFO_VERTEX_XY , (pos[:,0] & 0xFFFF) | (pos[:,1] << 16) ) ,
+                ( is_v10 , FIFO_VERTEX10 , (v10[:,0] & 0x3FF) | ((v10[:,1] & 0x3FF) << 10) | ((v10[:,2] & 0x3FF) << 20) ) ) :
+            opcodes[mask] = opcode
+            words[mask] = word[mask]
+
+        for opcode in self.nb_opcodes :
+            self.nb_opcodes[opcode] += int( (opcodes == opcode).sum() )
+
+        compact = nonzero(opcodes != FIFO_VERTEX16)[0]
+        new_args = args[selected].copy()
+        new_args[compact] = stream.add_raw( words[compact].astype(int32) ) + arange(len(compact))
+        stream.replace(start , selected , opcodes , new_args)
+        self.last = pos[-1].tolist()
+
+    def get_nb_compacted(self):
+        return ( sum( self.nb_opcodes.values() ) - self.nb_opcodes[FIFO_VERTEX16] )
+
+    def get_bytes_saved(self):
+        return ( 4 * self.get_nb_compacted() )
+
+    def get_cycles_saved(self):
+        return ( (FIFO_CYCLES[FIFO_VERTEX16] - FIFO_CYCLES[FIFO_VERTEX10]) * self.get_nb_compacted() )
+
+    def __str__(self):
+        nb = self.nb_opcodes
+        return "Compact vertices : VERTEX16=%d VERTEX10=%d VERTEX_XY=%d VERTEX_XZ=%d VERTEX_YZ=%d DIFF_VERTEX=%d, %d bytes and ~%d geometry cycles saved" % (nb[FIFO_VERTEX16] , nb[FIFO_VERTEX10] , nb[FIFO_VERTEX_XY] , nb[FIFO_VERTEX_XZ] , nb[FIFO_VERTEX_YZ] , nb[FIFO_DIFF_VERTEX] , self.get_bytes_saved() , self.get_cycles_saved())
+
+
+# a _nds_pack_scheduler makes the lists end on a full FIFO_COMMAND_PACK. The
+# packs are filled with the commands in list order, over the primitives, so the
+# NOP padding is only at the end of a list : (-n) % 4 slots for n commands,
+# whatever their order. FIFO_END is a dummy command for the geometry engine (a
+# FIFO_BEGIN or the end of the list ends the primitive as well), so dropping
+# n % 4 of them (the last ones) saves the padded pack : its header word, its NOP
+# and the dropped FIFO_END commands. When streaming, only the commands not
+# written yet can be dropped.
+class _nds_pack_scheduler (object) :
+    __slots__ = 'nb_lists' , 'nb_dropped' , 'nb_packs_saved' , 'padding_before' , 'padding_after' , 'slots_before' , 'slots_after'
 
     def __init__(self):
-        self.commands = []
+        self.nb_lists = 0
+        self.nb_dropped = 0
+        self.nb_packs_saved = 0
+        self.padding_before = 0
+        self.padding_after = 0
+        self.slots_before = 0
+        self.slots_after = 0
+
+    def run(self,stream,start=0):
+        #Schedule the commands of a list, from start to its (unterminated) end
+        ops = stream.get_ops()[start:]
+        n = len(ops)
+        nb_padding = (-n) % 4
+        self.nb_lists += 1
+        self.padding_before += nb_padding
+        self.slots_before += n + nb_padding
+        if ( nb_padding > 0 ) :
+            ends = nonzero(ops == FIFO_END)[0]
+            if ( len(ends) >= 4 - nb_padding ) :
+                keep = ones(len(ops) , bool)
+                keep[ends[len(ends) - (4 - nb_padding):]] = False
+                stream.compact(start , keep)
+                self.nb_dropped += 4 - nb_padding
+                self.nb_packs_saved += 1
+                n -= 4 - nb_padding
+                nb_padding = 0
+        self.padding_after += nb_padding
+        self.slots_after += n + nb_padding
+
+    def get_bytes_saved(self):
+        #a pack header word per saved pack
+        return ( 4 * self.nb_packs_saved )
+
+    def get_cycles_saved(self):
+        return ( self.nb_dropped * FIFO_CYCLES[FIFO_END] + (self.padding_before - self.padding_after) * FIFO_CYCLES[FIFO_NOP] + self.nb_packs_saved * GX_FEED_CYCLES )
+
+    def get_padding_ratio(self,padding,slots):
+        return ( 100.0 * padding / max(slots , 1) )
 
-    def add(self, cmd):
-        if self.len() == 4:
-            return ( False )
-        else :
-            self.commands.append(cmd)
-            return ( True )
+    def __str__(self):
+        return "Pack schedule : %d lists, padding %.2f%% -> %.2f%% of the command slots (%d -> %d NOPs), %d FIFO_END dropped, %d bytes and ~%d cycles saved" % (self.nb_lists , self.get_padding_ratio(self.padding_before , self.slots_before) , self.get_padding_ratio(self.padding_after , self.slots_after) , self.padding_before , self.padding_after , self.nb_dropped , self.get_bytes_saved() , self.get_cycles_saved())
 
-    def terminate(self):
-        if (self.len() < 4):
-            for i in range(self.len(),4):
-                self.commands.append(_nds_cmdpack_nop())
+
+# a _nds_cmdpack is a view over the (up to) 4 commands of one FIFO_COMMAND_PACK
+class _nds_cmdpack (object) :
+    __slots__ = 'stream' , 'start'
+
+    def __init__(self,stream,start=0):
+        self.stream = stream
+        self.start = start
 
     def len(self):
-        return ( len(self.commands) )
+        return ( max( 0 , min( 4 , self.stream.len() - self.start ) ) )
+
+    def get_commands(self):
+        return ( [ self.stream.get_command(i) for i in range(self.start , self.start + self.len()) ] )
 
     def get_nb_param(self):
         if self.len() == 0:
@@ -413,83 +2617,903 @@ class _nds_cmdpack (object) :
         else :
             nb = 1
 
-        for i in self.commands:
+        for i in self.get_commands():
             nb += i.get_nb_val()
 
         return ( nb )
 
     def get_pack(self,format):
-        str = ""
-        str += self.get_cmd(format)
-        str += self.get_val(format)
-        return ( str )
+        return ( self.get_cmd(format) + self.get_val(format) )
 
     def get_cmd(self,format):
-        cmd = ""
-        c = self.commands
+        c = [ i.get_cmd(format) for i in self.get_commands() ]
         if ( format == EXPORT_OPTIONS['FORMAT_TEXT'] ) :
-            cmd += "FIFO_COMMAND_PACK( %s , %s , %s , %s ),\n" % ( c[0].get_cmd(format) ,c[1].get_cmd(format) ,c[2].get_cmd(format) ,c[3].get_cmd(format) )
-        elif ( format == EXPORT_OPTIONS['FORMAT_BINARY'] ) :
-            cmd += c[0].get_cmd(format) + c[1].get_cmd(format) + c[2].get_cmd(format) + c[3].get_cmd(format)
-        return cmd
+            return ( "FIFO_COMMAND_PACK( %s , %s , %s , %s ),\n" % tuple(c) )
+        return ( "".join(c) )
 
     def get_val(self,format):
-        val = ""
-        for i in self.commands:
-            if ( i.get_val(format) != None ):
-                val += i.get_val(format)
-                if ( format == EXPORT_OPTIONS['FORMAT_TEXT'] ) :
-                    val += ",\n"
-
-        return val
+        val = [ i.get_val(format) for i in self.get_commands() ]
+        val = [ v for v in val if v != None ]
+        if ( format == EXPORT_OPTIONS['FORMAT_TEXT'] ) :
+            return ( "".join( [ v + ",\n" for v in val ] ) )
+        return ( "".join(val) )
 
     def __str__(self):
-        str = "CMD_PACK ELEMENT:\n"
-        for i in self.commands:
-            str += "%s\n" % (i)
-        return ( str )
-
+        return ( "CMD_PACK ELEMENT:\n" + "".join( [ "%s\n" % (i) for i in self.get_commands() ] ) )
 
 
+# a _nds_cmdpack_list is a view over all the command packs of a stream
 class _nds_cmdpack_list (object):
-    __slots__ = 'list'
+    __slots__ = 'stream'
 
-    def __init__(self):
-        self.list = [ _nds_cmdpack() ]
+    def __init__(self,stream):
+        self.stream = stream
 
-    def add(self,cmd):
-        if ( self.list[-1].add(cmd) == False ):
-            self.list.append( _nds_cmdpack() )
-            self.list[-1].add(cmd)
+    def add(self,opcode,arg=-1):
+        self.stream.add(opcode,arg)
 
     def len(self):
-        return ( len(self.list) )
+        return ( max( 1 , (self.stream.len() + 3) / 4 ) )
 
-    def get_nb_params(self):
-        nb = 0
-        for i in self.list :
-            nb += i.get_nb_param()
+    def get_cmdpack(self,i):
+        return ( _nds_cmdpack(self.stream , 4 * i) )
 
-        return ( nb )
+    def get_nb_params(self):
+        return ( self.stream.get_nb_params() )
 
     def terminate(self):
-        self.list[-1].terminate()
+        self.stream.terminate()
 
     def get_pack(self,format):
-        str = ""
-        for cp in self.list:
-            str += cp.get_pack(format)
-        return ( str )
+        if ( format == EXPORT_OPTIONS['FORMAT_TEXT'] ) :
+            return ( "".join( [ i + ",\n" for i in self.stream.get_text_items() ] ) )
+        return ( self.stream.get_binary() )
+
+    def __str__(self):
+        return ( "COMMAND_PACK LIST\n" + "".join( [ "%s\n" % ( self.get_cmdpack(i) ) for i in range(self.len()) ] ) )
+
+
+def _bincount(x,weights,n) :
+    #bincount always n long
+    counts = zeros(n , float64)
+    if (len(x) > 0) :
+        c = bincount(x , weights)
+        counts[:len(c)] = c
+    return ( counts )
+
+# a _nds_texture is an image encoded in one of the GX texture formats : the
+# texels, the palette index data (GL_COMPRESSED only) and the palette, laid out
+# as the hardware reads them from the texture and palette VRAM.
+# pixels is a (height,width,4) RGBA array, width and height being powers of 2
+# from 8 to 1024. The colors are encoded in 15 bits, and decoded gives the
+# image as the hardware draws it, to measure the encoding error.
+#  - GL_RGB4 / GL_RGB16 / GL_RGB256 : 2 / 4 / 8 bits palette indices, color 0
+#    being transparent if the image has transparent pixels
+#  - GL_RGB32_A3 / GL_RGB8_A5 : 5 / 3 bits palette index and 3 / 5 bits alpha
+#  - GL_RGBA : a 15 bits color and 1 bit alpha per texel
+#  - GL_COMPRESSED : 4x4 blocks of 2 bits indices into a palette of their own
+#    (see encode_compressed)
+class _nds_texture (object) :
+    __slots__ = 'format' , 'width' , 'height' , 'transparent' , 'texels' , 'indices' , 'palette' , 'decoded'
+
+    #bits per texel of each format
+    BITS = { 1 : 8 , 2 : 2 , 3 : 4 , 4 : 8 , 5 : 2 , 6 : 8 , 7 : 16 }
+
+    #k-means iterations of the palettes
+    NB_ITERATIONS = 8
+
+    #a GL_COMPRESSED block uses 4 colors instead of 2 interpolated ones when it
+    #makes the error this much smaller
+    MODE_RATIO = 0.75
+
+    def __init__(self,pixels,format) :
+        self.format = format
+        self.height , self.width = pixels.shape[:2]
+        self.transparent = 0
+        self.indices = zeros(0 , uint16)
+        self.palette = zeros(0 , uint16)
+        if (format == GL_TEXTURE_TYPE_ENUM['GL_RGBA']) :
+            self.encode_direct(pixels)
+        elif (format == GL_TEXTURE_TYPE_ENUM['GL_COMPRESSED']) :
+            self.encode_compressed(pixels)
+        elif (format == GL_TEXTURE_TYPE_ENUM['GL_RGB32_A3']) :
+            self.encode_palette(pixels , 32 , 3)
+        elif (format == GL_TEXTURE_TYPE_ENUM['GL_RGB8_A5']) :
+            self.encode_palette(pixels , 8 , 5)
+        else :
+            self.encode_palette(pixels , 1 << self.BITS[format] , 0)
+
+    @staticmethod
+    def to_rgb5(c) :
+        return ( clip( ((asarray(c , float64) * 31 / 255) + .5).astype(int32) , 0 , 31 ) )
+
+    @staticmethod
+    def to_rgb8(c) :
+        #5 bits components back to 8 bits, as the hardware does
+        c = asarray(c , int32)
+        return ( (c << 3) | (c >> 2) )
+
+    @staticmethod
+    def pack_bits(values,bits) :
+        #texels of less than 8 bits, the first one in the lowest bits
+        values = asarray(values , uint32).reshape(-1 , 8 / bits)
+        packed = zeros(len(values) , uint32)
+        for i in range(8 / bits) :
+            packed = packed | (values[:,i] << uint32(i * bits))
+        return ( packed.astype(uint8) )
+
+    @staticmethod
+    def quantize(colors,weights,nb_colors) :
+        #weighted k-means of the colors (in 5 bits components) into a palette
+        if (len(colors) <= nb_colors) :
+            return ( colors.astype(int32) )
+        #initial palette : evenly spaced weighted quantiles along the luminance
+        order = argsort( (colors * array([3 , 6 , 1])).sum(1) )
+        cumul = cumsum(weights[order])
+        picks = searchsorted(cumul , (arange(nb_colors) + .5) * cumul[-1] / nb_colors)
+        centers = colors[order[minimum(picks , len(order) - 1)]].astype(float64)
+        points = colors.astype(float64)
+        for i in range(_nds_texture.NB_ITERATIONS) :
+            nearest = _nds_texture.nearest(points , centers)
+            count = _bincount(nearest , weights , nb_colors)
+            for c in range(3) :
+                total = _bincount(nearest , weights * points[:,c] , nb_colors)
+                centers[:,c] = where(count > 0 , total / maximum(count , 1e-9) , centers[:,c])
+        return ( clip( (centers + .5).astype(int32) , 0 , 31 ) )
+
+    @staticmethod
+    def nearest(points,palette) :
+        #index of the nearest palette color of each point
+        points = asarray(points , float64)
+        palette = asarray(palette , float64)
+        d = (palette * palette).sum(1)[newaxis,:] - 2 * dot(points , palette.T)
+        return ( d.argmin(1) )
+
+    def encode_palette(self,pixels,nb_colors,alpha_bits) :
+        rgb = self.to_rgb5(pixels[:,:,:3].reshape(-1,3))
+        alpha = pixels[:,:,3].reshape(-1).astype(int32)
+        opaque = alpha >= 128
+        first = 0
+        if (alpha_bits == 0 and not opaque.all()) :
+            #color 0 is the transparent one
+            self.transparent = 1
+            first = 1
+
+        keys = RGB15_BATCH(rgb[:,0] , rgb[:,1] , rgb[:,2])
+        weights = _bincount(keys , (opaque if (first) else ones(len(keys))).astype(float64) , 1 << 15)
+        used = nonzero(weights)[0]
+        colors = column_stack( (used & 31 , (used >> 5) & 31 , (used >> 10) & 31) )
+        palette = self.quantize(colors , weights[used] , nb_colors - first)
+        if (len(palette) == 0) : palette = zeros( (1 , 3) , int32 )
+        index = self.nearest(rgb , palette) + first
+
+        decoded = self.to_rgb8(palette)[index - first]
+        if (alpha_bits > 0) :
+            a = (alpha * ((1 << alpha_bits) - 1) + 127) / 255
+            self.texels = (index | (a << (8 - alpha_bits))).astype(uint8)
+            decoded_alpha = a * 255 / ((1 << alpha_bits) - 1)
+        else :
+            if (first) : index = where(opaque , index , 0)
+            self.texels = self.pack_bits(index , self.BITS[self.format]) if (self.BITS[self.format] < 8) else index.astype(uint8)
+            decoded_alpha = where(index > 0 , 255 , 0) if (first) else ones(len(index)) * 255
+
+        self.palette = RGB15_BATCH(palette[:,0] , palette[:,1] , palette[:,2]).astype(uint16)
+        if (first) : self.palette = concatenate( (zeros(1 , uint16) , self.palette) )
+        self.decoded = column_stack( (decoded , decoded_alpha) ).reshape(self.height , self.width , 4)
+
+    def encode_direct(self,pixels) :
+        rgb = self.to_rgb5(pixels[:,:,:3].reshape(-1,3))
+        opaque = pixels[:,:,3].reshape(-1) >= 128
+        self.texels = (RGB15_BATCH(rgb[:,0] , rgb[:,1] , rgb[:,2]) | (opaque.astype(int32) << 15)).astype(uint16)
+        self.decoded = column_stack( (self.to_rgb8(rgb) , opaque * 255) ).reshape(self.height , self.width , 4)
+
+    # GL_COMPRESSED : each 4x4 block is 32 bits of 2 bits texels (row by row,
+    # the first texel in the lowest bits) and 16 bits of palette index data :
+    # the offset of its colors in the palette (in 4 bytes units) and one of
+    #  - mode 0 : 3 colors and transparent
+    #  - mode 1 : 2 colors, their average and transparent
+    #  - mode 2 : 4 colors
+    #  - mode 3 : 2 colors, (5c0+3c1)/8 and (3c0+5c1)/8
+    # The blocks are encoded all at once : the 2 colors of the interpolated modes
+    # are the ends of the principal axis of the block, the 3 / 4 colors of the
+    # other modes a k-means of the block seeded along that axis. Each block
+    # then takes the mode with the smallest error.
+    def encode_compressed(self,pixels) :
+        h , w = self.height , self.width
+        blocks = pixels.reshape(h / 4 , 4 , w / 4 , 4 , 4).transpose(0 , 2 , 1 , 3 , 4).reshape(-1 , 16 , 4)
+        px = blocks[:,:,:3].astype(float64)
+        opaque = blocks[:,:,3] >= 128
+        nb = len(blocks)
+        weight = opaque.astype(float64)
+        nb_opaque = maximum(weight.sum(1) , 1)
+
+        #principal axis of the opaque pixels of each block
+        mean = (px * weight[:,:,newaxis]).sum(1) / nb_opaque[:,newaxis]
+        d = (px - mean[:,newaxis,:]) * weight[:,:,newaxis]
+        cov = (d[:,:,:,newaxis] * d[:,:,newaxis,:]).sum(1)
+        axis = ones( (nb , 3) , float64 )
+        for i in range(self.NB_ITERATIONS) :
+            axis = (cov * axis[:,newaxis,:]).sum(2) + 1e-6
+            axis /= sqrt( (axis * axis).sum(1) )[:,newaxis]
+        proj = ((px - mean[:,newaxis,:]) * axis[:,newaxis,:]).sum(2)
+        rows = arange(nb)
+        c0 = self.to_rgb5( px[rows , where(opaque , proj , inf).argmin(1)] )
+        c1 = self.to_rgb5( px[rows , where(opaque , proj , -inf).argmax(1)] )
+
+        #k-means seeds : the opaque pixels at evenly spaced ranks along the axis
+        order = argsort( where(opaque , proj , inf) , axis=1 )
+        def kmeans(k) :
+            ranks = ( (nb_opaque[:,newaxis] - 1) * arange(k)[newaxis,:] / max(k - 1 , 1) + .5 ).astype(int32)
+            centers = px[rows[:,newaxis] , order[rows[:,newaxis] , ranks]]
+            for i in range(self.NB_ITERATIONS) :
+                nearest = ((px[:,:,newaxis,:] - centers[:,newaxis,:,:]) ** 2).sum(3).argmin(2)
+                member = (nearest[:,:,newaxis] == arange(k)[newaxis,newaxis,:]) & opaque[:,:,newaxis]
+                count = member.sum(1)
+                total = (member[:,:,:,newaxis] * px[:,:,newaxis,:]).sum(1)
+                centers = where( (count > 0)[:,:,newaxis] , total / maximum(count , 1)[:,:,newaxis] , centers )
+            return ( self.to_rgb5(centers) )
+
+        #candidate palettes (in 5 bits components) of every mode
+        candidates = {}
+        candidates[3] = concatenate( (c0[:,newaxis] , c1[:,newaxis] , ((5 * c0 + 3 * c1) / 8)[:,newaxis] , ((3 * c0 + 5 * c1) / 8)[:,newaxis]) , 1 )
+        candidates[1] = concatenate( (c0[:,newaxis] , c1[:,newaxis] , ((c0 + c1) / 2)[:,newaxis] , zeros( (nb , 1 , 3) , int32 )) , 1 )
+        candidates[2] = kmeans(4)
+        candidates[0] = concatenate( (kmeans(3) , zeros( (nb , 1 , 3) , int32 )) , 1 )
+
+        transparent = ~opaque.all(1)
+        best_error = ones(nb) * inf
+        modes = zeros(nb , int32)
+        texel_index = zeros( (nb , 16) , int32 )
+        for mode in (3 , 2 , 1 , 0) :
+            colors = self.to_rgb8(candidates[mode]).astype(float64)
+            nb_colors = 4 if (mode >= 2) else 3
+            dist = ((px[:,:,newaxis,:] - colors[:,newaxis,:nb_colors,:]) ** 2).sum(3)
+            nearest = dist.argmin(2)
+            error = (dist.min(2) * weight).sum(1)
+            if (mode < 2) :
+                #the transparent pixels use color 3
+                nearest = where(opaque , nearest , 3)
+                allowed = transparent
+            else :
+                allowed = ~transparent
+            if (mode == 2) :
+                #4 colors take twice the palette space
+                better = allowed & (error < best_error * self.MODE_RATIO)
+            else :
+                better = allowed & (error < best_error)
+            best_error = where(better , error , best_error)
+            modes = where(better , mode , modes)
+            texel_index = where(better[:,newaxis] , nearest , texel_index)
+
+        #the palette : the colors of each block, identical ones shared
+        palette = []
+        offsets = {}
+        index_data = zeros(nb , uint16)
+        block_colors = zeros( (nb , 4 , 3) , int32 )
+        for mode in (0 , 1 , 2 , 3) :
+            block_colors[modes == mode] = candidates[mode][modes == mode]
+        packed = RGB15_BATCH(block_colors[:,:,0] , block_colors[:,:,1] , block_colors[:,:,2]).tolist()
+        for b in range(nb) :
+            mode = int(modes[b])
+            key = tuple(packed[b][:4 if (mode in (0 , 2)) else 2])
+            if not ( key in offsets ) :
+                offsets[key] = len(palette) / 2
+                palette += list(key)
+                if (offsets[key] > 0x3FFF) :
+                    raise ValueError("GL_COMPRESSED palette over 64KB")
+            index_data[b] = offsets[key] | (mode << 14)
+        self.palette = array(palette , uint16)
+        self.indices = index_data
+
+        words = zeros(nb , uint32)
+        for i in range(16) :
+            words = words | (texel_index[:,i].astype(uint32) << uint32(2 * i))
+        self.texels = words
+
+        #the hardware interpolates the 5 bits components
+        decoded = self.to_rgb8(block_colors)[rows[:,newaxis] , texel_index]
+        decoded_alpha = where( (texel_index == 3) & (modes < 2)[:,newaxis] , 0 , 255 )
+        decoded = concatenate( (decoded , decoded_alpha[:,:,newaxis]) , 2 )
+        self.decoded = decoded.reshape(h / 4 , w / 4 , 4 , 4 , 4).transpose(0 , 2 , 1 , 3 , 4).reshape(h , w , 4)
+
+    def get_psnr(self,pixels) :
+        #transparent pixels only count for their alpha
+        pixels = pixels.astype(float64)
+        decoded = self.decoded.astype(float64)
+        visible = (pixels[:,:,3] >= 128)[:,:,newaxis]
+        error = (((pixels - decoded) ** 2) * concatenate( (visible , visible , visible , ones(visible.shape)) , 2 )).mean()
+        if (error == 0) : return ( inf )
+        return ( 10 * log10(255.0 * 255.0 / error) )
+
+    def get_param(self) :
+        #TEXIMAGE_PARAM without the VRAM offset
+        size_s = [ 8 << i for i in range(8) ].index(self.width)
+        size_t = [ 8 << i for i in range(8) ].index(self.height)
+        return ( size_s << 20 | size_t << 23 | self.format << 26 | self.transparent << 29 )
+
+    def get_size(self) :
+        return ( self.texels.nbytes + self.indices.nbytes + self.palette.nbytes )
+
+    def get_binary(self) :
+        #a header of 4 words (TEXIMAGE_PARAM, texels, index data and palette
+        #sizes) then the texels, index data and palette
+        header = array( [ self.get_param() , self.texels.nbytes , self.indices.nbytes , self.palette.nbytes ] , '<u4' )
+        return ( header.tostring() + self.texels.astype('<u%d' % self.texels.itemsize).tostring() + self.indices.astype('<u2').tostring() + self.palette.astype('<u2').tostring() )
+
+    def get_text(self,name) :
+        text = "/* %s %dx%d */\n" % (GL_TEXTURE_TYPE_NAMES[self.format] , self.width , self.height)
+        text += "u32 %s_param = 0x%08X;\n" % (name , self.get_param())
+        for ctype , suffix , data , digits in (("u%d" % (self.texels.itemsize * 8) , "texels" , self.texels , self.texels.itemsize * 2) , ("u16" , "indices" , self.indices , 4) , ("u16" , "palette" , self.palette , 4)) :
+            if (len(data) == 0) : continue
+            items = [ "0x%0*X" % (digits , v) for v in data.tolist() ]
+            lines = [ ", ".join(items[i:i + 8]) for i in range(0 , len(items) , 8) ]
+            text += "%s %s_%s[] = {\n%s\n};\n" % (ctype , name , suffix , ",\n".join(lines))
+        return ( text )
+
+    def __str__(self) :
+        return "Texture %s %dx%d : %d bytes of texels, %d bytes of index data, %d bytes of palette" % (GL_TEXTURE_TYPE_NAMES[self.format] , self.width , self.height , self.texels.nbytes , self.indices.nbytes , self.palette.nbytes)
+
+
+def _nds_save_texture(img,w,h,options,path,name) :
+    #writes the PIL image img resized to w x h, in options.texture_format
+    import PIL.Image
+    if (options.texture_format == EXPORT_OPTIONS['TEXTURE_PCX']) :
+        img_rgb = img.convert("RGB")
+        img_pal = img_rgb.convert("P",palette=PIL.Image.ADAPTIVE)
+        img_res = img_pal.resize((w,h) )
+        img_res.save(path)
+        return
+
+    img_res = img.convert("RGBA").resize( (w , h) , PIL.Image.ANTIALIAS )
+    pixels = array(list(img_res.getdata()) , uint8).reshape(h , w , 4)
+    texture , psnr = _nds_texture_encode(pixels , options.texture_format , options.texture_quality)
+    print "%s , PSNR %.2f dB" % (texture , psnr)
+    f = open(path , "wb")
+    if (options.format) :
+        f.write(texture.get_text(name))
+    else :
+        f.write(texture.get_binary())
+    f.close()
+
+
+def _nds_texture_encode(pixels,format,quality) :
+    #encodes the pixels in format, or with TEXTURE_AUTO in every format and keeps
+    #the smallest one decoding with a PSNR of at least quality (dB), else the
+    #one with the best PSNR
+    if (format != EXPORT_OPTIONS['TEXTURE_AUTO']) :
+        texture = _nds_texture(pixels , format)
+        return ( texture , texture.get_psnr(pixels) )
+
+    best = None
+    smallest = None
+    for f in sorted(GL_TEXTURE_TYPE_NAMES.keys()) :
+        texture = _nds_texture(pixels , f)
+        psnr = texture.get_psnr(pixels)
+        print "  %s : %d bytes, PSNR %.2f dB" % (GL_TEXTURE_TYPE_NAMES[f] , texture.get_size() , psnr)
+        if (psnr >= quality and (smallest == None or texture.get_size() < smallest[0].get_size())) :
+            smallest = ( texture , psnr )
+        if (best == None or psnr > best[1]) :
+            best = ( texture , psnr )
+    return ( smallest or best )
+
+
+# a _nds_decimator simplifies the faces of a mesh by quadric edge collapses
+# (Garland & Heckbert) : the cheapest collapse is taken from a heap until the
+# mesh is down to the wanted number of faces. Each collapse moves a vertex onto
+# one of its neighbours (half-edge collapse), so the levels reuse the source
+# vertices and only their faces change.
+# The vertices on a UV seam or a color boundary (their corners do not all have
+# the same attributes), on a material boundary or on an open edge never move :
+# seams, boundaries and outlines are kept as they are. A collapse is refused
+# when it would fold a face over or make the mesh non manifold.
+# Quads are split into triangles. error is the largest distance (from the
+# quadrics) a vertex has moved away from the source surface.
+class _nds_decimator (object) :
+    __slots__ = 'co' , 'face_vertices' , 'face_keys' , 'face_materials' , 'alive' , 'attributes' , 'vertex_faces' , 'quadrics' , 'positions' , 'locked' , 'version' , 'heap' , 'nb_faces' , 'error'
+
+    def __init__(self,faces,materials,co):
+        self.co = co.tolist()
+        self.face_vertices = []
+        self.face_keys = []
+        self.face_materials = []
+        self.attributes = []
+        keys = {}
+        for ( face_index , face_uv , face_col ) , material in zip(faces , materials) :
+            corners = []
+            for i, v in enumerate(face_index) :
+                attribute = ( None if (face_uv == None) else tuple(face_uv[i]) , None if (face_col == None) else tuple(face_col[i]) )
+                if not ( attribute in keys ) :
+                    keys[attribute] = len(self.attributes)
+                    self.attributes.append(attribute)
+                corners.append( ( v , keys[attribute] ) )
+            for triangle in ( [ corners[0] , corners[1] , corners[2] ] , ) + ( ( [ corners[0] , corners[2] , corners[3] ] , ) if (len(corners) == 4) else () ) :
+                self.face_vertices.append( [ c[0] for c in triangle ] )
+                self.face_keys.append( [ c[1] for c in triangle ] )
+                self.face_materials.append(material)
+        self.nb_faces = len(self.face_vertices)
+        self.alive = [ True ] * self.nb_faces
+        self.error = 0.0
+
+        nb_vertices = len(self.co)
+        self.vertex_faces = [ set() for v in range(nb_vertices) ]
+        for f , vertices in enumerate(self.face_vertices) :
+            for v in vertices :
+                self.vertex_faces[v].add(f)
+
+        triangles = array(self.face_vertices , int32).reshape(-1,3)
+        self.quadrics = self.get_quadrics(triangles , co)
+        #(x,y,z,1)(x,y,z,1)^T of each vertex, the error of a quadric q at the
+        #vertex is (q * position).sum()
+        h = column_stack( (co , ones(nb_vertices)) )
+        self.positions = (h[:,:,newaxis] * h[:,newaxis,:]).reshape(-1,16)
+        self.locked = self.get_locked(triangles , nb_vertices)
+        self.version = [ 0 ] * nb_vertices
+
+        #every edge, both ways
+        edges = concatenate( ( triangles[:,[0,1]] , triangles[:,[1,2]] , triangles[:,[2,0]] ) )
+        edges = concatenate( ( edges , edges[:,::-1] ) )
+        self.heap = []
+        self.push(edges[:,0] , edges[:,1])
+
+    def get_quadrics(self,triangles,co):
+        #sum of the (unit) planes quadrics of the faces around each vertex
+        p0 , p1 , p2 = co[triangles[:,0]] , co[triangles[:,1]] , co[triangles[:,2]]
+        n = cross(p1 - p0 , p2 - p0)
+        length = sqrt( (n * n).sum(1) )
+        n = n / maximum(length , 1e-12).reshape(-1,1)
+        planes = column_stack( (n , -(n * p0).sum(1)) )
+        planes[length <= 1e-12] = 0
+        k = (planes[:,:,newaxis] * planes[:,newaxis,:]).reshape(-1,16)
+        quadrics = zeros( (len(co) , 16) , float64 )
+        for c in range(3) :
+            for j in range(16) :
+                quadrics[:,j] += _bincount(triangles[:,c] , k[:,j] , len(co))
+        return ( quadrics )
+
+    def get_locked(self,triangles,nb_vertices):
+        locked = zeros(nb_vertices , bool)
+        if ( len(triangles) == 0 ) :
+            return ( locked )
+        #corners with different attributes or materials
+        keys = array(self.face_keys , int32).ravel()
+        materials = repeat( array(self.face_materials , int32) , 3 )
+        for values in ( keys , materials ) :
+            n = int(values.max()) + 1
+            pairs = unique( triangles.ravel().astype(int64) * n + values )
+            counts = bincount( (pairs / n).astype(int32) )
+            locked[:len(counts)] |= counts > 1
+        #edges used by one face (open) or more than two (non manifold)
+        edges = concatenate( ( triangles[:,[0,1]] , triangles[:,[1,2]] , triangles[:,[2,0]] ) )
+        edges.sort(1)
+        codes = edges[:,0].astype(int64) * nb_vertices + edges[:,1]
+        codes.sort()
+        index = nonzero( concatenate( ( [ True ] , codes[1:] != codes[:-1] ) ) )[0]
+        counts = diff( concatenate( ( index , [ len(codes) ] ) ) )
+        bad = codes[index][counts != 2]
+        locked[ (bad / nb_vertices).astype(int32) ] = True
+        locked[ (bad % nb_vertices).astype(int32) ] = True
+        return ( locked )
+
+    def push(self,u,v):
+        #the collapses u -> v of the unlocked u, costed with the current quadrics
+        u = asarray(u , int32)
+        v = asarray(v , int32)
+        movable = logical_not(self.locked[u])
+        u , v = u[movable] , v[movable]
+        if ( len(u) == 0 ) :
+            return
+        costs = maximum( ((self.quadrics[u] + self.quadrics[v]) * self.positions[v]).sum(1) , 0 )
+        version = self.version
+        entries = [ ( cost , a , b , version[a] , version[b] ) for cost , a , b in zip(costs.tolist() , u.tolist() , v.tolist()) ]
+        if ( len(self.heap) == 0 ) :
+            self.heap.extend(entries)
+            heapq.heapify(self.heap)
+        else :
+            for entry in entries :
+                heapq.heappush(self.heap , entry)
+
+    def get_normal(self,a,b,c):
+        ax , ay , az = a
+        ux , uy , uz = b[0] - ax , b[1] - ay , b[2] - az
+        vx , vy , vz = c[0] - ax , c[1] - ay , c[2] - az
+        return ( ( uy * vz - uz * vy , uz * vx - ux * vz , ux * vy - uy * vx ) )
+
+    def collapse(self,u,v):
+        #moves u onto v, returns False if the collapse is refused
+        fv = self.face_vertices
+        faces_u = self.vertex_faces[u]
+        shared = [ f for f in faces_u if v in fv[f] ]
+        if ( len(shared) == 0 ) :
+            return ( False )
+
+        #the neighbours common to u and v must be the ones of the removed faces
+        opposite = set()
+        for f in shared :
+            opposite.update(fv[f])
+        neighbours_u = set()
+        for f in faces_u :
+            neighbours_u.update(fv[f])
+        neighbours_v = set()
+        for f in self.vertex_faces[v] :
+            neighbours_v.update(fv[f])
+        if ( (neighbours_u & neighbours_v) != opposite ) :
+            return ( False )
+
+        #the corners of u take the attributes of v, the same on all the removed faces
+        key = set( [ self.face_keys[f][fv[f].index(v)] for f in shared ] )
+        if ( len(key) != 1 ) :
+            return ( False )
+        key = key.pop()
+
+        #no face may be folded over or degenerated
+        co = self.co
+        moved = [ f for f in faces_u if not (v in fv[f]) ]
+        for f in moved :
+            before = self.get_normal( *[ co[w] for w in fv[f] ] )
+            after = self.get_normal( *[ co[v if w == u else w] for w in fv[f] ] )
+            dot = before[0] * after[0] + before[1] * after[1] + before[2] * after[2]
+            if ( dot <= 0 or after[0] * after[0] + after[1] * after[1] + after[2] * after[2] <= 1e-24 ) :
+                return ( False )
+
+        for f in moved :
+            i = fv[f].index(u)
+            fv[f][i] = v
+            self.face_keys[f][i] = key
+            self.vertex_faces[v].add(f)
+        for f in shared :
+            self.alive[f] = False
+            for w in fv[f] :
+                self.vertex_faces[w].discard(f)
+        self.vertex_faces[u] = set()
+        self.nb_faces -= len(shared)
+
+        self.quadrics[v] += self.quadrics[u]
+        self.version[v] += 1
+        others = list( (neighbours_u | neighbours_v) - set( [ u , v ] ) )
+        self.push( [ v ] * len(others) + others , others + [ v ] * len(others) )
+        return ( True )
+
+    def decimate(self,nb_faces):
+        #collapses until at most nb_faces faces are left, or nothing can be collapsed
+        heap = self.heap
+        version = self.version
+        while ( self.nb_faces > nb_faces and len(heap) > 0 ) :
+            cost , u , v , version_u , version_v = heapq.heappop(heap)
+            if ( version_u != version[u] or version_v != version[v] or len(self.vertex_faces[u]) == 0 ) :
+                continue
+            if ( self.collapse(u , v) ) :
+                self.error = max(self.error , sqrt(cost))
+
+    def get_faces(self):
+        #the faces left, and their materials
+        faces = []
+        materials = []
+        for f , alive in enumerate(self.alive) :
+            if not ( alive ) :
+                continue
+            attributes = [ self.attributes[k] for k in self.face_keys[f] ]
+            uv = None if (attributes[0][0] == None) else [ a[0] for a in attributes ]
+            col = None if (attributes[0][1] == None) else [ a[1] for a in attributes ]
+            faces.append( ( list(self.face_vertices[f]) , uv , col ) )
+            materials.append( self.face_materials[f] )
+        return ( ( faces , materials ) )
+
+
+# a _nds_budget counts the polygons and vertices the lists of a mesh make the
+# geometry engine store in polygon and vertex RAM : the counts are taken after
+# the strips, a strip of n vertices being n - 2 triangles or (n - 2) / 2 quads,
+# and the vertices of a strip being shared by its polygons. They are checked
+# against the budget of the mesh (by default, the whole frame).
+class _nds_budget (object) :
+    __slots__ = 'polygon_limit' , 'vertex_limit' , 'lists' , 'nb_polygons' , 'nb_vertices'
+
+    def __init__(self,polygon_limit=POLYGON_BUDGET,vertex_limit=VERTEX_BUDGET):
+        self.polygon_limit = polygon_limit
+        self.vertex_limit = vertex_limit
+        self.lists = []
+        self.nb_polygons = 0
+        self.nb_vertices = 0
+
+    def add(self,begin_opt,nb_vertices):
+        #a primitives list of nb_vertices vertices
+        mode = GL_GLBEGIN_ENUM[begin_opt]
+        if (mode == GL_GLBEGIN_ENUM['GL_TRIANGLES']) :
+            nb_polygons = nb_vertices / 3
+        elif (mode == GL_GLBEGIN_ENUM['GL_QUADS']) :
+            nb_polygons = nb_vertices / 4
+        elif (mode == GL_GLBEGIN_ENUM['GL_TRIANGLE_STRIP']) :
+            nb_polygons = max(nb_vertices - 2 , 0)
+        else :
+            nb_polygons = max(nb_vertices - 2 , 0) / 2
+        self.nb_polygons += nb_polygons
+        self.nb_vertices += nb_vertices
+
+    def end_list(self):
+        self.lists.append( ( self.nb_polygons , self.nb_vertices ) )
+        self.nb_polygons = 0
+        self.nb_vertices = 0
+
+    def get_total(self):
+        return ( ( sum( [ l[0] for l in self.lists ] ) , sum( [ l[1] for l in self.lists ] ) ) )
+
+    def is_over(self):
+        nb_polygons , nb_vertices = self.get_total()
+        return ( nb_polygons > self.polygon_limit or nb_vertices > self.vertex_limit )
 
     def __str__(self):
-        str = "COMMAND_PACK LIST\n"
-        for i in self.list :
-            str += "%s\n" % ( i )
-        return ( str )
+        nb_polygons , nb_vertices = self.get_total()
+        text = "Budget : %d polygons (%.1f%% of %d), %d vertices (%.1f%% of %d) in %d lists" % (nb_polygons , 100.0 * nb_polygons / max(self.polygon_limit , 1) , self.polygon_limit , nb_vertices , 100.0 * nb_vertices / max(self.vertex_limit , 1) , self.vertex_limit , len(self.lists))
+        if (len(self.lists) > 1) :
+            text += "".join( [ "\n  list %d : %d polygons, %d vertices" % (i , l[0] , l[1]) for i , l in enumerate(self.lists) ] )
+        if (nb_polygons > self.polygon_limit) :
+            text += "\n!!!Warning : %d polygons over the polygon budget!!!" % (nb_polygons - self.polygon_limit)
+        if (nb_vertices > self.vertex_limit) :
+            text += "\n!!!Warning : %d vertices over the vertex budget!!!" % (nb_vertices - self.vertex_limit)
+        return ( text )
+
+
+# a _nds_vertex_animation stores the frames of an animated mesh as keyframe
+# deltas, for the runtime to move the vertices of its (uncompacted) list : the
+# FIFO_VERTEX16 parameters of each vertex (slot) are patched in place.
+# The frames between two keyframes are interpolated linearly, the keyframes
+# being chosen so that no vertex of an interpolated frame is more than
+# tolerance (in 1/4096 units, on each axis) from the exported one. The first
+# keyframe is frame 0, ie the positions in the list. Each next keyframe only
+# holds the slots that moved since the previous one : the delta of the slots
+# that moved less than 512/4096 is packed in one word (as a FIFO_DIFF_VERTEX),
+# the other slots get their 2 words FIFO_VERTEX16 parameters.
+class _nds_vertex_animation (object) :
+    __slots__ = 'frames' , 'tolerance' , 'keyframes' , 'error'
+
+    def __init__(self,frames,tolerance=ANIM_TOLERANCE):
+        #frames : (nb_frames , nb_slots , 3) v16 positions
+        self.frames = asarray(frames , int64)
+        self.tolerance = tolerance
+        self.error = 0
+        if ( self.frames.shape[1] > 0xFFFF ) :
+            raise ValueError("%d animated vertices, only %d can be indexed" % (self.frames.shape[1] , 0xFFFF))
+        self.keyframes = self.select_keyframes()
+
+    def get_error(self,a,b):
+        #largest distance between the frames after a and before b and their
+        #interpolation between the keyframes a and b
+        if ( b - a < 2 ) :
+            return ( 0 )
+        t = (arange(a + 1 , b) - a).reshape(-1,1,1) / float(b - a)
+        interpolated = self.frames[a] + t * (self.frames[b] - self.frames[a])
+        return ( abs(interpolated - self.frames[a+1:b]).max() )
+
+    def select_keyframes(self):
+        #each keyframe reaches as far as its interpolation stays within
+        #tolerance, the last frame always being a keyframe
+        keyframes = [ 0 ]
+        nb_frames = len(self.frames)
+        while ( keyframes[-1] < nb_frames - 1 ) :
+            a = keyframes[-1]
+            b = a + 1
+            while ( b + 1 < nb_frames and self.get_error(a , b + 1) <= self.tolerance ) :
+                b += 1
+            self.error = max(self.error , self.get_error(a , b))
+            keyframes.append(b)
+        return ( keyframes )
+
+    def pack_u16(self,values):
+        #2 values per word, the first one in the low half
+        values = asarray(values , int64)
+        if ( len(values) % 2 ) :
+            values = concatenate( ( values , [ 0 ] ) )
+        return ( (values[0::2] & 0xFFFF) | (values[1::2] << 16) )
+
+    def get_words(self,patch_offsets,patch_slots):
+        #the number of frames, keyframes, slots and patches, the word offset
+        #of each patch in the list and its slot, then each keyframe : its
+        #frame, number of small and large deltas, the slots and packed deltas
+        #of the small ones, the slots and positions of the large ones
+        words = [ array( [ len(self.frames) , len(self.keyframes) , self.frames.shape[1] , len(patch_offsets) ] , int64 ) ,
+                  asarray(patch_offsets , int64) ,
+                  self.pack_u16(patch_slots) ]
+        for k , frame in enumerate(self.keyframes) :
+            if ( k == 0 ) :
+                words.append( array( [ frame , 0 , 0 ] , int64 ) )
+                continue
+            pos = self.frames[frame]
+            delta = pos - self.frames[self.keyframes[k - 1]]
+            moved = (delta != 0).any(1)
+            is_small = moved & ( (delta >= -512) & (delta <= 511) ).all(1)
+            small = nonzero(is_small)[0]
+            large = nonzero(moved & ~is_small)[0]
+            d = delta[small]
+            words += [ array( [ frame , len(small) , len(large) ] , int64 ) ,
+                       self.pack_u16(small) ,
+                       (d[:,0] & 0x3FF) | ((d[:,1] & 0x3FF) << 10) | ((d[:,2] & 0x3FF) << 20) ,
+                       self.pack_u16(large) ,
+                       column_stack( (VERTEX_PACK_BATCH(pos[large,0] , pos[large,1]) , VERTEX_PACK_BATCH(pos[large,2] , 0)) ).ravel() ]
+        return ( concatenate( [ asarray(w , int64).ravel() for w in words ] ) & 0xFFFFFFFF )
+
+    def get_report(self,nb_bytes,list_bytes):
+        #nb_bytes against a list per frame, or the positions of every frame
+        nb_frames , nb_slots = self.frames.shape[:2]
+        return ( "Animation : %d frames, %d keyframes, %d vertices, %d bytes (%.1f%% of a list per frame, %.1f%% of the positions of every frame), error max %.1f/4096" % (nb_frames , len(self.keyframes) , nb_slots , nb_bytes , 100.0 * nb_bytes / max(nb_frames * list_bytes , 1) , 100.0 * nb_bytes / max(nb_frames * nb_slots * 8 , 1) , self.error) )
+
+
+# a _nds_skeleton stores the bone tracks of a skinned mesh : the geometry engine
+# moves the vertices itself, the list restoring the matrix of their bone from
+# the position matrix stack (bone i being stored in position i + 1) before
+# them. Each track is the keyframes of the skinning matrix of a bone, as a
+# rotation quaternion (4.12 fixed point) and a translation (20.12 fixed point),
+# 6 words per keyframe whatever the number of vertices. The frames between two
+# keyframes are interpolated (normalized linear interpolation of the
+# quaternions, linear of the translations), the keyframes being chosen so that
+# no vertex of the bone is more than tolerance (in 1/4096 units of the list) from
+# where the skinning matrix of the frame puts it.
+class _nds_skeleton (object) :
+    __slots__ = 'frames' , 'vertices' , 'tolerance' , 'unit' , 'quaternions' , 'translations' , 'tracks' , 'error'
+
+    def __init__(self,frames,vertices,tolerance=ANIM_TOLERANCE,unit=1<<12):
+        #frames : (nb_frames , nb_bones , 3 , 4) skinning matrices
+        #vertices : the rest positions of the vertices of each bone
+        #unit : the size of a list unit in 1/4096 units of the mesh
+        self.frames = asarray(frames , float64)
+        self.vertices = vertices
+        self.tolerance = tolerance
+        self.unit = unit
+        self.error = 0.0
+        self.quaternions , self.translations = self.quantize()
+        self.tracks = [ self.select_keyframes(bone) for bone in range(self.frames.shape[1]) ]
+
+    def get_quaternion(self,matrix):
+        #the rotation of a skinning matrix, its scale being dropped
+        u , sv , vt = linalg.svd(matrix[:,:3])
+        r = dot(u , vt)
+        trace = r[0,0] + r[1,1] + r[2,2]
+        if ( trace > 0 ) :
+            w = sqrt(trace + 1.0) * 2
+            q = ( (r[2,1] - r[1,2]) / w , (r[0,2] - r[2,0]) / w , (r[1,0] - r[0,1]) / w , w / 4 )
+        elif ( r[0,0] > r[1,1] and r[0,0] > r[2,2] ) :
+            w = sqrt(1.0 + r[0,0] - r[1,1] - r[2,2]) * 2
+            q = ( w / 4 , (r[0,1] + r[1,0]) / w , (r[0,2] + r[2,0]) / w , (r[2,1] - r[1,2]) / w )
+        elif ( r[1,1] > r[2,2] ) :
+            w = sqrt(1.0 + r[1,1] - r[0,0] - r[2,2]) * 2
+            q = ( (r[0,1] + r[1,0]) / w , w / 4 , (r[1,2] + r[2,1]) / w , (r[0,2] - r[2,0]) / w )
+        else :
+            w = sqrt(1.0 + r[2,2] - r[0,0] - r[1,1]) * 2
+            q = ( (r[0,2] + r[2,0]) / w , (r[1,2] + r[2,1]) / w , w / 4 , (r[1,0] - r[0,1]) / w )
+        return ( array(q , float64) )
+
+    def quantize(self):
+        #(x , y , z , w) quaternions and translations in fixed point, each
+        #quaternion being on the same side as the one of the previous frame
+        nb_frames , nb_bones = self.frames.shape[:2]
+        quaternions = zeros( (nb_frames , nb_bones , 4) , float64 )
+        for f in range(nb_frames) :
+            for b in range(nb_bones) :
+                q = self.get_quaternion(self.frames[f,b])
+                if ( f > 0 and dot(q , quaternions[f-1,b]) < 0 ) :
+                    q = -q
+                quaternions[f,b] = q
+        quaternions = clip( around(quaternions * (1<<12)) , -0x8000 , 0x7FFF ).astype(int64)
+        translations = clip( around(self.frames[:,:,:,3] * (1<<12)) , -0x80000000 , 0x7FFFFFFF ).astype(int64)
+        return ( ( quaternions , translations ) )
+
+    def get_matrices(self,q,t):
+        #the (n,3,4) matrices of (n,4) fixed point quaternions (normalized)
+        #and (n,3) translations
+        q = q / sqrt( (q ** 2).sum(1) ).reshape(-1,1)
+        x , y , z , w = q.T
+        m = zeros( (len(q) , 3 , 4) , float64 )
+        m[:,0,0] = 1 - 2 * (y*y + z*z)
+        m[:,0,1] = 2 * (x*y - z*w)
+        m[:,0,2] = 2 * (x*z + y*w)
+        m[:,1,0] = 2 * (x*y + z*w)
+        m[:,1,1] = 1 - 2 * (x*x + z*z)
+        m[:,1,2] = 2 * (y*z - x*w)
+        m[:,2,0] = 2 * (x*z - y*w)
+        m[:,2,1] = 2 * (y*z + x*w)
+        m[:,2,2] = 1 - 2 * (x*x + y*y)
+        m[:,:,3] = t / float(1<<12)
+        return ( m )
+
+    def get_error(self,bone,a,b):
+        #largest distance (in 1/4096 units of the list) between the vertices of
+        #the bone at the frames a to b and where the interpolation of the
+        #keyframes a and b puts them
+        t = ((arange(a , b + 1) - a) / float(max(b - a , 1))).reshape(-1,1)
+        q = self.quaternions[a,bone] + t * (self.quaternions[b,bone] - self.quaternions[a,bone])
+        tr = self.translations[a,bone] + t * (self.translations[b,bone] - self.translations[a,bone])
+        interpolated = self.get_matrices(q , tr)
+        exact = self.frames[a:b+1,bone]
+        v = self.vertices[bone]
+        if ( len(v) == 0 ) :
+            v = zeros( (1,3) , float64 )
+        moved = dot(interpolated[:,:,:3] - exact[:,:,:3] , v.T) + (interpolated[:,:,3] - exact[:,:,3]).reshape(-1,3,1)
+        return ( abs(moved).max() * self.unit )
+
+    def select_keyframes(self,bone):
+        #the same greedy search as the vertex animation, over one bone
+        keyframes = [ 0 ]
+        nb_frames = len(self.frames)
+        while ( keyframes[-1] < nb_frames - 1 ) :
+            a = keyframes[-1]
+            b = a + 1
+            while ( b + 1 < nb_frames and self.get_error(bone , a , b + 1) <= self.tolerance ) :
+                b += 1
+            self.error = max(self.error , self.get_error(bone , a , b))
+            keyframes.append(b)
+        if ( nb_frames == 1 ) :
+            self.error = max(self.error , self.get_error(bone , 0 , 0))
+        return ( keyframes )
+
+    def get_words(self):
+        #the number of frames and bones, the word offset of the track of each
+        #bone, then each track : its number of keyframes, and the frame,
+        #quaternion (x , y and z , w packed) and translation of each one
+        nb_frames , nb_bones = self.frames.shape[:2]
+        offset = 2 + nb_bones
+        offsets = []
+        tracks = []
+        for bone , keys in enumerate(self.tracks) :
+            offsets.append(offset)
+            q = self.quaternions[keys,bone]
+            t = self.translations[keys,bone]
+            track = column_stack( ( keys , (q[:,0] & 0xFFFF) | (q[:,1] << 16) , (q[:,2] & 0xFFFF) | (q[:,3] << 16) , t ) )
+            tracks.append( concatenate( ( [ len(keys) ] , track.ravel() ) ) )
+            offset += len(tracks[-1])
+        words = concatenate( [ array( [ nb_frames , nb_bones ] + offsets , int64 ) ] + tracks )
+        return ( words.astype(int64) & 0xFFFFFFFF )
+
+    def get_report(self,nb_bytes,nb_restores):
+        #nb_bytes against the positions of the vertices at every frame
+        nb_frames , nb_bones = self.frames.shape[:2]
+        nb_vertices = sum( [ len(v) for v in self.vertices ] )
+        return ( "Skeleton : %d bones, %d frames, %d keyframes, %d bytes (%.1f%% of the positions of every frame), %d matrix restores, error max %.1f/4096" % (nb_bones , nb_frames , sum( [ len(keys) for keys in self.tracks ] ) , nb_bytes , 100.0 * nb_bytes / max(nb_frames * nb_vertices * 8 , 1) , nb_restores , self.error) )
+
+
+# a _nds_export_stats gathers what the export of a mesh took, for the build logs
+# (--stats) : the time and the peak memory of the process after each stage, the
+# counters of the mesh and of its lists, the number of commands of each opcode
+# and the bytes they take (their opcode byte and their parameters).
+class _nds_export_stats (object) :
+    __slots__ = 'name' , 'stages' , 'counters' , 'opcodes'
+
+    def __init__(self,name):
+        self.name = name
+        self.stages = []
+        self.counters = {}
+        self.opcodes = zeros(256 , int64)
+
+    def end_stage(self,stage,start_time):
+        #(stage , seconds , peak memory of the process so far) of each stage
+        self.stages.append( ( stage , time.time() - start_time , get_peak_memory() ) )
+
+    def get_time(self,*stages):
+        #seconds spent in these stages
+        return ( sum( [ seconds for stage , seconds , peak in self.stages if (stage in stages) ] ) )
+
+    def count(self,name,n=1):
+        self.counters[name] = self.counters.get(name , 0) + n
+
+    def get_attribute_bytes(self):
+        return ( dict( [ ( FIFO_COMMANDS[op].name , int(self.opcodes[op] * (1 + 4 * FIFO_NB_PARAMS[op])) ) for op in nonzero(self.opcodes)[0].tolist() ] ) )
+
+    def get_report(self):
+        #for the JSON file
+        return ( { 'mesh' : self.name ,
+                   'stages' : [ { 'stage' : stage , 'time' : seconds , 'peak_memory' : peak } for stage , seconds , peak in self.stages ] ,
+                   'counters' : self.counters ,
+                   'opcodes' : dict( [ ( FIFO_COMMANDS[op].name , int(self.opcodes[op]) ) for op in nonzero(self.opcodes)[0].tolist() ] ) ,
+                   'attribute_bytes' : self.get_attribute_bytes() } )
+
+    def __str__(self):
+        nb_bytes = self.get_attribute_bytes().items()
+        nb_bytes.sort(key = lambda b : -b[1])
+        return ( "Stats %s : %s; %d packs, %d padding NOPs; bytes %s" % (self.name ,
+                 ", ".join( [ "%s %.3fs" % (stage , seconds) for stage , seconds , peak in self.stages ] ) ,
+                 self.counters.get('packs' , 0) , self.counters.get('padding_nops' , 0) ,
+                 ", ".join( [ "%s %d" % b for b in nb_bytes ] )) )
 
 
 class _nds_mesh (object) :
-    __slots__ = 'name', 'quads' , 'triangles' , 'texture' , 'cmdpack_list' , 'cmdpack_count' , 'options', 'final_cmdpack'
+    __slots__ = 'name', 'quads' , 'triangles' , 'texture' , 'corners' , 'groups' , 'sublists' , 'chunks' , 'nodes' , 'budget' , 'lod_faces' , 'scale' , 'frames' , 'skeleton' , 'corner_bones' , 'current_bone' , 'nb_restores' , 'cmdstream' , 'cmdpack_list' , 'cmdpack_count' , 'options', 'final_cmdpack' , 'writer' , 'state_filter' , 'vertex_compactor' , 'pack_scheduler' , 'stripifier' , 'cmdstream_done' , 'stats'
 
 
     def __init__(self,mesh_options):
@@ -497,17 +3521,44 @@ class _nds_mesh (object) :
         self.options = mesh_options
         self.quads = []
         self.triangles = []
-        self.cmdpack_list = _nds_cmdpack_list()
+        self.groups = []
+        self.sublists = []
+        self.chunks = []
+        self.nodes = []
+        self.lod_faces = None
+        self.scale = ( 1<<12 , ( 0 , 0 , 0 ) )
+        self.frames = None
+        self.skeleton = None
+        self.corner_bones = None
+        self.current_bone = None
+        self.nb_restores = 0
+        self.budget = _nds_budget(mesh_options.polygon_budget , mesh_options.vertex_budget)
+        self.cmdstream = _nds_cmdstream()
+        self.cmdpack_list = _nds_cmdpack_list(self.cmdstream)
         print self.cmdpack_list
         self.cmdpack_count = 0
-        
+        self.writer = None
+        self.final_cmdpack = None
+        self.state_filter = _nds_state_filter()
+        self.vertex_compactor = _nds_vertex_compactor(mesh_options.vertex_tolerance)
+        self.pack_scheduler = _nds_pack_scheduler()
+        self.stripifier = None
+        self.cmdstream_done = 0
+        self.stats = _nds_export_stats(mesh_options.mesh_name)
 
         self.name = mesh_options.mesh_name
+        start_time = time.time()
         self.get_faces(mesh_options.mesh_data)
-        #self.rescale_mesh(mesh_options.mesh_data)
+        self.stats.end_stage('extraction' , start_time)
 
-        self.prepare_cmdpack()
-        self.construct_cmdpack()
+        #When streaming, the list is built and written at the same time by save()
+        if not (self.options.stream_export) :
+            start_time = time.time()
+            self.prepare_cmdpack()
+            self.stats.end_stage('prepare_cmdpack' , start_time)
+            start_time = time.time()
+            self.construct_cmdpack()
+            self.stats.end_stage('construct_cmdpack' , start_time)
 
     def save_tex(self) :
         try:
@@ -515,149 +3566,1103 @@ class _nds_mesh (object) :
         except ImportError :
             print "Python Imaging Library not installed"
         else :
-            print self.options.texture_data[0].filename
-            print Blender.sys.expandpath(self.options.texture_data[0].filename)
-            if (self.options.texture_data[0].packed ) : self.options.texture_data[0].unpack(Blender.UnpackModes.USE_LOCAL)
-            img = PIL.Image.open(Blender.sys.expandpath(self.options.texture_data[0].getFilename()))
-            img_rgb = img.convert("RGB")
-            img_pal = img_rgb.convert("P",palette=PIL.Image.ADAPTIVE)
-            img_res = img_pal.resize((self.options.texture_w,self.options.texture_h) )
-            img_res.save(self.options.get_final_path_tex())
-
-
-    def add_nds_mesh_vertex(self,face,face_list):
-        for i, v in enumerate(face.v):
-            nds_mesh_vertex = _nds_mesh_vertex()
-            #we copy vertex's coordinates information
-            nds_mesh_vertex.vertex = _nds_cmdpack_vertex(v.co)
-            #we copy vertex's normals information
-            nds_mesh_vertex.normal = _nds_cmdpack_normal(v.no)
-            #we copy vertex's UV coordinates information only if there is UV layer for the current mesh
-            if (self.options.uv_export) :
-                if (face.uv[i].x >= 0 and face.uv[i].y >= 0):
-                    nds_mesh_vertex.uv = _nds_cmdpack_texture( ( face.uv[i].x * self.options.texture_w , (1-face.uv[i].y) * self.options.texture_h))
-            #we copy vertex's color only if there is Color Layer for the current mesh
-            if (self.options.color_export) :
-                nds_mesh_vertex.color = _nds_cmdpack_color( (face.col[i].r * 32 / 256 , face.col[i].g * 32 / 256, face.col[i].b * 32 / 256) )
-            #finally, we append the nds_mesh_vertex in the quads list
-            face_list.append(nds_mesh_vertex)
-
-    def get_faces(self,blender_mesh):
-        for face in blender_mesh.faces :
-            #we process the face only if this is a quad
-            if (len(face) == 4) :
-                self.add_nds_mesh_vertex(face,self.quads)
-            #we process the face only if this is a triangle
-            elif (len(face) == 3) :
-                self.add_nds_mesh_vertex(face,self.triangles)
-
-    """TODO : I think there is a need to rescale the mesh because the range in the NDS is [-8.0, 8.0[ but I need to do some tests before"""
-    def rescale_mesh(self,blender_mesh):
-        max_x=max_y=max_z=min_x=min_y=min_z=max_l=0
-        for v in blender_mesh.verts:
-            if v.co[0]>max_x : max_x = v.co[0]
-            elif v.co[0]<min_x : min_x = v.co[0]
-            if v.co[1]>max_y : max_y = v.co[1]
-            elif v.co[1]<min_y : min_y = v.co[1]
-            if v.co[2]>max_z : max_z = v.co[2]
-            elif v.co[2]<min_z : min_z = v.co[2]
-        if (abs(max_x-min_x) > max_l) : max_l = abs(max_x-min_x)
-        if (abs(max_y-min_y) > max_l) : max_l = abs(max_y-min_y)
-        if (abs(max_z-min_z) > max_l) : max_l = abs(max_z-min_z)
-
-        if (len(self.quads)>0):
-            for f in self.quads:
-                v=f.vertex
-                f.vertex.x = v.x/max_l
-                f.vertex.y = v.y/max_l
-                f.vertex.z = v.z/max_l
-        if (len(self.triangles)>0):
-            for f in self.triangles:
-                v=f.vertex
-                f.vertex.x = v.x/max_l
-                f.vertex.y = v.y/max_l
-                f.vertex.z = v.z/max_l
-        print "longueur max = %s" % (max_l)
+            for i , texture in enumerate(self.options.texture_data) :
+                img = PIL.Image.open(self.options.mesh_data.get_texture_file(texture))
+                w , h = self.options.get_texture_scale(i)[:2]
+                _nds_save_texture(img , w , h , self.options , self.options.get_final_path_tex(i) , self.options.get_texture_name(i))
+
+
+    def get_faces(self,source):
+        #we process the face only if this is a quad or a triangle
+        faces = []
+        materials = []
+        for face , material in zip(source.get_faces() , source.get_face_materials()) :
+            if (len(face[0]) == 4 or len(face[0]) == 3) :
+                faces.append(face)
+                materials.append(min(material , len(self.options.materials) - 1))
+        skeleton = source.get_skeleton() if (self.options.skeleton_export) else None
+        if (self.options.lod_levels > 1) : self.lod_faces = ( faces , materials , skeleton )
+        if (skeleton != None) :
+            names , vertex_bones , frames = skeleton
+            if (len(names) > SKELETON_BONES) :
+                raise ValueError("%d bones, the matrix stack only holds %d" % (len(names) , SKELETON_BONES))
+            self.skeleton = ( names , array(vertex_bones , int32) , asarray(frames , float64).reshape(-1,len(names),3,4) )
+
+        #a mesh over its budget (or any mesh with SPLIT_ALWAYS) is split into
+        #chunks drawn by their own lists
+        chunks = [ arange(len(faces)) ]
+        nodes = []
+        nb_corners = sum( [ len(face[0]) for face in faces ] )
+        over_budget = len(faces) > self.options.polygon_budget or nb_corners > self.options.vertex_budget
+        if (self.options.split_budget == EXPORT_OPTIONS['SPLIT_ALWAYS'] or (self.options.split_budget and over_budget)) :
+            chunks , nodes = self.split_faces(faces , source.get_vertices()[0])
+
+        #the faces of a chunk are grouped by the state they are drawn with :
+        #opaque materials before translucent ones (the GX sorts translucent
+        #polygons by itself), then by texture, so each texture is bound once
+        groups = {}
+        for c , chunk in enumerate(chunks) :
+            for i in chunk.tolist() :
+                texture , alpha = self.options.materials[materials[i]]
+                key = ( c , alpha < 1.0 , -1 if (texture == None) else texture , alpha )
+                if not ( key in groups ) :
+                    groups[key] = ( [] , [] )
+                groups[key][0 if (len(faces[i][0]) == 4) else 1].append(faces[i])
+        keys = groups.keys()
+        keys.sort()
+
+        #the faces of a group are binned by bone, so the vertices of a bone
+        #mostly follow each other and its matrix is restored once
+        if (self.skeleton != None) :
+            for quads , triangles in groups.values() :
+                quads.sort(key = self.get_face_bone)
+                triangles.sort(key = self.get_face_bone)
+
+        faces = []
+        scales = []
+        for key in keys :
+            quads , triangles = groups[key]
+            faces += quads + triangles
+            scales += [ self.options.get_texture_scale(key[2]) ] * (len(quads) + len(triangles))
+
+        #all the corners are gathered once, group by group, quads then
+        #triangles, and the face lists only keep the indices of their (cached)
+        #corners
+        if (len(set( [ key[2] for key in keys ] )) <= 1) : scales = None
+        self.corners = _nds_mesh_corners(faces,source,self.options,scales)
+        self.cmdstream.source = self.corners
+        #the position of the matrix of each corner in the stack
+        if (self.skeleton != None) : self.corner_bones = (self.skeleton[1][self.corners.indices] + 1).tolist()
+        vertices = self.corners.vertices
+        #the frames of an animated mesh, moved and scaled like its vertices
+        if (self.options.anim_export and len(source.get_frames()) > 1) :
+            self.frames = [ asarray(frame , float64) for frame in source.get_frames() ]
+        if (self.options.rescale) : self.rescale_mesh()
+        start = 0
+        for key in keys :
+            quads , triangles = groups[key]
+            quad_ids = self.corners.ids[ start : start + 4*len(quads) ]
+            start += 4*len(quads)
+            triangle_ids = self.corners.ids[ start : start + 3*len(triangles) ]
+            start += 3*len(triangles)
+            self.groups.append( ( key[2] , key[3] , quad_ids , triangle_ids ) )
+            if ( len(self.chunks) == key[0] ) :
+                self.chunks.append( [ len(self.groups) - 1 , 0 , [] ] )
+            self.chunks[-1][1] += 1
+            self.chunks[-1][2] += [ quad_ids , triangle_ids ]
+        self.quads = concatenate( [ self.corners.ids[:0] ] + [ g[2] for g in self.groups ] )
+        self.triangles = concatenate( [ self.corners.ids[:0] ] + [ g[3] for g in self.groups ] )
+        #(first sub-list , number of sub-lists , bounding box) of each chunk
+        self.chunks = [ ( first , nb , self.get_bounding_box(concatenate(ids)) ) for first , nb , ids in self.chunks ]
+
+        #the boxes of the nodes, from the leaves up : the children of a node
+        #always come after it
+        boxes = [ None ] * len(nodes)
+        for n in range(len(nodes) - 1 , -1 , -1) :
+            children = [ self.chunks[~child][2] if (child < 0) else boxes[child] for child in nodes[n] ]
+            boxes[n] = tuple( [ min(children[0][i] , children[1][i]) for i in range(3) ] + [ max(children[0][i] , children[1][i]) for i in range(3 , 6) ] )
+        self.nodes = [ tuple(nodes[n]) + boxes[n] for n in range(len(nodes)) ]
+        print self.corners
+        print self.get_quantization_report(vertices)
+        if (len(self.chunks) > 1) : print "Split into %d chunks of up to %d faces" % (len(self.chunks) , self.options.get_chunk_polygons())
+
+    def get_face_bone(self,face):
+        #the bone of most of the corners of the face (the lowest one if tied)
+        bones = self.skeleton[1][face[0]].tolist()
+        return ( min( [ ( -bones.count(b) , b ) for b in bones ] )[1] )
+
+    def split_faces(self,faces,co):
+        #the chunks of faces, and the nodes of the bounding volume hierarchy
+        #over them, the first one being the root
+        centers = array( [ co[face[0]].mean(0) for face in faces ] , float64 ).reshape(-1,3)
+        sizes = array( [ len(face[0]) for face in faces ] , int32 )
+        chunks = []
+        nodes = []
+        self.split_node(arange(len(faces)) , centers , sizes , chunks , nodes)
+        return ( ( chunks , nodes ) )
+
+    def split_node(self,selected,centers,sizes,chunks,nodes):
+        #median splits along the longest axis of the face centers, until every
+        #chunk has at most get_chunk_polygons() faces and vertex_budget
+        #vertices (sizes being the corners of each face). Returns the node
+        #index, or ~chunk index for a leaf
+        fits = len(selected) <= self.options.get_chunk_polygons() and sizes[selected].sum() <= self.options.vertex_budget
+        if ( fits or len(selected) <= 1 ) :
+            chunks.append(selected)
+            return ( ~(len(chunks) - 1) )
+        node = len(nodes)
+        nodes.append(None)
+        c = centers[selected]
+        axis = argmax( c.max(0) - c.min(0) )
+        order = selected[ argsort(c[:,axis] , kind='mergesort') ]
+        half = len(order) / 2
+        left = self.split_node(sort(order[:half]) , centers , sizes , chunks , nodes)
+        right = self.split_node(sort(order[half:]) , centers , sizes , chunks , nodes)
+        nodes[node] = ( left , right )
+        return ( node )
+
+    def get_chunk_faces(self):
+        #number of faces of each chunk
+        return ( [ sum( [ len(g[2]) / 4 + len(g[3]) / 3 for g in self.groups[first : first + nb] ] ) for first , nb , box in self.chunks ] )
+
+    def get_chunk_bytes(self):
+        #size of the sub-lists of each chunk
+        return ( [ sum( [ 4 * (1 + l[2]) for l in self.sublists[first : first + nb] ] ) for first , nb , box in self.chunks ] )
+
+    def get_view_savings(self):
+        #the part of the lists skipped by culling the chunks out of each view
+        #of CHUNK_VIEWS : a box is drawn when it reaches into the view pyramid
+        boxes = array( [ box for first , nb , box in self.chunks ] , float64 ).reshape(-1,6)
+        sizes = array( self.get_chunk_bytes() , float64 )
+        low , high = boxes[:,:3] , boxes[:,3:]
+        center = (low.min(0) + high.max(0)) / 2
+        savings = []
+        for axis , direction in CHUNK_VIEWS :
+            #the farthest point of the box along the view
+            depth = where(direction > 0 , high[:,axis] - center[axis] , center[axis] - low[:,axis])
+            visible = depth >= 0
+            for other in range(3) :
+                if ( other == axis ) : continue
+                #|p - center| <= depth on the other axes, for some point p of the box
+                gap = maximum( maximum(low[:,other] - center[other] , center[other] - high[:,other]) , 0 )
+                visible &= gap <= depth
+            savings.append( 1.0 - sizes[visible].sum() / max(sizes.sum() , 1.0) )
+        return ( savings )
+
+    def get_chunks_report(self):
+        faces = sort( array( self.get_chunk_faces() , int32 ) )
+        savings = self.get_view_savings()
+        return ( "Chunks : %d chunks (%d nodes), faces per chunk min=%d median=%d max=%d, %.0f bytes per chunk, %.1f%% of the list culled per view (%.1f%% to %.1f%% over %d views)" % (len(self.chunks) , len(self.nodes) , faces[0] , faces[len(faces) / 2] , faces[-1] , mean(self.get_chunk_bytes()) , 100.0 * mean(savings) , 100.0 * min(savings) , 100.0 * max(savings) , len(savings)) )
+
+    def get_bounding_box(self,ids):
+        #(min x , y , z , max x , y , z) of the corners in v16 fixed point,
+        #rounded outwards and grown by the vertex tolerance
+        if ( len(ids) == 0 ) :
+            return ( ( 0 , ) * 6 )
+        vertices = self.corners.vertices[ids] * (1<<12)
+        if ( self.skeleton != None ) :
+            #the box of a skinned mesh holds every pose
+            vertices = concatenate( self.get_skinned_vertices(ids) ) * (1<<12)
+        if ( self.frames != None ) :
+            #the box of an animated mesh holds every frame
+            vertices = concatenate( [ frame[self.corners.indices[ids]] for frame in self.frames ] ) * (1<<12)
+        low = clip( floor(vertices.min(0)) - self.options.vertex_tolerance , -0x8000 , 0x7FFF ).astype(int32)
+        high = clip( ceil(vertices.max(0)) + self.options.vertex_tolerance , -0x8000 , 0x7FFF ).astype(int32)
+        return ( tuple(low.tolist() + high.tolist()) )
+
+    def get_skinned_vertices(self,ids):
+        #the corners (in list units) at each frame of the skeleton
+        inverse , offset = self.scale
+        offset = array(offset , float64) / (1<<12)
+        vertices = self.corners.vertices[ids] * (inverse / float(1<<12)) + offset
+        bones = self.skeleton[1][self.corners.indices[ids]]
+        skinned = []
+        for frame in self.skeleton[2] :
+            #the vertices without a bone stay in place
+            matrices = concatenate( ( frame , [ eye(3 , 4) ] ) )[bones]
+            moved = (matrices[:,:,:3] * vertices.reshape(-1,1,3)).sum(2) + matrices[:,:,3]
+            skinned.append( (moved - offset) * (float(1<<12) / inverse) )
+        return ( skinned )
+
+    def rescale_mesh(self):
+        #the vertices are moved and scaled to fill the v16 range [-8, 8[ : the
+        #list draws (v - offset) * scale, the header giving 1 / scale and the
+        #offset (20.12 fixed point) for the runtime to glTranslatef32 and
+        #glScalef32 before calling it. Both are exact in fixed point.
+        vertices = self.corners.vertices
+        if ( len(vertices) == 0 ) :
+            return
+        low , high = vertices.min(0) , vertices.max(0)
+        if ( self.frames != None ) :
+            every = concatenate( [ frame[self.corners.indices] for frame in self.frames ] )
+            low , high = every.min(0) , every.max(0)
+        offset = around( (low + high) / 2 * (1<<12) ).astype(int64)
+        extent = maximum( high - offset / 4096.0 , offset / 4096.0 - low ).max()
+        #the smallest 1 / scale keeping the vertices under 0x7FFF / 4096
+        inverse = max( int(ceil(extent * (1<<24) / 0x7FFF)) , 1 )
+        self.scale = ( inverse , tuple(offset.tolist()) )
+        self.corners.vertices = (vertices - offset / 4096.0) * (4096.0 / inverse)
+        if ( self.frames != None ) :
+            self.frames = [ (frame - offset / 4096.0) * (4096.0 / inverse) for frame in self.frames ]
+        print "Rescale : offset (%f, %f, %f), scale %f" % (offset[0] / 4096.0 , offset[1] / 4096.0 , offset[2] / 4096.0 , 4096.0 / inverse)
+
+    def get_quantization_report(self,vertices):
+        #distance between the source vertices and the ones the hardware draws
+        inverse , offset = self.scale
+        drawn = floattov16_batch(self.corners.vertices) * (inverse / float(1<<24)) + array(offset , float64) / 4096.0
+        error = sqrt( ((drawn - vertices) ** 2).sum(1) )
+        if ( len(error) == 0 ) :
+            error = zeros(1)
+        text = "Quantization : %d vertices, error max %f mean %f rms %f (v16 step %f)" % (len(vertices) , error.max() , error.mean() , sqrt((error ** 2).mean()) , inverse / float(1<<24))
+        outside = logical_or( self.corners.vertices * (1<<12) < -0x8000 , self.corners.vertices * (1<<12) > 0x7FFF ).any(1).sum()
+        if ( outside > 0 ) :
+            text += "\n!!!Warning : %d vertices out of the v16 range [-8, 8[ are clamped : use Rescale!!!" % (outside)
+        return ( text )
+
+    def get_scale_header(self):
+        #1 / scale and offset (20.12 fixed point), before the lists of a
+        #rescaled mesh
+        if not ( self.options.rescale ) :
+            return ( "" )
+        inverse , offset = self.scale
+        if (self.options.format == EXPORT_OPTIONS['FORMAT_TEXT']) :
+            return ( "s32 %s_scale[] = {\n%d, %d, %d, %d\n};\n" % ( (self.options.mesh_name , inverse) + offset ) )
+        return ( pack( '<4i' , inverse , *offset ) )
 
-    def prepare_cmdpack(self):
-        #If there is at least 1 quad
-        if ( len(self.quads) > 0 ) :
-            #Begin Quads list
-            self.cmdpack_list.add( _nds_cmdpack_begin('GL_QUADS') )
+    def prepare_primitives(self,begin_opt,face_list):
+        self.budget.add(begin_opt , len(face_list))
+
+        #Begin the primitives list
+        self.cmdpack_list.add( FIFO_BEGIN , GL_GLBEGIN_ENUM[begin_opt] )
+
+        uv_valid = self.corners.uv_valid.tolist()
+        for i in face_list.tolist() :
 
-            for i in range( len(self.quads) ) :
+            #the matrix of the bone of the vertex, before its normal is lit
+            if ( self.corner_bones != None and self.corner_bones[i] != self.current_bone ) :
+                self.cmdpack_list.add( FIFO_RESTORE , self.corner_bones[i] )
+                self.current_bone = self.corner_bones[i]
+                self.nb_restores += 1
 
-                v = self.quads[i]
+            if ( self.options.color_export ) :
+                self.cmdpack_list.add( FIFO_COLOR , i )
 
-                if ( self.options.color_export and v.color != None ) :
-                    self.cmdpack_list.add(v.color)
+            if ( self.options.uv_export and uv_valid[i] ) :
+                self.cmdpack_list.add( FIFO_TEX_COORD , i )
 
-                if (self.options.uv_export and v.uv != None) :
-                    self.cmdpack_list.add(v.uv)
+            if ( self.options.normals_export ) :
+                self.cmdpack_list.add( FIFO_NORMAL , i )
 
-                if (self.options.normals_export and v.normal != None):
-                    self.cmdpack_list.add(v.normal)
+            self.cmdpack_list.add( FIFO_VERTEX16 , i )
 
-                if (v.vertex != None) :
-                    self.cmdpack_list.add(v.vertex)
-            #End Quads list
-            self.cmdpack_list.add( _nds_cmdpack_end() )
+            if ( self.writer != None and self.cmdstream.len() >= CMDSTREAM_CHUNK ) :
+                self.optimize_cmdstream()
+                self.cmdstream_done -= self.writer.write(self.cmdstream)
 
-        #If there is at least 1 triangle
-        if ( len(self.triangles) > 0 ) :
-            #Begin Triangles list
-            self.cmdpack_list.add( _nds_cmdpack_begin('GL_TRIANGLES') )
+        #End the primitives list
+        self.cmdpack_list.add( FIFO_END )
 
-            for i in range( len(self.triangles) ) :
+    def get_corner_cost(self):
+        #Bytes taken by each corner in an unoptimized list : the parameters
+        #and the opcodes of its commands
+        nb_cmds = zeros(self.corners.len() , int32) + 1
+        if ( self.options.color_export ) : nb_cmds += 1
+        if ( self.options.normals_export ) : nb_cmds += 1
+        if ( self.options.uv_export ) : nb_cmds += self.corners.uv_valid
+        return ( 4 * (nb_cmds + 1) + nb_cmds )
 
-                v = self.triangles[i]
+    def prepare_strips(self,strip_opt,begin_opt,face_list,size):
+        strips, alone = self.stripifier.stripify(face_list,size)
+        for strip in strips :
+            self.prepare_primitives(strip_opt,strip)
+        if ( len(alone) > 0 ) :
+            self.prepare_primitives(begin_opt,alone)
+
+    def prepare_cmdpack(self):
+        if (self.options.strips) :
+            self.stripifier = _nds_stripifier(self.corners.get_vertex_ids(),self.get_corner_cost())
+
+        #a mesh without faces still gets its (empty) list
+        groups = self.groups
+        if ( len(groups) == 0 ) :
+            groups = [ ( None , 1.0 , self.quads , self.triangles ) ]
+
+        #one sub-list per group of faces
+        for texture , alpha , quads , triangles in groups :
+            if ( self.writer != None and len(self.sublists) > 0 ) :
+                self.writer.start_list()
+
+            #If there is at least 1 quad
+            if ( len(quads) > 0 ) :
+                if (self.options.strips) :
+                    self.prepare_strips('GL_QUAD_STRIP','GL_QUADS',quads,4)
+                else :
+                    self.prepare_primitives('GL_QUADS',quads)
 
-                if ( self.options.color_export and v.color != None ) :
-                    self.cmdpack_list.add(v.color)
+            #If there is at least 1 triangle
+            if ( len(triangles) > 0 ) :
+                if (self.options.strips) :
+                    self.prepare_strips('GL_TRIANGLE_STRIP','GL_TRIANGLES',triangles,3)
+                else :
+                    self.prepare_primitives('GL_TRIANGLES',triangles)
 
-                if (self.options.uv_export and v.uv != None) :
-                    self.cmdpack_list.add(v.uv)
+            self.end_sublist(texture , alpha)
 
-                if (self.options.normals_export and v.normal != None):
-                    self.cmdpack_list.add(v.normal)
+        if (self.options.strips) : print self.stripifier
+        if (self.options.state_filter) : print self.state_filter
+        if (self.options.compact_vertices and self.frames == None) : print self.vertex_compactor
+        if (self.options.pack_schedule) : print self.pack_scheduler
+        print self.budget
+        if (len(self.chunks) > 1) : print self.get_chunks_report()
 
-                if (v.vertex != None) :
-                    self.cmdpack_list.add(v.vertex)
-            #End Quads list
-            self.cmdpack_list.add( _nds_cmdpack_end() )
+    def end_sublist(self,texture,alpha):
+        self.budget.end_list()
+        self.optimize_cmdstream()
 
         #Fill the remaining cmd slots with NOP commands
+        start = 0
+        if ( len(self.sublists) > 0 ) : start = self.sublists[-1][1]
+        if (self.options.pack_schedule) :
+            self.pack_scheduler.run(self.cmdstream,start)
+            self.cmdstream_done = self.cmdstream.len()
+        if ( self.cmdstream.len() == start ) : self.cmdstream.add(FIFO_NOP)
         self.cmdpack_list.terminate()
+        self.cmdstream_done = self.cmdstream.len()
 
-    def construct_cmdpack(self):
+        #nothing is known of the state when a sub-list is called
+        self.state_filter.reset()
+        self.vertex_compactor.reset()
+        self.current_bone = None
 
-        self.final_cmdpack = ""
+        if ( self.writer != None ) :
+            self.writer.end_list(self.cmdstream)
+            self.cmdstream_done = self.cmdstream.len()
+            self.sublists.append( ( 0 , 0 , self.writer.counts[-1] , texture , alpha ) )
+        else :
+            self.sublists.append( ( start , self.cmdstream.len() , self.cmdstream.get_nb_params(None , start) , texture , alpha ) )
+
+    def optimize_cmdstream(self):
+        #Run the optimization passes over the commands added since the last call
+        if (self.options.state_filter) :
+            self.state_filter.run(self.cmdstream,self.cmdstream_done)
+        #the vertices of an animated list are patched in place : they all
+        #stay FIFO_VERTEX16
+        if (self.options.compact_vertices and self.frames == None) :
+            self.vertex_compactor.run(self.cmdstream,self.cmdstream_done)
+        self.cmdstream_done = self.cmdstream.len()
 
+    def construct_cmdpack(self):
+        #each sub-list is its parameters count followed by its packs
         if (self.options.format == EXPORT_OPTIONS['FORMAT_TEXT']) :
-            s = "u32 %s[] = {\n%d,\n%s" % ( self.options.mesh_name , self.cmdpack_list.get_nb_params() , self.cmdpack_list.get_pack(self.options.format) )
-            self.final_cmdpack += s[0:-2]
-            self.final_cmdpack += "\n};\n"
+            #the items are joined once, without any trailing separator to strip
+            items = []
+            for start , end , nb_params , texture , alpha in self.sublists :
+                items += [ "%d" % (nb_params) ] + self.cmdstream.get_text_items(end , start)
+            self.final_cmdpack = self.get_scale_header() + "u32 %s[] = {\n%s\n};\n" % ( self.options.mesh_name , ",\n".join(items) )
         elif (self.options.format == EXPORT_OPTIONS['FORMAT_BINARY']) :
-            self.final_cmdpack += pack( '<i' , self.cmdpack_list.get_nb_params())
-            self.final_cmdpack += self.cmdpack_list.get_pack(self.options.format)
+            self.final_cmdpack = self.get_scale_header() + "".join( [ pack( '<i' , nb_params ) + self.cmdstream.get_binary(end , start) for start , end , nb_params , texture , alpha in self.sublists ] )
 
         #print self.final_cmdpack
 
-    def save(self) :
-        f = open(self.options.get_final_path_mesh(),"w")
-        f.write(self.final_cmdpack)
-        f.close();
+    def get_materials_table(self):
+        #(offset in words of the sub-list in the file (in the array when
+        #C-Style) , texture + 1 or 0 if untextured , alpha in 0..31) of every
+        #sub-list
+        table = []
+        offset = 0
+        if (self.options.format == EXPORT_OPTIONS['FORMAT_BINARY']) : offset = len(self.get_scale_header()) / 4
+        for start , end , nb_params , texture , alpha in self.sublists :
+            table.append( ( offset , 0 if (texture == None or texture < 0) else texture + 1 , int(round(alpha * 31)) ) )
+            offset += 1 + nb_params
+        return ( table )
+
+    def save_materials(self):
+        #the table of a mesh drawn in several sub-lists : their count, then
+        #offset / texture / alpha of each one
+        table = self.get_materials_table()
+        f = open(self.options.get_final_path_materials(),"wb")
+        if (self.options.format == EXPORT_OPTIONS['FORMAT_TEXT']) :
+            f.write( "u32 %s_materials[] = {\n%d,\n%s\n};\n" % ( self.options.mesh_name , len(table) , ",\n".join( [ "%d, %d, %d" % entry for entry in table ] ) ) )
+        else :
+            f.write( pack( '<I' , len(table) ) + "".join( [ pack( '<3I' , *entry ) for entry in table ] ) )
+        f.close()
+
+    def save_chunks(self):
+        #the table of a split mesh : its number of chunks, then the first
+        #sub-list, number of sub-lists and bounding box of each one
+        table = [ ( first , nb ) + box for first , nb , box in self.chunks ]
+        f = open(self.options.get_final_path_chunks(),"wb")
+        if (self.options.format == EXPORT_OPTIONS['FORMAT_TEXT']) :
+            f.write( "s16 %s_chunks[] = {\n%d,\n%s\n};\n" % ( self.options.mesh_name , len(table) , ",\n".join( [ "%d, %d, %d, %d, %d, %d, %d, %d" % entry for entry in table ] ) ) )
+        else :
+            f.write( pack( '<h' , len(table) ) + "".join( [ pack( '<8h' , *entry ) for entry in table ] ) )
+        f.close()
+
+    def save_nodes(self):
+        #the bounding volume hierarchy of a split mesh : its number of nodes,
+        #then the two children (a node index, or ~chunk index) and bounding
+        #box of each one, the root being the first
+        f = open(self.options.get_final_path_nodes(),"wb")
+        if (self.options.format == EXPORT_OPTIONS['FORMAT_TEXT']) :
+            f.write( "s16 %s_nodes[] = {\n%d,\n%s\n};\n" % ( self.options.mesh_name , len(self.nodes) , ",\n".join( [ "%d, %d, %d, %d, %d, %d, %d, %d" % entry for entry in self.nodes ] ) ) )
+        else :
+            f.write( pack( '<h' , len(self.nodes) ) + "".join( [ pack( '<8h' , *entry ) for entry in self.nodes ] ) )
+        f.close()
+
+    def get_vertex_patches(self):
+        #(word offset in the file (in the array when C-Style) , corner) of
+        #the FIFO_VERTEX16 parameters of the sub-lists
+        offsets = []
+        corners = []
+        offset = 0
+        if (self.options.format == EXPORT_OPTIONS['FORMAT_BINARY']) : offset = len(self.get_scale_header()) / 4
+        for start , end , nb_params , texture , alpha in self.sublists :
+            selected = nonzero(self.cmdstream.get_ops()[start:end] == FIFO_VERTEX16)[0]
+            offsets.append( offset + 1 + self.cmdstream.get_param_offsets(end , start)[selected] )
+            corners.append( self.cmdstream.get_args()[start:end][selected] )
+            offset += 1 + nb_params
+        return ( ( concatenate( [ zeros(0 , int64) ] + offsets ) , concatenate( [ zeros(0 , int32) ] + corners ) ) )
+
+    def save_anim(self,patches):
+        #the animated vertices (slots) are the source vertices of the corners
+        offsets , corners = patches
+        slots = unique(self.corners.indices)
+        frames = [ floattov16_batch(frame[slots]) for frame in self.frames ]
+        animation = _nds_vertex_animation(frames , self.options.anim_tolerance)
+        words = animation.get_words(offsets , searchsorted(slots , self.corners.indices[corners]))
+        f = open(self.options.get_final_path_anim(),"wb")
+        if (self.options.format == EXPORT_OPTIONS['FORMAT_TEXT']) :
+            f.write( "u32 %s_anim[] = {\n%s\n};\n" % ( self.options.mesh_name , ",\n".join( [ "%d" % (w) for w in words.tolist() ] ) ) )
+        else :
+            f.write( words.astype('<u4').tostring() )
+        f.close()
+        print animation.get_report(4 * len(words) , sum( [ 4 * (1 + l[2]) for l in self.sublists ] ))
+
+    def save_skeleton(self):
+        #the vertices of each bone, for the error of its track
+        names , vertex_bones , frames = self.skeleton
+        co = self.options.mesh_data.get_vertices()[0]
+        used = unique(self.corners.indices)
+        vertices = [ co[used[vertex_bones[used] == bone]] for bone in range(len(names)) ]
+        skeleton = _nds_skeleton(frames , vertices , self.options.anim_tolerance , float(1<<24) / self.scale[0])
+        words = skeleton.get_words()
+        f = open(self.options.get_final_path_skeleton(),"wb")
+        if (self.options.format == EXPORT_OPTIONS['FORMAT_TEXT']) :
+            f.write( "u32 %s_skeleton[] = {\n%s\n};\n" % ( self.options.mesh_name , ",\n".join( [ "%d" % (w) for w in words.tolist() ] ) ) )
+        else :
+            f.write( words.astype('<u4').tostring() )
+        f.close()
+        print skeleton.get_report(4 * len(words) , self.nb_restores)
+
+    def save_lods(self):
+        #the levels after the first one are decimated from the faces of the
+        #mesh, each one keeping LOD_RATIO of the triangles of the previous one,
+        #and exported as meshes of their own
+        faces , materials , skeleton = self.lod_faces
+        decimator = _nds_decimator(faces , materials , self.options.mesh_data.get_vertices()[0])
+        #(polygons , switch distance) of each level
+        levels = [ ( len(self.quads)/4 + len(self.triangles)/3 , 0.0 ) ]
+        for level in range(1 , min(self.options.lod_levels , LOD_LEVELS)) :
+            start_time = time.time()
+            decimator.decimate( int(decimator.nb_faces * LOD_RATIO) )
+            lod_faces , lod_materials = decimator.get_faces()
+            if (decimator.nb_faces == len(decimator.face_vertices)) :
+                #nothing could be collapsed : the faces of the mesh, unsplit
+                lod_faces , lod_materials = faces , materials
+            options = self.options.get_lod_options(level , _mesh_lod_source(self.options.mesh_data , "%s_lod%d" % (self.name , level) , lod_faces , lod_materials , skeleton))
+            print "LOD %d : %d triangles in %.3fs, error %f" % (level , len(lod_faces) , time.time() - start_time , decimator.error)
+            lod = _nds_mesh(options)
+            lod.save()
+            print lod
+            #the distance the error is seen under LOD_PIXEL_ERROR pixels from
+            levels.append( ( len(lod_faces) , decimator.error * LOD_SCREEN_HEIGHT / (2 * tan(radians(LOD_FOV) / 2) * LOD_PIXEL_ERROR) ) )
+
+        #the number of levels, then the polygons and switch distance (20.12
+        #fixed point) of each one
+        table = [ ( polygons , min(int(round(distance * (1<<12))) , 0x7FFFFFFF) ) for polygons , distance in levels ]
+        f = open(self.options.get_final_path_lods(),"wb")
+        if (self.options.format == EXPORT_OPTIONS['FORMAT_TEXT']) :
+            f.write( "s32 %s_lods[] = {\n%d,\n%s\n};\n" % ( self.options.mesh_name , len(table) , ",\n".join( [ "%d, %d" % entry for entry in table ] ) ) )
+        else :
+            f.write( pack( '<i' , len(table) ) + "".join( [ pack( '<2i' , *entry ) for entry in table ] ) )
+        f.close()
+        print "LODs : " + " , ".join( [ "%d polygons from %.2f" % entry for entry in levels ] )
 
-        if (self.options.texfile_export) : self.save_tex()
+    def save(self) :
+        start_time = time.time()
+        if (self.options.stream_export) :
+            self.writer = _nds_cmdlist_writer(self.options.get_final_path_mesh(),self.options.format,self.options.mesh_name,self.get_scale_header())
+            if (self.frames != None) : self.writer.patches = []
+            self.prepare_cmdpack()
+            self.writer.close(self.cmdstream)
+            print self.writer
+            if (self.frames != None) :
+                patches = ( concatenate( [ zeros(0 , int64) ] + [ p[0] for p in self.writer.patches ] ) , concatenate( [ zeros(0 , int32) ] + [ p[1] for p in self.writer.patches ] ) )
+            self.writer = None
+        else :
+            f = open(self.options.get_final_path_mesh(),"wb")
+            f.write(self.final_cmdpack)
+            f.close();
+            #the list was built before save() : its time counts, like in the
+            #streaming writer
+            elapsed = max(self.stats.get_time('prepare_cmdpack' , 'construct_cmdpack') + time.time() - start_time , 1e-6)
+            print "Wrote %d bytes into %s in %.3fs : %.2f MB/s" % (len(self.final_cmdpack) , self.options.get_final_path_mesh() , elapsed , len(self.final_cmdpack) / (1024.0 * 1024.0) / elapsed)
+            if (self.frames != None) : patches = self.get_vertex_patches()
+
+        if (len(self.sublists) > 1) : self.save_materials()
+        if (len(self.chunks) > 1) : self.save_chunks()
+        if (len(self.nodes) > 0) : self.save_nodes()
+        if (self.frames != None) : self.save_anim(patches)
+        if (self.skeleton != None) : self.save_skeleton()
+        if (self.options.lod_levels > 1) : self.save_lods()
+        if (self.options.texfile_export) :
+            tex_time = time.time()
+            self.save_tex()
+            self.stats.end_stage('save_tex' , tex_time)
+        self.stats.end_stage('save' , start_time)
+        self.count_stats()
+
+    def count_stats(self):
+        #the counters of the saved mesh and of its lists
+        stats = self.stats
+        stats.opcodes = self.cmdstream.get_histogram()
+        stats.count('faces' , len(self.quads) / 4 + len(self.triangles) / 3)
+        stats.count('corners' , self.corners.len())
+        stats.count('sublists' , len(self.sublists))
+        stats.count('chunks' , len(self.chunks))
+        stats.count('commands' , int(stats.opcodes.sum()))
+        stats.count('packs' , int(stats.opcodes.sum()) / 4)
+        stats.count('padding_nops' , self.cmdstream.nb_padding)
+        stats.count('parameters' , int( (stats.opcodes * FIFO_NB_PARAMS).sum() ))
+        stats.count('list_bytes' , os.path.getsize(self.options.get_final_path_mesh()))
+        if (self.options.state_filter) : stats.count('filtered_commands' , self.state_filter.get_nb_removed())
+        if (self.options.compact_vertices and self.frames == None) : stats.count('compacted_vertices' , self.vertex_compactor.get_nb_compacted())
+        if (self.options.pack_schedule) : stats.count('dropped_ends' , self.pack_scheduler.nb_dropped)
+        if (self.skeleton != None) : stats.count('restores' , self.nb_restores)
 
     def __str__(self):
-        return "NDS Mesh [%s], Faces = %d (Quads=%d, Triangles=%d), Texture=%s" % (self.name,len(self.quads)/4+len(self.triangles)/3,len(self.quads)/4,len(self.triangles)/3,repr((self.options.get_final_path_tex(), self.options.texture_w,self.options.texture_h)) )
+        return "NDS Mesh [%s], Faces = %d (Quads=%d, Triangles=%d), Sub-lists=%d, Chunks=%d, Texture=%s" % (self.name,len(self.quads)/4+len(self.triangles)/3,len(self.quads)/4,len(self.triangles)/3,len(self.sublists),len(self.chunks),repr((self.options.get_final_path_tex(), self.options.texture_w,self.options.texture_h)) )
+
+
+# a _nds_export_cache keeps the exported files of the meshes in a directory,
+# under a hash of everything they are made of : the mesh arrays, the export
+# options and the texture image. A mesh found in the cache has its files copied
+# instead of being encoded again.
+# The cache is shared by the processes of a _nds_batch_export : the files are
+# renamed into place once written, the <key>.files list of the indices of the
+# stored files last : an entry without it, or missing one of its files, is a
+# miss. The least recently used entries are removed as a whole by evict() when
+# the cache grows over max_size bytes.
+class _nds_export_cache (object) :
+    __slots__ = 'dir_path' , 'max_size' , 'nb_hits' , 'nb_misses' , 'nb_evictions'
+
+    #Bumped when the exported files change for the same mesh and options
+    VERSION = 2
+
+    #The _mesh_options fields changing the exported files
+    KEY_OPTIONS = ( 'mesh_name' , 'format' , 'uv_export' , 'normals_export' , 'color_export' , 'texfile_export' , 'stream_export' , 'state_filter' , 'compact_vertices' , 'vertex_tolerance' , 'pack_schedule' , 'strips' , 'texture_sizes' , 'materials' , 'texture_w' , 'texture_h' , 'texture_x' , 'texture_y' , 'texture_format' , 'texture_quality' , 'split_budget' , 'polygon_budget' , 'vertex_budget' , 'chunk_polygons' , 'lod_levels' , 'rescale' , 'anim_export' , 'anim_tolerance' , 'skeleton_export' )
+
+    def __init__(self,dir_path,max_size=CACHE_SIZE) :
+        self.dir_path = dir_path
+        self.max_size = max_size
+        self.nb_hits = 0
+        self.nb_misses = 0
+        self.nb_evictions = 0
+        if not ( os.path.isdir(dir_path) ) :
+            os.makedirs(dir_path)
+
+    def __getstate__(self) :
+        return ( ( self.dir_path , self.max_size , self.nb_hits , self.nb_misses , self.nb_evictions ) )
+
+    def __setstate__(self,state) :
+        ( self.dir_path , self.max_size , self.nb_hits , self.nb_misses , self.nb_evictions ) = state
+
+    def get_key(self,options) :
+        source = options.mesh_data
+        key = hashlib.md5()
+        key.update( repr( [ self.VERSION ] + [ getattr(options , k) for k in self.KEY_OPTIONS ] ) )
+        co , no = source.get_vertices()
+        key.update( ascontiguousarray(co , float64).tostring() )
+        key.update( ascontiguousarray(no , float64).tostring() )
+        key.update( repr(source.get_faces()) )
+        key.update( repr(source.get_face_materials()) )
+        if (options.anim_export) :
+            for frame in source.get_frames() :
+                key.update( ascontiguousarray(frame , float64).tostring() )
+        skeleton = source.get_skeleton() if (options.skeleton_export) else None
+        if (skeleton != None) :
+            names , vertex_bones , frames = skeleton
+            key.update( repr( ( names , list(vertex_bones) ) ) )
+            for frame in frames :
+                key.update( ascontiguousarray(frame , float64).tostring() )
+        for texture in options.texture_data :
+            if (options.texfile_export and os.path.exists(source.get_texture_file(texture))) :
+                f = open(source.get_texture_file(texture) , "rb")
+                key.update( f.read() )
+                f.close()
+        return ( key.hexdigest() )
+
+    def get_path(self,key,i) :
+        return ( os.path.join(self.dir_path , "%s.%d" % (key , i)) )
+
+    def get_list_path(self,key) :
+        return ( os.path.join(self.dir_path , "%s.files" % (key)) )
+
+    def rename(self,tmp_path,path) :
+        try:
+            os.rename(tmp_path , path)
+        except OSError :
+            #already stored by another process
+            os.remove(tmp_path)
+
+    def remove(self,key,names=None) :
+        #removes the files of an entry, whatever is left of them
+        if (names == None) :
+            names = [ name for name in os.listdir(self.dir_path) if name.split(".")[0] == key and not name.endswith(".tmp") ]
+        for name in names :
+            try:
+                os.remove(os.path.join(self.dir_path , name))
+            except OSError :
+                continue
+
+    def load(self,key,options) :
+        #copies the cached files of the mesh, if all of them are there
+        try:
+            f = open(self.get_list_path(key) , "r")
+            indices = [ int(i) for i in f.read().split() ]
+            f.close()
+        except (IOError , ValueError) :
+            return ( False )
+        paths = options.get_final_paths()
+        if ( len( [ i for i in indices if i >= len(paths) or not os.path.exists(self.get_path(key , i)) ] ) > 0 ) :
+            self.remove(key)
+            return ( False )
+        try:
+            for i in indices :
+                shutil.copyfile(self.get_path(key , i) , paths[i])
+            #the modification time is what evict() looks at
+            for i in indices :
+                os.utime(self.get_path(key , i) , None)
+            os.utime(self.get_list_path(key) , None)
+        except (IOError , OSError) :
+            #evicted by another process meanwhile
+            return ( False )
+        return ( True )
+
+    def store(self,key,options) :
+        indices = []
+        for i , path in enumerate(options.get_final_paths()) :
+            if not ( os.path.exists(path) ) : continue
+            tmp_path = "%s.%d.tmp" % (self.get_path(key , i) , os.getpid())
+            shutil.copyfile(path , tmp_path)
+            self.rename(tmp_path , self.get_path(key , i))
+            indices.append(i)
+        #the list of the files comes last : the entry is complete
+        tmp_path = "%s.%d.tmp" % (self.get_list_path(key) , os.getpid())
+        f = open(tmp_path , "w")
+        f.write( " ".join( [ "%d" % i for i in indices ] ) )
+        f.close()
+        self.rename(tmp_path , self.get_list_path(key))
+
+    def evict(self) :
+        #(last use , size , file names) of each entry, the oldest ones being
+        #removed first
+        entries = {}
+        size = 0
+        now = time.time()
+        for name in os.listdir(self.dir_path) :
+            path = os.path.join(self.dir_path , name)
+            try:
+                st = os.stat(path)
+            except OSError :
+                continue
+            if (name.endswith(".tmp")) :
+                if (now - st.st_mtime > CACHE_TMP_AGE) :
+                    try:
+                        os.remove(path)
+                    except OSError :
+                        pass
+                continue
+            key = name.split(".")[0]
+            mtime , entry_size , names = entries.get(key , ( 0 , 0 , [] ))
+            entries[key] = ( max(mtime , st.st_mtime) , entry_size + st.st_size , names + [ name ] )
+            size += st.st_size
+        entries = [ ( mtime , entry_size , key , names ) for key , ( mtime , entry_size , names ) in entries.items() ]
+        entries.sort()
+        for mtime , entry_size , key , names in entries :
+            if (size <= self.max_size) : break
+            self.remove(key , names)
+            size -= entry_size
+            self.nb_evictions += 1
+        return ( size )
+
+    def __str__(self) :
+        return "Export cache %s : %d hits, %d misses, %d entries evicted" % (self.dir_path , self.nb_hits , self.nb_misses , self.nb_evictions)
+
+
+def _nds_export_job(job) :
+    #exports one mesh of a _nds_batch_export, in a process of the pool, under
+    #cProfile when profile is set
+    options , cache , profile = job
+    start_time = time.time()
+    cached = False
+    stats = None
+    try:
+        key = None
+        if (cache != None) :
+            key = cache.get_key(options)
+            cached = cache.load(key , options)
+        if not (cached) :
+            if (profile) :
+                import cProfile
+                profiler = cProfile.Profile()
+                nds_export = profiler.runcall(_nds_mesh , options)
+                profiler.runcall(nds_export.save)
+                profiler.dump_stats(options.get_final_path_profile())
+            else :
+                nds_export = _nds_mesh(options)
+                nds_export.save()
+            print nds_export
+            print nds_export.stats
+            stats = nds_export.stats.get_report()
+            if (key != None) : cache.store(key , options)
+    except (IOError , ValueError , MemoryError) , e :
+        return ( ( options.mesh_name , options.get_final_path_mesh() , 0 , time.time() - start_time , str(e) , cached , stats ) )
+
+    size = sum( [ os.path.getsize(path) for path in options.get_final_paths() if os.path.exists(path) ] )
+    return ( ( options.mesh_name , options.get_final_path_mesh() , size , time.time() - start_time , None , cached , stats ) )
+
+
+# a _nds_atlas packs the textures of a batch of meshes into shared pages, so the
+# meshes are drawn with fewer texture binds and less VRAM lost to padding.
+# The textures (at the size chosen for their mesh) are sorted by height and
+# packed in shelves into pages of up to max_size x max_size texels, each page
+# then shrunk to the smallest power of 2 holding its shelves. Meshes using the
+# same image at the same size share its place.
+# The texture coordinates of a mesh are moved to its place in the page (see
+# texture_x / texture_y), and the place of every mesh is written in a table :
+# Atlas.h, or Atlas.bin (a count, then per mesh a 16 bytes name and the page,
+# x, y, width and height in 16 bits words, padded to 28 bytes).
+# The meshes with texture coordinates out of [0,1] repeat their texture : they
+# keep it for themselves.
+class _nds_atlas (object) :
+    __slots__ = 'max_size' , 'meshes' , 'images' , 'places' , 'pages'
+
+    def __init__(self,mesh_options,max_size=ATLAS_SIZE) :
+        self.max_size = max_size
+        self.meshes = []
+        self.images = {}
+        self.places = {}
+        self.pages = []
+        for options in mesh_options :
+            if not (options.texfile_export and options.uv_export and len(options.texture_data) == 1) : continue
+            if not (self.in_unit_square(options.mesh_data)) :
+                print "Atlas : mesh %s repeats its texture, it keeps it" % options.mesh_name
+                continue
+            path = options.mesh_data.get_texture_file(options.texture_data[0])
+            key = ( path , options.texture_w , options.texture_h )
+            self.images[key] = path
+            self.meshes.append( (options , key) )
+
+    @staticmethod
+    def in_unit_square(source) :
+        uv = []
+        for index , face_uv , face_col in source.get_faces() :
+            if (face_uv != None) : uv += face_uv
+        uv = array(uv , float64).reshape(-1,2)
+        #corners without UV have negative ones
+        uv = uv[logical_and(uv[:,0] >= 0 , uv[:,1] >= 0)]
+        return ( len(uv) == 0 or uv.max() <= 1.0 )
+
+    def pack(self) :
+        #shelves of a page : [ y , height , used width ]
+        keys = self.images.keys()
+        keys.sort(key = lambda k : (-k[2] , -k[1]))
+        shelves = []
+        for key in keys :
+            w , h = key[1] , key[2]
+            place = None
+            for page , page_shelves in enumerate(shelves) :
+                for shelf in page_shelves :
+                    if (shelf[1] >= h and shelf[2] + w <= self.max_size) :
+                        place = ( page , shelf[2] , shelf[0] )
+                        shelf[2] += w
+                        break
+                if (place != None) : break
+                y = sum( [ shelf[1] for shelf in page_shelves ] )
+                if (y + h <= self.max_size) :
+                    page_shelves.append( [ y , h , w ] )
+                    place = ( page , 0 , y )
+                    break
+            if (place == None) :
+                shelves.append( [ [ 0 , h , w ] ] )
+                place = ( len(shelves) - 1 , 0 , 0 )
+            self.places[key] = place
+
+        self.pages = []
+        for page_shelves in shelves :
+            w = max( [ shelf[2] for shelf in page_shelves ] )
+            h = sum( [ shelf[1] for shelf in page_shelves ] )
+            size = [ 8 , 8 ]
+            while (size[0] < w) : size[0] *= 2
+            while (size[1] < h) : size[1] *= 2
+            self.pages.append( tuple(size) )
+
+    def apply(self) :
+        #the meshes draw with their page instead of their own texture
+        for options , key in self.meshes :
+            page , options.texture_x , options.texture_y = self.places[key]
+            options.texfile_export = 0
+
+    def get_final_path_page(self,options,page) :
+        if (options.texture_format == EXPORT_OPTIONS['TEXTURE_PCX']) :
+            return ( os.path.join(options.dir_path , "Atlas_%d.pcx" % page) )
+        return ( os.path.join(options.dir_path , "Atlas_%d%s" % (page , ".h" if (options.format) else ".tex")) )
+
+    def get_final_path_table(self,options) :
+        return ( os.path.join(options.dir_path , "Atlas" + (".h" if (options.format) else ".bin")) )
+
+    def save(self) :
+        #the pages and table use the settings of the first mesh
+        import PIL.Image
+        options = self.meshes[0][0]
+        for page , size in enumerate(self.pages) :
+            img = PIL.Image.new("RGBA" , size , (0 , 0 , 0 , 0))
+            for key , place in self.places.items() :
+                if (place[0] != page) : continue
+                texture = PIL.Image.open(self.images[key]).convert("RGBA").resize( (key[1] , key[2]) , PIL.Image.ANTIALIAS )
+                img.paste(texture , (place[1] , place[2]))
+            _nds_save_texture(img , size[0] , size[1] , options , self.get_final_path_page(options , page) , "Atlas_%d" % page)
+
+        f = open(self.get_final_path_table(options) , "wb")
+        if (options.format) :
+            f.write("/* page , x , y , width , height of the texture of each mesh */\n")
+            for mesh_options , key in self.meshes :
+                f.write("u16 Atlas_%s[] = { %d , %d , %d , %d , %d };\n" % ((mesh_options.mesh_name ,) + self.places[key] + key[1:]))
+        else :
+            f.write(pack('<i' , len(self.meshes)))
+            for mesh_options , key in self.meshes :
+                f.write(pack('<16s6H' , mesh_options.mesh_name[:16] , *(self.places[key] + key[1:] + (0 ,))))
+        f.close()
+
+    def get_fill(self) :
+        used = sum( [ key[1] * key[2] for key in self.places.keys() ] )
+        return ( float(used) / max( sum( [ w * h for w , h in self.pages ] ) , 1 ) )
+
+    def __str__(self) :
+        return "Atlas : %d textures of %d meshes in %d pages (%s), %.1f%% used" % (len(self.places) , len(self.meshes) , len(self.pages) , " , ".join( [ "%dx%d" % size for size in self.pages ] ) , 100.0 * self.get_fill())
+
+
+# a _nds_batch_export exports a list of meshes. The meshes are first copied
+# into _mesh_snapshots, then encoded and saved by a pool of processes (one per
+# processor by default). Blender itself cannot be forked outside of posix
+# systems : there, and with a single process, the meshes are exported in turn.
+# With an _nds_atlas, the textures are packed and saved before. With profile,
+# each mesh is exported under cProfile, its profile saved to <mesh>.prof.
+class _nds_batch_export (object) :
+    __slots__ = 'mesh_options' , 'nb_processes' , 'cache' , 'atlas' , 'profile' , 'results' , 'extract_time' , 'elapsed'
+
+    def __init__(self,mesh_options,nb_processes=0,cache=None,atlas=None,profile=False) :
+        self.mesh_options = mesh_options
+        self.nb_processes = nb_processes
+        self.cache = cache
+        self.atlas = atlas
+        self.profile = profile
+        self.results = []
+        self.extract_time = 0
+        self.elapsed = 0
+        if (self.nb_processes <= 0) :
+            try:
+                import multiprocessing
+                self.nb_processes = multiprocessing.cpu_count()
+            except (ImportError , NotImplementedError) :
+                self.nb_processes = 1
+        self.nb_processes = max( min(self.nb_processes , len(mesh_options)) , 1 )
+        if (Blender != None and os.name != 'posix') :
+            self.nb_processes = 1
+
+    def run(self) :
+        start_time = time.time()
+        if (self.atlas != None and len(self.atlas.meshes) > 0) :
+            try:
+                import PIL.Image
+            except ImportError :
+                print "Python Imaging Library not installed : no atlas"
+                self.atlas = None
+            else :
+                self.atlas.pack()
+                self.atlas.apply()
+                self.atlas.save()
+        if (self.nb_processes > 1) :
+            jobs = [ (options.get_snapshot() , self.cache , self.profile) for options in self.mesh_options ]
+        else :
+            jobs = [ (options , self.cache , self.profile) for options in self.mesh_options ]
+        self.extract_time = time.time() - start_time
+
+        if (self.nb_processes > 1) :
+            import multiprocessing
+            pool = multiprocessing.Pool(self.nb_processes)
+            try:
+                self.results = pool.map(_nds_export_job , jobs , 1)
+            finally:
+                pool.close()
+                pool.join()
+        else :
+            self.results = [ _nds_export_job(job) for job in jobs ]
+        if (self.cache != None) :
+            self.cache.nb_hits += len( [ r for r in self.results if r[5] ] )
+            self.cache.nb_misses += len( [ r for r in self.results if not r[5] ] )
+            self.cache.evict()
+        self.elapsed = max(time.time() - start_time , 1e-6)
+        return ( self.get_nb_errors() )
+
+    def get_nb_errors(self) :
+        return ( len( [ r for r in self.results if r[4] != None ] ) )
+
+    def get_size(self) :
+        return ( sum( [ r[2] for r in self.results ] ) )
+
+    def save_stats(self,path) :
+        #the _nds_export_stats of the exported meshes (not the cached ones) as JSON
+        import json
+        f = open(path , "w")
+        json.dump( { 'version' : 1 , 'meshes' : [ r[6] for r in self.results if r[6] != None ] } , f , indent=1 , sort_keys=True )
+        f.close()
+
+    def __str__(self) :
+        lines = []
+        for name , path , size , elapsed , error , cached , stats in self.results :
+            if (error != None) :
+                lines.append( "  %-24s FAILED : %s" % (name , error) )
+            else :
+                lines.append( "  %-24s %10d bytes in %.3fs -> %s%s" % (name , size , elapsed , path , " (cached)" if (cached) else "") )
+        if (self.cache != None) :
+            lines.append( str(self.cache) )
+        if (self.atlas != None) :
+            lines.append( str(self.atlas) )
+        lines.append( "Batch export : %d meshes (%d failed) in %.3fs with %d processes (extraction %.3fs) : %.2f meshes/s , %.2f MB/s" % (len(self.results) , self.get_nb_errors() , self.elapsed , self.nb_processes , self.extract_time , len(self.results) / self.elapsed , self.get_size() / (1024.0 * 1024.0) / self.elapsed) )
+        return ( "\n".join(lines) )
+
+
+def get_peak_memory() :
+    #peak memory (in bytes) of the process, 0 where it cannot be known
+    try:
+        import resource
+    except ImportError :
+        return ( 0 )
+    return ( resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 )
+
+
+def _nds_benchmark_job(case) :
+    #exports one synthetic mesh of a _nds_benchmark, quietly, and measures it
+    kind , nb_faces , dir_path = case
+    stdout = pysys.stdout
+    pysys.stdout = open(os.devnull , "w")
+    try:
+        start_time = time.time()
+        source = _synthetic_mesh_source(kind , nb_faces)
+        generate_time = time.time() - start_time
+        start_time = time.time()
+        options = _mesh_options(source , dir_path)
+        #UVs scaled as for a 128x128 texture, though there is none
+        if (source.has_uv()) : options.texture_w , options.texture_h = 128 , 128
+        options_time = time.time() - start_time
+        mesh = _nds_mesh(options)
+        mesh.save()
+    finally:
+        pysys.stdout.close()
+        pysys.stdout = stdout
+
+    #bytes of the unoptimized list, of the optimized list, of the final list
+    #and of all the files
+    size = sum( [ os.path.getsize(path) for path in options.get_final_paths() if os.path.exists(path) ] )
+    stage_bytes = { 'extraction' : int(mesh.get_corner_cost().sum()) ,
+                    'prepare_cmdpack' : 4 * sum( [ s[2] for s in mesh.sublists ] ) ,
+                    'construct_cmdpack' : len(mesh.final_cmdpack) ,
+                    'save' : size ,
+                    'save_tex' : 0 }
+    nb_triangles = max(len(mesh.quads) / 2 + len(mesh.triangles) / 3 , 1)
+    stages = []
+    for stage , seconds , peak in mesh.stats.stages :
+        if (stage == 'extraction') : seconds += options_time
+        stages.append( { 'stage' : stage , 'time' : seconds , 'peak_memory' : peak , 'bytes' : stage_bytes[stage] , 'bytes_per_triangle' : stage_bytes[stage] / float(nb_triangles) } )
+    return ( { 'kind' : kind , 'faces' : len(source.faces) , 'triangles' : nb_triangles , 'generate_time' : generate_time ,
+               'peak_memory' : get_peak_memory() , 'output_bytes' : size , 'bytes_per_triangle' : size / float(nb_triangles) , 'stages' : stages } )
+
+
+# a _nds_benchmark exports synthetic meshes of every kind and size, each run in
+# its own process (when it can) so the peak memory measured is its own, and
+# records the time, peak memory and bytes of each stage of the export, the best
+# of several runs. The results are saved as JSON, and compared with those of a
+# baseline : a stage slower, bigger or using more memory than the baseline by
+# more than the threshold fails.
+class _nds_benchmark (object) :
+    __slots__ = 'cases' , 'results' , 'nb_runs'
+
+    def __init__(self,kinds=BENCH_KINDS,sizes=BENCH_SIZES,dir_path=".",nb_runs=BENCH_RUNS) :
+        self.cases = [ ( kind , nb_faces , dir_path ) for nb_faces in sizes for kind in kinds ]
+        self.results = []
+        self.nb_runs = max(nb_runs , 1)
+
+    def run(self) :
+        for case in self.cases :
+            runs = []
+            for i in range(self.nb_runs) :
+                try:
+                    import multiprocessing
+                    pool = multiprocessing.Pool(1)
+                except (ImportError , OSError) :
+                    runs.append( _nds_benchmark_job(case) )
+                else :
+                    try:
+                        runs.append( pool.apply(_nds_benchmark_job , (case , )) )
+                    finally:
+                        pool.close()
+                        pool.join()
+            self.results.append( self.get_best(runs) )
+            print self.get_lines(self.results[-1])
+
+    def get_best(self,runs) :
+        #one wall clock sample is too noisy to be compared : the result of the
+        #first run, with the fastest time and smallest peak memory of each stage
+        #over all the runs (the bytes are the same in every run)
+        result = runs[0]
+        result['runs'] = len(runs)
+        result['generate_time'] = min( [ run['generate_time'] for run in runs ] )
+        result['peak_memory'] = min( [ run['peak_memory'] for run in runs ] )
+        for i , stage in enumerate(result['stages']) :
+            stage['time'] = min( [ run['stages'][i]['time'] for run in runs ] )
+            stage['peak_memory'] = min( [ run['stages'][i]['peak_memory'] for run in runs ] )
+        return ( result )
+
+    def save(self,path) :
+        import json
+        f = open(path , "w")
+        json.dump( { 'version' : 1 , 'results' : self.results } , f , indent=1 , sort_keys=True )
+        f.close()
+
+    def compare(self,path,threshold=BENCH_THRESHOLD,min_time=BENCH_MIN_TIME) :
+        #the regressions against the results saved in path
+        import json
+        f = open(path , "r")
+        baseline = json.load(f)['results']
+        f.close()
+        base_stages = {}
+        for result in baseline :
+            for stage in result['stages'] :
+                base_stages[ ( result['kind'] , result['faces'] , stage['stage'] ) ] = stage
+
+        regressions = []
+        for result in self.results :
+            for stage in result['stages'] :
+                base = base_stages.get( ( result['kind'] , result['faces'] , stage['stage'] ) )
+                if (base == None) : continue
+                name = "%s %d faces %s" % (result['kind'] , result['faces'] , stage['stage'])
+                if (stage['time'] > max(base['time'] , min_time) * (1 + threshold)) :
+                    regressions.append( "%s : %.3fs, %.3fs in the baseline" % (name , stage['time'] , base['time']) )
+                if (stage['bytes'] > base['bytes'] * (1 + threshold)) :
+                    regressions.append( "%s : %d bytes, %d in the baseline" % (name , stage['bytes'] , base['bytes']) )
+                if (base['peak_memory'] > 0 and stage['peak_memory'] > base['peak_memory'] * (1 + threshold)) :
+                    regressions.append( "%s : %.1f MB peak, %.1f MB in the baseline" % (name , stage['peak_memory'] / 1048576.0 , base['peak_memory'] / 1048576.0) )
+        return ( regressions )
+
+    def get_lines(self,result) :
+        lines = [ "%-10s %8d faces %8d triangles : %10d bytes (%.2f bytes/triangle), %.1f MB peak (generated in %.3fs)" % (result['kind'] , result['faces'] , result['triangles'] , result['output_bytes'] , result['bytes_per_triangle'] , result['peak_memory'] / 1048576.0 , result['generate_time']) ]
+        for stage in result['stages'] :
+            lines.append( "    %-18s %8.3fs %8.1f MB peak %10d bytes %6.2f bytes/triangle" % (stage['stage'] , stage['time'] , stage['peak_memory'] / 1048576.0 , stage['bytes'] , stage['bytes_per_triangle']) )
+        return ( "\n".join(lines) )
+
+    def __str__(self) :
+        return ( "Benchmark : %d meshes, %.3fs exporting %d triangles" % (len(self.results) , sum( [ stage['time'] for result in self.results for stage in result['stages'] ] ) , sum( [ result['triangles'] for result in self.results ] )) )
 
 
 class _menu_nds_export (object) :
-    __slots__ = 'nb_meshes', 'mesh_options','selected_menu_mesh','popup_elm','button' , 'texID'
+    __slots__ = 'nb_meshes', 'mesh_options','selected_menu_mesh','popup_elm','button' , 'texID' , 'dir_path' , 'cache_export' , 'atlas_export'
 
     def __init__(self,dir_path):
+        self.dir_path = dir_path
+        self.cache_export = 0 #Do we reuse the files of the meshes exported before ? 0->No, 1->Yes
+        self.atlas_export = 0 #Do we pack the textures of the meshes into atlas pages ? 0->No, 1->Yes
         self.nds_list_meshes(dir_path)
 
     def nds_list_meshes(self,dir_path) :
@@ -668,13 +4673,30 @@ class _menu_nds_export (object) :
         objects = Blender.Object.GetSelected()
 
         self.nb_meshes = 0
-        self.mesh_options = []
+        self.mesh_options = self.get_mesh_options(objects,dir_path)
+        self.nb_meshes = len(self.mesh_options)
+
+        self.button = {}
+
+    def get_mesh_options(self,objects,dir_path) :
+        mesh_options = []
         for cur_obj in objects :
             if (cur_obj.getType()=="Mesh") :
-                self.mesh_options.append( _mesh_options( cur_obj.getData(name_only=False,mesh=True) , dir_path) )
-                self.nb_meshes += 1
-
-        button = []
+                mesh_options.append( _mesh_options( _blender_mesh_source(cur_obj.getData(name_only=False,mesh=True) , cur_obj) , dir_path) )
+        return ( mesh_options )
+
+    def nds_batch_export(self,mesh_options) :
+        #every mesh is exported with the settings shown for the first one
+        for options in mesh_options :
+            if (options is not self.mesh_options[0]) :
+                options.apply_settings(self.mesh_options[0])
+        cache = None
+        if (self.cache_export) : cache = _nds_export_cache(os.path.join(self.dir_path , ".nds_cache"))
+        atlas = None
+        if (self.atlas_export) : atlas = _nds_atlas(mesh_options)
+        batch = _nds_batch_export(mesh_options , 0 , cache , atlas)
+        batch.run()
+        print batch
 
 
     def _menu_meshes_select(self,event, val) :
@@ -688,7 +4710,7 @@ class _menu_nds_export (object) :
         glClear(GL_COLOR_BUFFER_BIT)
         glColor3f(0,0,0)
         glRasterPos2d(5, 200 + 15 )
-        Draw.Text( "Mesh to export : %s" % (self.mesh_options[0].mesh_name) )
+        Draw.Text( "Mesh to export : %s (%d selected)" % (self.mesh_options[0].mesh_name , self.nb_meshes) )
         glRasterPos2d(5, 200 + 15 -15)
         Draw.Text( "Save Format : %s" % ("C-Style Format" if (self.mesh_options[0].format) else "NDS Binary CallList" ) )
         glRasterPos2d(5, 200 + 15 -30)
@@ -702,11 +4724,29 @@ class _menu_nds_export (object) :
             Draw.Text( "No Texture export" )
 
         Draw.PushButton("GO!! Export!!" , 99 , 5 , 200 + 15 - 75 ,128, 20)
+        Draw.PushButton("Export selected" , 98 , 5 + 128 + 5 , 200 + 15 - 75 ,128, 20 , "Export all the selected meshes with these settings")
+        Draw.PushButton("Export scene" , 97 , 5 + 128 + 5 + 128 + 5 , 200 + 15 - 75 ,128, 20 , "Export all the meshes of the scene with these settings")
 
         Draw.Toggle( "C-Style File"   , 1 , 5 , 5 + 0  + 2 , 128 , 20 , self.mesh_options[0].format)
         Draw.Toggle( "Texture"        , 2 , 5 , 5 + 20 + 4 , 128 , 20 , self.mesh_options[0].uv_export )
         Draw.Toggle( "Normals"        , 3 , 5 , 5 + 40 + 6 , 128 , 20 , self.mesh_options[0].normals_export)
         Draw.Toggle( "Colors "        , 4 , 5 , 5 + 60 + 8 , 128 , 20 , self.mesh_options[0].color_export)
+        Draw.Toggle( "Streaming"      , 5 , 5 , 5 + 80 + 10 , 128 , 20 , self.mesh_options[0].stream_export)
+        Draw.Toggle( "State filter"   , 6 , 5 , 5 + 100 + 12 , 128 , 20 , self.mesh_options[0].state_filter)
+        Draw.Toggle( "Compact vertices" , 7 , 360 , 5 + 0 + 2 , 128 , 20 , self.mesh_options[0].compact_vertices)
+        self.button['tolerance'] = Draw.Number( "Tolerance: " , 8 , 360 , 5 + 20 + 4 , 128 , 20 , self.mesh_options[0].vertex_tolerance , 0 , 32 , "How far (in 1/4096 units) a vertex may move to fit in a FIFO_VERTEX10" )
+        Draw.Toggle( "Strips"         , 9 , 360 , 5 + 40 + 6 , 128 , 20 , self.mesh_options[0].strips)
+        Draw.Toggle( "Cache"          , 15 , 360 , 5 + 60 + 8 , 128 , 20 , self.cache_export , "Reuse the files of the meshes exported before with the same settings")
+        Draw.Toggle( "Atlas"          , 18 , 360 + 128 + 5 , 5 + 0 + 2 , 128 , 20 , self.atlas_export , "Pack the textures of the exported meshes into shared pages")
+        self.button['split_budget'] = Draw.Menu( "Split %t|No split %x0|Split over budget %x1|Split in chunks %x2" , 19 , 360 + 128 + 5 , 5 + 20 + 4 , 128 , 20 , self.mesh_options[0].split_budget , "Split the meshes (over the polygon / vertex budget) into chunks")
+        self.button['chunk_polygons'] = Draw.Number( "Chunk: " , 25 , 360 + 128 + 5 , 5 + 40 + 6 , 128 , 20 , self.mesh_options[0].chunk_polygons , 16 , max(self.mesh_options[0].polygon_budget , 16) , "Largest number of faces of a chunk" )
+        Draw.Toggle( "Rescale"        , 27 , 360 + 128 + 5 , 5 + 80 + 10 , 128 , 20 , self.mesh_options[0].rescale , "Scale the vertices to the whole v16 range, with a scale header")
+        self.button['lod_levels'] = Draw.Number( "LOD: " , 26 , 360 + 128 + 5 , 5 + 60 + 8 , 128 , 20 , self.mesh_options[0].lod_levels , 1 , LOD_LEVELS , "Number of levels of detail, decimated from the mesh" )
+        Draw.Toggle( "Animation"      , 28 , 360 + 128 + 5 , 5 + 100 + 12 , 128 , 20 , self.mesh_options[0].anim_export , "Export the shape keys of the mesh as keyframe deltas")
+        Draw.Toggle( "Skeleton"       , 29 , 360 + 2 * (128 + 5) , 5 + 0 + 2 , 128 , 20 , self.mesh_options[0].skeleton_export , "Skin the mesh with the matrix stack and export the bone tracks of its armature")
+        Draw.Toggle( "Pack schedule"  , 30 , 360 + 2 * (128 + 5) , 5 + 20 + 4 , 128 , 20 , self.mesh_options[0].pack_schedule , "Drop the FIFO_END commands that would make a list end on a padded pack")
+        self.button['texture_format'] = Draw.Menu( "Texture format %t|PCX file %x0|Auto (smallest) %x255|GL_RGB4 (4 colors) %x2|GL_RGB16 (16 colors) %x3|GL_RGB256 (256 colors) %x4|GL_COMPRESSED (4x4 blocks) %x5|GL_RGB32_A3 %x1|GL_RGB8_A5 %x6|GL_RGBA (direct) %x7" , 16 , 360 , 5 + 80 + 10 , 128 , 20 , self.mesh_options[0].texture_format , "Format of the exported texture")
+        self.button['texture_quality'] = Draw.Number( "PSNR: " , 17 , 360 , 5 + 100 + 12 , 128 , 20 , self.mesh_options[0].texture_quality , 10 , 60 , "Lowest quality (in dB) of an Auto texture" )
 
 
         glBegin(GL_LINE_LOOP)
@@ -724,7 +4764,7 @@ class _menu_nds_export (object) :
 
         self.texID = 0
         
-        if (self.mesh_options[0].mesh_data.faceUV) :
+        if (self.mesh_options[0].mesh_data.has_uv()) :
             if (self.mesh_options[0].uv_export ) :
                 if (len(self.mesh_options[0].texture_data) > 0) :
                     img = self.mesh_options[0].texture_data[0]
@@ -781,6 +4821,11 @@ class _menu_nds_export (object) :
         elif evt==2 : self.mesh_options[0].uv_export = 1 - self.mesh_options[0].uv_export
         elif evt==3 : self.mesh_options[0].normals_export = 1 - self.mesh_options[0].normals_export
         elif evt==4 : self.mesh_options[0].color_export = 1 - self.mesh_options[0].color_export
+        elif evt==5 : self.mesh_options[0].stream_export = 1 - self.mesh_options[0].stream_export
+        elif evt==6 : self.mesh_options[0].state_filter = 1 - self.mesh_options[0].state_filter
+        elif evt==7 : self.mesh_options[0].compact_vertices = 1 - self.mesh_options[0].compact_vertices
+        elif evt==8 : self.mesh_options[0].vertex_tolerance = self.button['tolerance'].val
+        elif evt==9 : self.mesh_options[0].strips = 1 - self.mesh_options[0].strips
         elif evt==10 : self.mesh_options[0].texture_w = 128
         elif evt==11 : self.mesh_options[0].texture_w = 64
         elif evt==12 : self.mesh_options[0].texture_w = 32
@@ -791,12 +4836,32 @@ class _menu_nds_export (object) :
         elif evt==22 : self.mesh_options[0].texture_h = 32
         elif evt==23 : self.mesh_options[0].texture_h = 16
         elif evt==24 : self.mesh_options[0].texture_h = 8
+        elif evt==15 : self.cache_export = 1 - self.cache_export
+        elif evt==18 : self.atlas_export = 1 - self.atlas_export
+        elif evt==19 : self.mesh_options[0].split_budget = self.button['split_budget'].val
+        elif evt==25 : self.mesh_options[0].chunk_polygons = self.button['chunk_polygons'].val
+        elif evt==26 : self.mesh_options[0].lod_levels = self.button['lod_levels'].val
+        elif evt==27 : self.mesh_options[0].rescale = 1 - self.mesh_options[0].rescale
+        elif evt==28 : self.mesh_options[0].anim_export = 1 - self.mesh_options[0].anim_export
+        elif evt==29 : self.mesh_options[0].skeleton_export = 1 - self.mesh_options[0].skeleton_export
+        elif evt==30 : self.mesh_options[0].pack_schedule = 1 - self.mesh_options[0].pack_schedule
+        elif evt==16 : self.mesh_options[0].texture_format = self.button['texture_format'].val
+        elif evt==17 : self.mesh_options[0].texture_quality = self.button['texture_quality'].val
         elif evt==99 :
-            nds_export = _nds_mesh(self.mesh_options[0])
-            nds_export.save()
-            print nds_export
+            self.nds_batch_export( [ self.mesh_options[0] ] )
             Draw.Exit()                 # exit when user presses ESC
             return
+        elif evt==98 :
+            self.nds_batch_export(self.mesh_options)
+            Draw.Exit()
+            return
+        elif evt==97 :
+            scene = Blender.Scene.GetCurrent()
+            selected = [ cur_obj.name for cur_obj in Blender.Object.GetSelected() ]
+            objects = [ cur_obj for cur_obj in scene.objects if not ( cur_obj.name in selected ) ]
+            self.nds_batch_export(self.mesh_options + self.get_mesh_options(objects,self.dir_path))
+            Draw.Exit()
+            return
         Draw.Redraw(1)
 
 def DSexport(dir_path):
@@ -824,5 +4889,283 @@ def my_callback(filename):
     DSexport(Blender.sys.dirname(filename))
 
 
-fname = Blender.sys.makename(ext = "")
-Blender.Window.FileSelector(my_callback, "Select a directory","")
+CLI_TEXTURE_FORMATS = {
+    'pcx'    : EXPORT_OPTIONS['TEXTURE_PCX'] ,
+    'auto'   : EXPORT_OPTIONS['TEXTURE_AUTO'] ,
+    '4'      : GL_TEXTURE_TYPE_ENUM['GL_RGB4'] ,
+    '16'     : GL_TEXTURE_TYPE_ENUM['GL_RGB16'] ,
+    '256'    : GL_TEXTURE_TYPE_ENUM['GL_RGB256'] ,
+    '4x4'    : GL_TEXTURE_TYPE_ENUM['GL_COMPRESSED'] ,
+    'a3i5'   : GL_TEXTURE_TYPE_ENUM['GL_RGB32_A3'] ,
+    'a5i3'   : GL_TEXTURE_TYPE_ENUM['GL_RGB8_A5'] ,
+    'direct' : GL_TEXTURE_TYPE_ENUM['GL_RGBA']
+}
+
+def check_lists(paths, cli_options):
+    #read the lists of exported .bin files, and estimate their cost
+    errors = 0
+    for path in paths :
+        start_time = time.time()
+        try:
+            reader = _nds_cmdlist_reader(path , 4 if (cli_options.rescale) else 0)
+        except IOError , e :
+            print "Problem : cannot read %s (%s)" % (path , e)
+            errors += 1
+            continue
+        budget = _nds_budget(cli_options.polygon_budget , cli_options.vertex_budget)
+        model = _nds_cost_model()
+        for i , ( offset , ops , starts ) in enumerate(reader.lists) :
+            for mode , nb_vertices in reader.get_primitives(i) :
+                budget.add(GL_GLBEGIN_NAMES[mode] , nb_vertices)
+            budget.end_list()
+            model.run(offset , ops , starts)
+        nb_polygons , nb_vertices = budget.get_total()
+        print "%s : %d lists, %d polygons, %d vertices, %s (checked in %.3fs)" % (path , len(reader.lists) , nb_polygons , nb_vertices , model , time.time() - start_time)
+        if (cli_options.cycle_budget > 0 and model.get_total() > cli_options.cycle_budget) :
+            reader.errors.append( "%d geometry cycles over the budget of %d" % (model.get_total() - cli_options.cycle_budget , cli_options.cycle_budget) )
+        for error in reader.errors :
+            print "!!!Error : %s : %s!!!" % (path , error)
+        if (len(reader.errors) > 0) : errors += 1
+    return ( 1 if (errors) else 0 )
+
+
+def verify_lists(cli_options):
+    #export synthetic meshes without the passes the first exporter did not
+    #have, and compare their files with the ones of the reference encoder
+    import tempfile
+    dir_path = tempfile.mkdtemp(prefix="nds_verify")
+    errors = 0
+    try:
+        for kind in VERIFY_KINDS :
+            for format , stream in ( ( EXPORT_OPTIONS['FORMAT_BINARY'] , 0 ) , ( EXPORT_OPTIONS['FORMAT_BINARY'] , 1 ) , ( EXPORT_OPTIONS['FORMAT_TEXT'] , 0 ) ) :
+                options = _mesh_options( _synthetic_mesh_source(kind , VERIFY_FACES) , dir_path )
+                options.format = format
+                options.texture_w , options.texture_h = VERIFY_TEXTURE
+                if (stream) : options.stream_export = EXPORT_OPTIONS['STREAM']
+                options.state_filter = EXPORT_OPTIONS['NO_STATE_FILTER']
+                options.compact_vertices = EXPORT_OPTIONS['NO_COMPACT_VERTICES']
+                options.pack_schedule = EXPORT_OPTIONS['NO_PACK_SCHEDULE']
+                options.strips = EXPORT_OPTIONS['NO_STRIPS']
+                nds_export = _nds_mesh(options)
+                nds_export.save()
+                f = open(options.get_final_path_mesh() , "rb")
+                data = f.read()
+                f.close()
+                expected = _nds_reference_list(options).get_bytes()
+                name = "%s%s" % (os.path.basename(options.get_final_path_mesh()) , " (streamed)" if (stream) else "")
+                if (data == expected) :
+                    print "%s : %d bytes, the same as the reference encoder" % (name , len(data))
+                    continue
+                offset = min( [ i for i in range(min(len(data) , len(expected))) if data[i] != expected[i] ] + [ min(len(data) , len(expected)) ] )
+                print "!!!Error : %s : %d bytes, %d with the reference encoder, first difference at byte %d!!!" % (name , len(data) , len(expected) , offset)
+                errors += 1
+    finally:
+        shutil.rmtree(dir_path , True)
+    return ( 1 if (errors) else 0 )
+
+
+def run_benchmark(cli_options):
+    #export the synthetic meshes, save the results and compare them with the baseline
+    try:
+        kinds = [ kind for kind in cli_options.bench_kinds.split(",") if kind != '' ]
+        sizes = [ int(size) for size in cli_options.bench_sizes.split(",") if size != '' ]
+    except ValueError , e :
+        print "Problem : bad benchmark sizes (%s)" % e
+        return ( 1 )
+    for kind in kinds :
+        if not (kind in BENCH_KINDS) :
+            print "Problem : unknown synthetic mesh %s (%s)" % (kind , ", ".join(BENCH_KINDS))
+            return ( 1 )
+
+    dir_path = cli_options.dir_path
+    if (dir_path == None) :
+        import tempfile
+        dir_path = tempfile.mkdtemp(prefix="nds_bench")
+    elif not (os.path.isdir(dir_path)) :
+        os.makedirs(dir_path)
+    benchmark = _nds_benchmark(kinds , sizes , dir_path , cli_options.bench_runs)
+    try:
+        benchmark.run()
+    finally:
+        if (cli_options.dir_path == None) : shutil.rmtree(dir_path , True)
+    print benchmark
+    benchmark.save(cli_options.bench_path)
+    print "Results saved to %s" % cli_options.bench_path
+
+    if (cli_options.bench_baseline != None) :
+        regressions = benchmark.compare(cli_options.bench_baseline , cli_options.bench_threshold)
+        for regression in regressions :
+            print "!!!Regression : %s!!!" % regression
+        print "%d regressions over %d%% against %s" % (len(regressions) , cli_options.bench_threshold * 100 , cli_options.bench_baseline)
+        if (len(regressions) > 0) : return ( 1 )
+    return ( 0 )
+
+
+def get_obj_options(path, cli_options, frames=()):
+    mesh_options = _mesh_options( _obj_mesh_source(path , frames) , cli_options.dir_path or os.path.dirname(path) )
+
+    mesh_options.format = cli_options.format
+    #an option only turns off what the mesh has
+    if not (cli_options.uv_export) : mesh_options.uv_export = EXPORT_OPTIONS['NO_TEXCOORDS']
+    if not (cli_options.normals_export) : mesh_options.normals_export = EXPORT_OPTIONS['NO_NORMALS']
+    if not (cli_options.color_export) : mesh_options.color_export = EXPORT_OPTIONS['NO_COLORS']
+    if (cli_options.texfile_export and len(mesh_options.texture_data) > 0) : mesh_options.texfile_export = 1
+    mesh_options.texture_format = CLI_TEXTURE_FORMATS[cli_options.texture_format]
+    mesh_options.texture_quality = cli_options.texture_quality
+    if (cli_options.stream_export) : mesh_options.stream_export = EXPORT_OPTIONS['STREAM']
+    if not (cli_options.state_filter) : mesh_options.state_filter = EXPORT_OPTIONS['NO_STATE_FILTER']
+    if not (cli_options.compact_vertices) : mesh_options.compact_vertices = EXPORT_OPTIONS['NO_COMPACT_VERTICES']
+    mesh_options.vertex_tolerance = cli_options.vertex_tolerance
+    if not (cli_options.pack_schedule) : mesh_options.pack_schedule = EXPORT_OPTIONS['NO_PACK_SCHEDULE']
+    if not (cli_options.strips) : mesh_options.strips = EXPORT_OPTIONS['NO_STRIPS']
+    mesh_options.split_budget = cli_options.split_budget
+    mesh_options.polygon_budget = cli_options.polygon_budget
+    mesh_options.vertex_budget = cli_options.vertex_budget
+    mesh_options.chunk_polygons = cli_options.chunk_polygons
+    mesh_options.lod_levels = max(1 , min(cli_options.lod_levels , LOD_LEVELS))
+    if (cli_options.rescale) : mesh_options.rescale = EXPORT_OPTIONS['RESCALE']
+    mesh_options.anim_tolerance = cli_options.anim_tolerance
+    return ( mesh_options )
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options] mesh.obj [mesh.obj ...]",
+                                   description="Export Wavefront OBJ meshes in Nintendo DS CallLists.")
+    parser.add_option("-o", "--output", dest="dir_path", default=None,
+                      help="directory of the exported files (default : next to each mesh)")
+    parser.add_option("-j", "--jobs", dest="nb_processes", type="int", default=0,
+                      help="number of processes exporting the meshes (default : one per processor)")
+    parser.add_option("--cache", dest="cache_path", default=None,
+                      help="reuse the files of the meshes exported before, kept in this directory")
+    parser.add_option("--cache-size", dest="cache_size", type="int", default=CACHE_SIZE / (1024 * 1024),
+                      help="size of the cache in MB (default : %default)")
+    parser.add_option("-t", "--text", dest="format", action="store_const", const=EXPORT_OPTIONS['FORMAT_TEXT'], default=EXPORT_OPTIONS['FORMAT_BINARY'],
+                      help="export C-Style .h files instead of .bin files")
+    parser.add_option("--no-uv", dest="uv_export", action="store_false", default=True,
+                      help="do not export the UV coordinates")
+    parser.add_option("--no-normals", dest="normals_export", action="store_false", default=True,
+                      help="do not export the normals")
+    parser.add_option("--no-colors", dest="color_export", action="store_false", default=True,
+                      help="do not export the vertex colors")
+    parser.add_option("--texture", dest="texfile_export", action="store_true", default=False,
+                      help="also export the texture in a .pcx file")
+    parser.add_option("--texture-format", dest="texture_format", default="pcx", choices=CLI_TEXTURE_FORMATS.keys(),
+                      help="format of the texture : pcx, auto (the smallest one within --texture-quality), 4, 16, 256, 4x4, a3i5, a5i3 or direct (default : %default)")
+    parser.add_option("--texture-quality", dest="texture_quality", type="float", default=TEXTURE_QUALITY,
+                      help="lowest PSNR (in dB) of an auto texture (default : %default)")
+    parser.add_option("--atlas", dest="atlas_size", action="store_const", const=ATLAS_SIZE, default=0,
+                      help="pack the textures of the meshes into shared pages (with --texture)")
+    parser.add_option("--atlas-size", dest="atlas_size", type="int",
+                      help="largest atlas page, in texels (default : %d)" % ATLAS_SIZE)
+    parser.add_option("--stream", dest="stream_export", action="store_true", default=False,
+                      help="write the lists while they are built instead of holding them in memory (the faces and vertices of the meshes still are)")
+    parser.add_option("--no-state-filter", dest="state_filter", action="store_false", default=True,
+                      help="keep the attributes commands that repeat the current state")
+    parser.add_option("--no-compact-vertices", dest="compact_vertices", action="store_false", default=True,
+                      help="only use FIFO_VERTEX16 commands")
+    parser.add_option("--tolerance", dest="vertex_tolerance", type="int", default=0,
+                      help="how far (in 1/4096 units) a vertex may move to fit in a FIFO_VERTEX10")
+    parser.add_option("--no-pack-schedule", dest="pack_schedule", action="store_false", default=True,
+                      help="keep the FIFO_END commands that make the lists end on a padded pack")
+    parser.add_option("--no-strips", dest="strips", action="store_false", default=True,
+                      help="do not link the faces into strips")
+    parser.add_option("--polygon-budget", dest="polygon_budget", type="int", default=POLYGON_BUDGET,
+                      help="polygons a mesh may use, warned about when over (default : %default)")
+    parser.add_option("--vertex-budget", dest="vertex_budget", type="int", default=VERTEX_BUDGET,
+                      help="vertices a mesh may use, warned about when over (default : %default)")
+    parser.add_option("--split", dest="split_budget", action="store_const", const=EXPORT_OPTIONS['SPLIT'], default=EXPORT_OPTIONS['NO_SPLIT'],
+                      help="split the meshes over the budget into chunks, each with its own list and bounding box")
+    parser.add_option("--chunks", dest="split_budget", action="store_const", const=EXPORT_OPTIONS['SPLIT_ALWAYS'],
+                      help="split every mesh into chunks, for culling them on the device")
+    parser.add_option("--chunk-polygons", dest="chunk_polygons", type="int", default=CHUNK_POLYGONS,
+                      help="largest number of faces of a chunk (default : %default)")
+    parser.add_option("--rescale", dest="rescale", action="store_true", default=False,
+                      help="scale the vertices to the whole v16 range, the scale and offset being written before the list")
+    parser.add_option("--lod", dest="lod_levels", type="int", default=1,
+                      help="number of levels of detail, the first one being the mesh (1 to %d, default : %%default)" % LOD_LEVELS)
+    parser.add_option("--animation", dest="anim_export", action="store_true", default=False,
+                      help="export the meshes as the frames of one animated mesh, the first one being its list")
+    parser.add_option("--anim-tolerance", dest="anim_tolerance", type="int", default=ANIM_TOLERANCE,
+                      help="how far (in 1/4096 units) an interpolated frame may be from the exported one (default : %default)")
+    parser.add_option("--stats", dest="stats_path", default=None,
+                      help="save the time and peak memory of each stage, the counters and the opcodes / bytes of the lists of each mesh to this JSON file")
+    parser.add_option("--profile", dest="profile", action="store_true", default=False,
+                      help="export each mesh under cProfile, its profile being saved to <mesh>.prof")
+    parser.add_option("--roundtrip", dest="roundtrip", action="store_true", default=False,
+                      help="read back the exported lists, compare them with the meshes and write them to <mesh>_decoded.obj")
+    parser.add_option("--check", dest="check", action="store_true", default=False,
+                      help="read exported .bin lists instead of exporting meshes : check them and estimate their geometry cycles (with --rescale for rescaled meshes)")
+    parser.add_option("--verify", dest="verify", action="store_true", default=False,
+                      help="export synthetic meshes with the optimizations turned off and check that their .bin and .h files are the ones of the scalar reference encoder, byte for byte")
+    parser.add_option("--cycle-budget", dest="cycle_budget", type="int", default=0,
+                      help="with --check, fail the lists over this number of geometry cycles")
+    parser.add_option("--benchmark", dest="bench_path", default=None,
+                      help="export synthetic meshes instead of OBJ meshes and save the time, memory and bytes of each stage to this JSON file (the meshes go to -o, or to a temporary directory)")
+    parser.add_option("--bench-kinds", dest="bench_kinds", default=",".join(BENCH_KINDS),
+                      help="synthetic meshes of the benchmark (default : %default)")
+    parser.add_option("--bench-sizes", dest="bench_sizes", default=",".join( [ str(size) for size in BENCH_SIZES ] ),
+                      help="numbers of faces of the synthetic meshes (default : %default)")
+    parser.add_option("--bench-runs", dest="bench_runs", type="int", default=BENCH_RUNS,
+                      help="times each synthetic mesh is exported, keeping the fastest time and smallest memory of each stage (default : %default)")
+    parser.add_option("--bench-baseline", dest="bench_baseline", default=None,
+                      help="fail the stages of the benchmark slower, bigger or using more memory than in this results file")
+    parser.add_option("--bench-threshold", dest="bench_threshold", type="float", default=BENCH_THRESHOLD,
+                      help="how much worse than the baseline (0.25 : 25%) a stage may get (default : %default)")
+    (cli_options, paths) = parser.parse_args(argv)
+    if (cli_options.bench_path != None) :
+        return ( run_benchmark(cli_options) )
+    if (cli_options.verify) :
+        return ( verify_lists(cli_options) )
+    if (len(paths) == 0) :
+        parser.error("no mesh to export")
+    if (cli_options.check) :
+        return ( check_lists(paths , cli_options) )
+
+    print "---------------"
+    print " NDS  EXPORTER"
+    print "---------------"
+
+    if (cli_options.dir_path != None and not os.path.isdir(cli_options.dir_path)) :
+        os.makedirs(cli_options.dir_path)
+
+    errors = 0
+    mesh_options = []
+    #an animation is one mesh, the other paths being its frames
+    if (cli_options.anim_export) :
+        paths = [ ( paths[0] , paths[1:] ) ]
+    else :
+        paths = [ ( path , () ) for path in paths ]
+    for path , frames in paths :
+        try:
+            mesh_options.append( get_obj_options(path , cli_options , frames) )
+        except (IOError , ValueError , IndexError) , e :
+            print "Problem : cannot read %s (%s)" % (path , e)
+            errors += 1
+
+    cache = None
+    if (cli_options.cache_path != None) :
+        cache = _nds_export_cache(cli_options.cache_path , cli_options.cache_size * 1024 * 1024)
+    atlas = None
+    if (cli_options.atlas_size > 0) :
+        atlas = _nds_atlas(mesh_options , cli_options.atlas_size)
+    batch = _nds_batch_export(mesh_options , cli_options.nb_processes , cache , atlas , cli_options.profile)
+    errors += batch.run()
+    print batch
+    if (cli_options.stats_path != None) :
+        batch.save_stats(cli_options.stats_path)
+        print "Export statistics saved to %s" % cli_options.stats_path
+
+    if (cli_options.roundtrip) :
+        for options in mesh_options :
+            roundtrip = _nds_roundtrip(options)
+            print roundtrip.run()
+            if (roundtrip.nb_problems > 0) : errors += 1
+
+    return ( 1 if (errors) else 0 )
+
+
+if __name__ == '__main__' :
+    if (Blender != None) :
+        Blender.Window.FileSelector(my_callback, "Select a directory","")
+    else :
+        raise SystemExit( main() )